@@ -0,0 +1,226 @@
+import argparse
+import os
+import sys
+
+import cv2
+import numpy as np
+
+# the masks of the regions of interest cached across frames (roi_utils) and the video streaming (video_io) are
+# shared with the advanced lane finding project, its directory is resolved here so the module works from any
+# working directory and importer, and appended so the modules of the importer come first
+PROJECT2_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                                             'Project2-Advance-Lane-Finding'))
+if PROJECT2_DIR not in sys.path:
+    sys.path.append(PROJECT2_DIR)
+
+from roi_utils import region_masks
+from video_io import FrameReader, transcode
+
+
+def grayscale(img):
+    """Applies the Grayscale transform
+       if the image is read by cv2.imread(), use BGR2GRAY
+    """
+
+    return cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+
+
+def canny(img, low_threshold, high_threshold):
+    """Applies the Canny transform"""
+    return cv2.Canny(img, low_threshold, high_threshold)
+
+
+def gaussian_blur(img, kernel_size):
+    """Applies a Gaussian Noise kernel"""
+    return cv2.GaussianBlur(img, (kernel_size, kernel_size), 0)
+
+
+def region_of_interest(img, vertices):
+    """
+    Applies an image mask.
+
+    Only keeps the region of the image defined by the polygon
+    formed from `vertices`. The rest of the image is set to black.
+    `vertices` should be a numpy array of integer points.
+    The mask is rasterized once per image shape, type and polygon, and reused for the next frames.
+    """
+    return region_masks.apply(img, vertices)
+
+
+def weighted_img(img, initial_img, α=0.8, β=1., γ=0.):
+    """
+    `img` is the output of the hough_lines(), An image with lines drawn on it.
+    Should be a blank image (all black) with lines drawn on it.
+
+    `initial_img` should be the image before any processing.
+
+    The result image is computed as follows:
+
+    initial_img * α + img * β + γ
+    NOTE: initial_img and img must be the same shape!
+    """
+    return cv2.addWeighted(initial_img, α, img, β, γ)
+
+
+def compute_slope(x1, y1, x2, y2):
+    # vertical segments get an infinite slope, they are not lane lines
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (y2 - y1) / (x2 - x1)
+
+
+def compute_bias(x1, y1, slop):
+    return y1 - slop * x1
+
+
+def fit_lane_lines(lines):
+    '''
+    Select the segments whose angles to the horizontal line are between 30 degrees and 60 degrees, and
+    take the median slope and bias of each side, for all the segments at once
+    :param lines: output of cv2.HoughLinesP, array (n, 1, 4) of segments x1, y1, x2, y2, or None
+    :return: (slope, bias) of the left (negative slope) and right (positive slope) lines, None if a side
+    has no segment
+    '''
+    if lines is None or len(lines) == 0:
+        return None, None
+    x1, y1, x2, y2 = lines.reshape(-1, 4).T
+    slope = compute_slope(x1, y1, x2, y2)
+    bias = compute_bias(x1, y1, slope)
+
+    sides = []
+    for inside in ((-2 < slope) & (slope < -0.5), (0.5 < slope) & (slope < 2)):
+        if inside.any():
+            sides.append((np.median(slope[inside]), np.median(bias[inside])))
+        else:
+            sides.append(None)
+    return sides[0], sides[1]
+
+
+class LaneSmoother():
+    '''
+    Exponential moving average of the slope and bias of both lines over the frames of a video.
+
+    A side without any segment in a frame keeps its previous line.
+    '''
+    def __init__(self, alpha=0.2):
+        # weight of the line of the new frame
+        self.alpha = alpha
+        # smoothed (slope, bias) of the left and right lines, None until first seen
+        self.lines = [None, None]
+
+    def update(self, left, right):
+        '''
+        :param left: (slope, bias) of the left line in the new frame, or None
+        :param right: (slope, bias) of the right line in the new frame, or None
+        :return: the smoothed left and right lines
+        '''
+        for side, line in enumerate((left, right)):
+            if line is None:
+                continue
+            if self.lines[side] is None:
+                self.lines[side] = np.array(line, np.float64)
+            else:
+                self.lines[side] += self.alpha * (np.array(line, np.float64) - self.lines[side])
+        return self.lines[0], self.lines[1]
+
+    def reset(self):
+        self.lines = [None, None]
+
+
+def draw_lines(img, lines, imshape, color=[255, 0, 0], thickness=8, smoother=None):
+    '''
+    Select lines whose angles to the horizontal line are between 30 degrees and 60 degrees and connect the line segments into a line
+    :param smoother: optional LaneSmoother averaging the lines over the frames
+    '''
+    left, right = fit_lane_lines(lines)
+    if smoother is not None:
+        left, right = smoother.update(left, right)
+
+    if left is not None:
+        neg_slope, neg_bias = left[0], np.asarray(left[1]).astype(int)
+        x1, y1 = 0, neg_bias
+        x2, y2 = np.int32(np.round(imshape[1]/2-50)), np.int32(np.round((imshape[1]/2-50))*neg_slope+neg_bias)
+        cv2.line(img, (int(x1), int(y1)), (int(x2), int(y2)), color, thickness)
+
+    if right is not None:
+        pos_slope, pos_bias = right[0], np.asarray(right[1]).astype(int)
+        x1, y1 = np.int32(np.round(imshape[1]/2+50)), np.int32(np.round((imshape[1]/2+50))*pos_slope+pos_bias)
+        x2, y2 = np.int32(np.round((imshape[0]-pos_bias)/pos_slope)), imshape[0]
+        cv2.line(img, (int(x1), int(y1)), (int(x2), int(y2)), color, thickness)
+
+
+def hough_lines(img, rho, theta, threshold, min_line_len, max_line_gap, imshape, smoother=None):
+    """
+    `img` should be the output of a Canny transform.
+
+    Returns an image with hough lines drawn.
+    """
+    lines = cv2.HoughLinesP(img, rho, theta, threshold, np.array([]), minLineLength=min_line_len, maxLineGap=max_line_gap)
+    line_img = np.zeros((img.shape[0], img.shape[1], 3), dtype=np.uint8)
+    draw_lines(line_img, lines, imshape, smoother=smoother)
+    return line_img
+
+
+def pipeline(image, kernel_size=3, low_threshold=100, high_threshold=200, rho=2, theta=np.pi/180, threshold=20,
+             min_line_len=20, max_line_gap=8, smoother=None):
+    '''
+    kernel_size: kernel_size of Gaussian blur （usually an odd inteter)
+    low_threshold: parameter for canny edge detection. It is the high threshold value of intensity gradient. In our case, it ranges from 0 to 255.
+    high_threshold: parameter for canny edge detection. It is the low threshold value of intensity gradient. In our case, it ranges from 0 to 255.
+    rho: distance resolution of our grid in Hough space in pixels
+    theta: angle resolution of our grid in Hough space in pixels
+    threshold: only those lines are returned that get enough votes ( >threshold )
+    min_line_len: the minimum length of a line (in pixels) that you will accept in the output
+    max_line_gap: the maximum distance (in pixels) between segments that you will allow to be connected into a single line
+    smoother: optional LaneSmoother averaging the lines over the frames of a video
+    '''
+
+    # Create a masked edges image
+    gray_img = grayscale(image)
+    blur_img = gaussian_blur(gray_img, kernel_size)
+    edges = canny(blur_img, low_threshold, high_threshold)
+    imshape = image.shape
+    vertices = np.array([[(0,imshape[0]),(imshape[1]/2-25, imshape[0]/2+50),(imshape[1]/2+25,imshape[0]/2+50),(imshape[1], imshape[0])]],dtype = np.int32)
+    masked_image = region_of_interest(edges, vertices)
+
+    # Run Hough on edge detected image to get the line image
+    line_image = hough_lines(masked_image, rho, theta, threshold, min_line_len, max_line_gap, imshape, smoother)
+
+    # draw lane lines on the original image
+    weighted_image = weighted_img(line_image, image, α=0.8, β=1., γ=0.)
+
+    return weighted_image
+
+
+def process_video(input_path, output_path, smoothing=0.2, step=1, **params):
+    '''
+    Draw the lane lines on every frame of a video, the frames are streamed through video_io
+    :param smoothing: weight of the new frame in the moving average of the lines, 1 disables it
+    :param step: process one frame out of step
+    :param params: parameters of pipeline()
+    :return: the number of processed frames
+    '''
+    smoother = LaneSmoother(smoothing)
+    with FrameReader(input_path, step=step) as reader:
+        return transcode(reader, output_path, lambda frame: pipeline(frame, smoother=smoother, **params),
+                         fps=reader.fps / step)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find the lane lines of a video with the Hough transform.')
+    parser.add_argument('input', type=str, help='Path of the input video.')
+    parser.add_argument('output', type=str, help='Path of the output video.')
+    parser.add_argument('--smoothing', type=float, default=0.2,
+                        help='Weight of the new frame in the moving average of the lines, 1 disables it.')
+    parser.add_argument('--step', type=int, default=1, help='Process one frame out of step.')
+    parser.add_argument('--kernel_size', type=int, default=3, help='Kernel size of the Gaussian blur.')
+    parser.add_argument('--low_threshold', type=int, default=100, help='Low threshold of the Canny edge detection.')
+    parser.add_argument('--high_threshold', type=int, default=200, help='High threshold of the Canny edge detection.')
+    parser.add_argument('--threshold', type=int, default=20, help='Minimum number of votes of a Hough line.')
+    parser.add_argument('--min_line_len', type=int, default=20, help='Minimum length of a Hough line.')
+    parser.add_argument('--max_line_gap', type=int, default=8, help='Maximum gap between the segments of a line.')
+    args = parser.parse_args()
+
+    frames = process_video(args.input, args.output, args.smoothing, args.step, kernel_size=args.kernel_size,
+                           low_threshold=args.low_threshold, high_threshold=args.high_threshold,
+                           threshold=args.threshold, min_line_len=args.min_line_len, max_line_gap=args.max_line_gap)
+    print('{} frames written to {}'.format(frames, args.output))
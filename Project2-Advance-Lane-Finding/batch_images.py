@@ -0,0 +1,163 @@
+import argparse
+import concurrent.futures
+import glob
+import json
+import multiprocessing
+import os
+import sys
+
+import cv2
+import numpy as np
+
+from calibration_utils import camera_calibration
+from curvature_utils import offset_to_center
+from line_utils import Line
+from pipeline import pipeline
+
+# directory of the Hough transform pipeline of Project1
+PROJECT1_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Project1-Find-Lane-Lines')
+
+# settings of the worker processes, set by init_worker
+worker_settings = None
+
+
+def list_images(pattern):
+    '''
+    :param pattern: directory of images, or glob pattern
+    :return: the sorted paths of the images
+    '''
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*')
+    extensions = ('.jpg', '.jpeg', '.png', '.bmp')
+    return sorted(path for path in glob.glob(pattern) if path.lower().endswith(extensions))
+
+
+def init_worker(method, output_dir, mtx, dist):
+    global worker_settings
+    if method == 'hough' and PROJECT1_DIR not in sys.path:
+        sys.path.append(PROJECT1_DIR)
+    worker_settings = (method, output_dir, mtx, dist)
+
+
+def advanced_lanes(image, mtx, dist):
+    '''
+    :return: the annotated image and the lane fits, curvature and offset of the advanced pipeline
+    '''
+    left_lane_line, right_lane_line = Line(), Line()
+    result = pipeline(image, mtx, dist, left_lane_line, right_lane_line, 9, 100, 50, False, True)
+    return result, {'left_fit': left_lane_line.best_fit.tolist(), 'right_fit': right_lane_line.best_fit.tolist(),
+                    'curvature': float(np.mean([left_lane_line.radius_of_curvature,
+                                                right_lane_line.radius_of_curvature])),
+                    'offset': float(offset_to_center(image, left_lane_line, right_lane_line))}
+
+
+def hough_lanes(image):
+    '''
+    :return: the annotated image and the slope and bias of the lines of the Hough transform pipeline
+    '''
+    from lane_lines import LaneSmoother, pipeline as hough_pipeline
+    # a new smoother holds the lines of the image it has seen
+    smoother = LaneSmoother()
+    result = hough_pipeline(image, smoother=smoother)
+    lines = [None if line is None else {'slope': float(line[0]), 'bias': float(line[1])} for line in smoother.lines]
+    return result, {'left_line': lines[0], 'right_line': lines[1]}
+
+
+def decode(path):
+    bgr = cv2.imread(path)
+    if bgr is None:
+        raise IOError('Cannot read image {}'.format(path))
+    return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+
+
+def encode(path, image, report):
+    if image is not None:
+        cv2.imwrite(path, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+    with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def process_chunk(paths):
+    '''
+    Process a chunk of images in a worker. The next image is decoded and the previous one encoded by
+    threads while the current one is processed, cv2 releases the GIL for both.
+    :return: the report of each image
+    '''
+    method, output_dir, mtx, dist = worker_settings
+    reports = []
+    with concurrent.futures.ThreadPoolExecutor(2) as io:
+        writes = []
+        upcoming = io.submit(decode, paths[0])
+        for i, path in enumerate(paths):
+            report = {'image': path}
+            try:
+                image = upcoming.result()
+            except Exception as e:
+                image = None
+                report['error'] = str(e)
+            if i + 1 < len(paths):
+                upcoming = io.submit(decode, paths[i + 1])
+            result = None
+            if image is not None:
+                try:
+                    if method == 'hough':
+                        result, lanes = hough_lanes(image)
+                    else:
+                        result, lanes = advanced_lanes(image, mtx, dist)
+                    report.update(lanes)
+                except Exception as e:
+                    report['error'] = '{}: {}'.format(type(e).__name__, e)
+            # the report of a failed image is written without annotated image
+            writes.append(io.submit(encode, os.path.join(output_dir, os.path.basename(path)), result, report))
+            reports.append(report)
+        for write in writes:
+            write.result()
+    return reports
+
+
+def process_images(paths, output_dir, method='advanced', mtx=None, dist=None, workers=None, chunksize=16):
+    '''
+    Apply a lane finding pipeline to independent images on a process pool
+    :param paths: paths of the images
+    :param output_dir: directory of the annotated images and of their json reports
+    :param method: 'advanced' for the pipeline of this project, 'hough' for the one of Project1
+    :param mtx: camera matrix, for the advanced pipeline
+    :param dist: distortion coefficient, for the advanced pipeline
+    :param workers: number of worker processes, all the cores by default
+    :param chunksize: number of images sent to a worker at once
+    :return: the reports of the images, in the order of paths
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    chunks = [paths[i:i + chunksize] for i in range(0, len(paths), chunksize)]
+    workers = workers or multiprocessing.cpu_count()
+    reports = []
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(method, output_dir, mtx, dist)) as pool:
+        for chunk_reports in pool.imap(process_chunk, chunks):
+            reports += chunk_reports
+    return reports
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find the lane lines of a directory of images.')
+    parser.add_argument('input', type=str, help='Directory of the images, or glob pattern.')
+    parser.add_argument('output', type=str, help='Directory of the annotated images and their json reports.')
+    parser.add_argument('--method', type=str, default='advanced', choices=['advanced', 'hough'],
+                        help='Advanced lane finding pipeline, or the Hough transform pipeline of Project1.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes.')
+    parser.add_argument('--chunksize', type=int, default=16, help='Number of images sent to a worker at once.')
+    parser.add_argument('--camera_cal', type=str, default='camera_cal',
+                        help='Directory of the chessboard images used to calibrate the camera.')
+    parser.add_argument('--cache', type=str, default='camera_cal/calibration.npz',
+                        help='File storing the camera calibration between runs.')
+    args = parser.parse_args()
+
+    mtx = dist = None
+    if args.method == 'advanced':
+        images = glob.glob(os.path.join(args.camera_cal, 'calibration*.jpg'))
+        _, mtx, dist, _, _ = camera_calibration(images, 9, 6, cache_file=args.cache)
+    paths = list_images(args.input)
+    reports = process_images(paths, args.output, args.method, mtx, dist, args.workers, args.chunksize)
+    failed = [report for report in reports if 'error' in report]
+    print('{} images written to {}, {} failed'.format(len(reports) - len(failed), args.output, len(failed)))
+    for report in failed:
+        print('{}: {}'.format(report['image'], report['error']))
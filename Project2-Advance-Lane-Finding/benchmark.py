@@ -0,0 +1,249 @@
+import argparse
+import json
+import platform
+import sys
+import timeit
+
+import cv2
+import numpy as np
+
+import binary_utils
+import curvature_utils
+import lane_pixels_utils
+import perspective_transform_utils
+from line_utils import Line
+from pipeline import pipeline, preprocess
+
+# camera without distortion, the synthetic frames are already undistorted
+MTX = np.array([[1000., 0., 640.], [0., 1000., 360.], [0., 0., 1.]])
+DIST = np.zeros((1, 5))
+
+
+def lane_fits(height, frame=0):
+    '''
+    :param height: height of the image
+    :param frame: index of the frame, the lane drifts slowly from frame to frame
+    :return: the known polynomial coefficients of the left and right lane lines in the birds-eye view
+    '''
+    # x = k * (height - 1 - y) ** 2 + x_bottom, expanded to a * y ** 2 + b * y + c
+    k = 1.5e-4 * np.cos(frame / 25.)
+    x_bottom = 340 + 10 * np.sin(frame / 40.)
+    y0 = height - 1
+    left_fit = np.array([k, -2 * k * y0, k * y0 ** 2 + x_bottom])
+    right_fit = left_fit + np.array([0., 0., 600.])
+    return left_fit, right_fit
+
+
+def synthetic_frame(width=1280, height=720, noise=0.01, frame=0, seed=0):
+    '''
+    Deterministic road frame with a white left lane line and a yellow right lane line
+    :param width: width of the frame
+    :param height: height of the frame
+    :param noise: fraction of the road pixels replaced by bright speckles
+    :param frame: index of the frame in a synthetic video
+    :param seed: seed of the noise
+    :return: RGB frame and the known fits of the left and right lines in the birds-eye view
+    '''
+    random = np.random.RandomState(seed + frame)
+    left_fit, right_fit = lane_fits(height, frame)
+
+    # draw the lane lines in the birds-eye view and warp them to the camera view
+    ploty = np.arange(height)
+    lines = np.zeros((height, width, 3), np.uint8)
+    for fit, color in ((left_fit, (255, 255, 255)), (right_fit, (255, 210, 0))):
+        fitx = fit[0] * ploty ** 2 + fit[1] * ploty + fit[2]
+        pts = np.int32(np.dstack((fitx, ploty)))
+        cv2.polylines(lines, pts, isClosed=False, color=color, thickness=20)
+    lines = perspective_transform_utils.warped_test_images(lines, inverse=True)
+
+    # grey asphalt below the horizon, blue sky above
+    img = np.empty((height, width, 3), np.uint8)
+    img[:height // 2 + 100] = (120, 160, 210)
+    road = 90 + random.normal(0, 6, (height - height // 2 - 100, width, 3))
+    img[height // 2 + 100:] = np.clip(road, 0, 255).astype(np.uint8)
+    mask = lines.any(axis=2)
+    img[mask] = lines[mask]
+
+    # bright speckles on the road
+    speckles = random.random_sample(img.shape[:2]) < noise
+    speckles[:height // 2 + 100] = False
+    img[speckles] = random.randint(150, 256, (np.count_nonzero(speckles), 3))
+    return img, left_fit, right_fit
+
+
+def time_call(func, number, repeat):
+    '''
+    :return: the median and minimum duration of a call in milliseconds
+    '''
+    times = np.array(timeit.repeat(func, number=number, repeat=repeat)) / number * 1000
+    return {'median_ms': float(np.median(times)), 'min_ms': float(np.min(times)), 'runs': number * repeat}
+
+
+def benchmarks(img, nframes, noise, seed):
+    '''
+    :return: the functions to time, by name
+    '''
+    thresh = (20, 100)
+    gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    imshape = img.shape
+    vertices = np.array([[(0, imshape[0]), (imshape[1] / 2 - 25, imshape[0] / 2 + 50),
+                          (imshape[1] / 2 + 25, imshape[0] / 2 + 50), (imshape[1], imshape[0])]], dtype=np.int32)
+    combined = binary_utils.combined_gradient_threshold(img, thresh, (0.7, 1.3), 9)
+    undist, combined_binary, warped = preprocess(img, MTX, DIST)
+    img_size = (img.shape[1], img.shape[0])
+
+    # lines located by a blind search, as at the start of the tracking
+    left, right = Line(), Line()
+    lane_pixels_utils.find_lane_pixels_blind(warped, left, right, 9, 100, 50, False)
+    lane_pixels_utils.fit_polynomial(left, right, warped)
+    ploty = np.linspace(0, warped.shape[0] - 1, warped.shape[0])
+    warped_color = np.dstack((warped, warped, warped)) * 255
+
+    frames = [synthetic_frame(img.shape[1], img.shape[0], noise, i, seed)[0] for i in range(nframes)]
+
+    def run_video(blind):
+        left_lane_line, right_lane_line = Line(), Line()
+        for frame in frames:
+            if blind:
+                left_lane_line.detected = False
+            pipeline(frame, MTX, DIST, left_lane_line, right_lane_line, 9, 100, 50, False, True)
+
+    return {
+        'binary_utils.compare_color_space': lambda: binary_utils.compare_color_space(img),
+        'binary_utils.compare_binary': lambda: binary_utils.compare_binary(gray, thresh),
+        'binary_utils.abs_sobel_thresh_x': lambda: binary_utils.abs_sobel_thresh(img, thresh, 'x', 9),
+        'binary_utils.abs_sobel_thresh_y': lambda: binary_utils.abs_sobel_thresh(img, thresh, 'y', 9),
+        'binary_utils.mag_thresh': lambda: binary_utils.mag_thresh(img, 9, thresh),
+        'binary_utils.ang_thresh': lambda: binary_utils.ang_thresh(img, 9, (0.7, 1.3)),
+        'binary_utils.get_sxbinary': lambda: binary_utils.get_sxbinary(gray, thresh),
+        'binary_utils.combined_gradient_threshold': lambda: binary_utils.combined_gradient_threshold(
+            img, thresh, (0.7, 1.3), 9),
+        'binary_utils.combined_color_threshold': lambda: binary_utils.combined_color_threshold(
+            img, (170, 255), combined),
+        'binary_utils.region_of_interest': lambda: binary_utils.region_of_interest(combined_binary, vertices),
+        'binary_utils.color_transform': lambda: binary_utils.color_transform(img, (170, 255), thresh, 3),
+        'perspective_transform_utils.warped_test_images': lambda: perspective_transform_utils.warped_test_images(
+            combined_binary, False),
+        'perspective_transform_utils.warped_test_images_inverse': lambda:
+            perspective_transform_utils.warped_test_images(warped_color, True),
+        'perspective_transform_utils.BirdsEyeTransform.warp': lambda: perspective_transform_utils.birds_eye.warp(
+            combined_binary),
+        'perspective_transform_utils.BirdsEyeTransform.unwarp': lambda:
+            perspective_transform_utils.birds_eye.unwarp(warped_color),
+        'perspective_transform_utils.weighted_img': lambda: perspective_transform_utils.weighted_img(
+            warped_color, undist, 1, 0.5, 0.),
+        'perspective_transform_utils.perspective_points': lambda: perspective_transform_utils.perspective_points(
+            img_size),
+        'lane_pixels_utils.hist': lambda: lane_pixels_utils.hist(warped),
+        'lane_pixels_utils.find_lane_pixels_blind': lambda: lane_pixels_utils.find_lane_pixels_blind(
+            warped, Line(), Line(), 9, 100, 50, False),
+        'lane_pixels_utils.find_lane_pixels': lambda: lane_pixels_utils.find_lane_pixels(warped, left, right, 100),
+        'lane_pixels_utils.find_lane_pixels_band': lambda: lane_pixels_utils.find_lane_pixels(
+            warped, left, right, 100, band=True),
+        'lane_pixels_utils.fit_polynomial': lambda: lane_pixels_utils.fit_polynomial(left, right, warped),
+        'lane_pixels_utils.sanity_check': lambda: lane_pixels_utils.sanity_check(left.bestx, right.bestx, 50),
+        'lane_pixels_utils.visualization_window': lambda: lane_pixels_utils.visualization_window(
+            np.copy(warped_color), left, right),
+        'lane_pixels_utils.visualization_outimg': lambda: lane_pixels_utils.visualization_outimg(
+            warped, left, right, ploty, 100, True),
+        'curvature_utils.offset_to_center': lambda: curvature_utils.offset_to_center(warped, left, right),
+        'curvature_utils.measure_curvature_pixels': lambda: curvature_utils.measure_curvature_pixels(
+            left, right, ploty),
+        # per frame duration of the whole pipeline over the synthetic video
+        'pipeline.tracked': (lambda: run_video(False), len(frames)),
+        'pipeline.blind': (lambda: run_video(True), len(frames)),
+    }
+
+
+def accuracy(nframes, noise, seed, width, height):
+    '''
+    :return: the largest distance in pixels between the tracked lines and the known lines over the video
+    '''
+    left_lane_line, right_lane_line = Line(), Line()
+    ploty = np.arange(height)
+    error = 0.
+    for i in range(nframes):
+        frame, left_fit, right_fit = synthetic_frame(width, height, noise, i, seed)
+        pipeline(frame, MTX, DIST, left_lane_line, right_lane_line, 9, 100, 50, False, True)
+        for lane_line, fit in ((left_lane_line, left_fit), (right_lane_line, right_fit)):
+            fitx = fit[0] * ploty ** 2 + fit[1] * ploty + fit[2]
+            error = max(error, float(np.max(np.absolute(lane_line.bestx - fitx))))
+    return error
+
+
+def run(width=1280, height=720, noise=0.01, nframes=20, seed=0, number=5, repeat=3, only=None):
+    '''
+    :param only: if set, only run the benchmarks whose name contains this string
+    :return: the results of the benchmarks
+    '''
+    img, _, _ = synthetic_frame(width, height, noise, 0, seed)
+    results = {}
+    for name, bench in benchmarks(img, nframes, noise, seed).items():
+        if only is not None and only not in name:
+            continue
+        if isinstance(bench, tuple):
+            func, calls = bench
+            stats = time_call(func, 1, repeat)
+            stats = {'median_ms': stats['median_ms'] / calls, 'min_ms': stats['min_ms'] / calls,
+                     'runs': stats['runs'] * calls}
+        else:
+            stats = time_call(bench, number, repeat)
+        results[name] = stats
+        print('{:60s} {:10.3f} ms'.format(name, stats['median_ms']), file=sys.stderr)
+
+    return {
+        'meta': {'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv2.__version__,
+                 'machine': platform.machine(), 'width': width, 'height': height, 'noise': noise,
+                 'frames': nframes, 'seed': seed},
+        'accuracy_px': accuracy(nframes, noise, seed, width, height),
+        'results': results,
+    }
+
+
+def compare(report, baseline, tolerance):
+    '''
+    :param report: results of this run
+    :param baseline: results of a previous run
+    :param tolerance: allowed relative slow down, 0.2 for 20%
+    :return: the names of the benchmarks slower than the baseline by more than the tolerance
+    '''
+    regressions = {}
+    for name, stats in report['results'].items():
+        if name not in baseline['results']:
+            continue
+        ratio = stats['median_ms'] / baseline['results'][name]['median_ms']
+        stats['baseline_ratio'] = ratio
+        if ratio > 1 + tolerance:
+            regressions[name] = ratio
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the lane finding stages on synthetic frames.')
+    parser.add_argument('--output', type=str, default='', help='Json file to write the results to.')
+    parser.add_argument('--baseline', type=str, default='', help='Json results of a previous run to compare with.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative slow down.')
+    parser.add_argument('--width', type=int, default=1280, help='Width of the synthetic frames.')
+    parser.add_argument('--height', type=int, default=720, help='Height of the synthetic frames.')
+    parser.add_argument('--noise', type=float, default=0.01, help='Fraction of noisy road pixels.')
+    parser.add_argument('--frames', type=int, default=20, help='Number of frames of the pipeline benchmarks.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic frames.')
+    parser.add_argument('--only', type=str, default=None, help='Only run the benchmarks containing this name.')
+    args = parser.parse_args()
+
+    report = run(args.width, args.height, args.noise, args.frames, args.seed, only=args.only)
+    regressions = {}
+    if args.baseline != '':
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        report['regressions'] = regressions
+
+    if args.output != '':
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    for name, ratio in sorted(regressions.items()):
+        print('REGRESSION {}: {:.2f}x slower than the baseline'.format(name, ratio), file=sys.stderr)
+    sys.exit(1 if regressions else 0)
@@ -1,6 +1,9 @@
+import math
 import cv2
 import numpy as np
 
+from roi_utils import region_masks
+
 def compare_color_space(img):
     '''
     Generate color channel maps of 3 color space
@@ -41,7 +44,9 @@ def abs_sobel_thresh(img, thresh, orient='x', sobel_kernel=3):
         # scale to 8-bit (0 - 255) then convert to type = np.uint8
         scaled_sobel = np.uint8(255*abs_sobelx/np.max(abs_sobelx))
     else:
-        scaled_sobel = np.uint8(255*np.absolute(cv2.Sobel(gray, cv2.CV_64F, 0, 1, ksize=sobel_kernel))/np.max(np.absolute(cv2.Sobel(gray, cv2.CV_64F, 0, 1, ksize=sobel_kernel))))
+        # take the derivative in y once and reuse it for the scaling
+        abs_sobely = np.absolute(cv2.Sobel(gray, cv2.CV_64F, 0, 1, ksize=sobel_kernel))
+        scaled_sobel = np.uint8(255*abs_sobely/np.max(abs_sobely))
     binary = np.zeros_like(scaled_sobel)
     binary[(scaled_sobel >= thresh[0]) & (scaled_sobel < thresh[1])] = 1
     return binary
@@ -98,50 +103,311 @@ def get_sxbinary(scaled_sobel, sx_thresh):
 
     return sxbinary
 
-def combined_gradient_threshold(img, sx_thresh, dir_thresh, sobel_kernel):
+def scaled_bounds(peak, thresh, scale, upper_inclusive=False):
+    '''
+    Translate a threshold on the 8-bit rescaled gradient into bounds on the raw gradient
+    :param peak: maximum raw value of the frame (the value that is scaled to 255)
+    :param thresh: threshold (low, high) on the rescaled 8-bit value
+    :param scale: function mapping a raw value to its rescaled 8-bit value
+    :param upper_inclusive: if True, the high threshold is inclusive
+    :return: integer bounds (low, high) so that low <= raw < high passes the threshold
+    '''
+
+    def first_above(t, strict):
+        # the rescaled value is monotonic in the raw value, bisect on integers in [0, peak + 1]
+        low, high = 0, int(peak) + 1
+        while low < high:
+            mid = (low + high) // 2
+            value = scale(mid)
+            if value > t or (not strict and value >= t):
+                high = mid
+            else:
+                low = mid + 1
+        return low
+
+    return first_above(thresh[0], False), first_above(thresh[1], upper_inclusive)
+
+
+class GradientEngine():
+    '''
+    Compute grayscale and Sobel x/y once per frame and derive all gradient masks from them.
+
+    The float32 derivatives of an 8-bit image are exact integers, so every threshold of
+    abs_sobel_thresh, mag_thresh and ang_thresh is applied as an exact comparison on the raw
+    gradient and the masks are identical to the ones of those functions.
+    '''
+    def __init__(self):
+        # shape of the allocated workspace
+        self.shape = None
+        # grayscale image of the current frame
+        self.gray = None
+        # absolute x and y derivatives
+        self.abs_sobelx = None
+        self.abs_sobely = None
+        # squared gradient magnitude (float64 keeps it exact)
+        self.sq_mag = None
+        # float64 scratch buffer for the direction tests
+        self.scratch = None
+        # boolean masks of each threshold
+        self.gradx = None
+        self.grady = None
+        self.magbinary = None
+        self.dirbinary = None
+        self.tmp = None
+
+    def allocate(self, shape):
+        if self.shape == shape:
+            return
+        self.shape = shape
+        self.gray = np.empty(shape, np.uint8)
+        self.abs_sobelx = np.empty(shape, np.float32)
+        self.abs_sobely = np.empty(shape, np.float32)
+        self.sq_mag = np.empty(shape, np.float64)
+        self.scratch = np.empty(shape, np.float64)
+        self.gradx = np.empty(shape, bool)
+        self.grady = np.empty(shape, bool)
+        self.magbinary = np.empty(shape, bool)
+        self.dirbinary = np.empty(shape, bool)
+        self.tmp = np.empty(shape, bool)
+
+    def compute(self, img, sobel_kernel):
+        '''
+        Fill the workspace with the gradients of an RGB image
+        '''
+        self.allocate(img.shape[:2])
+        self.sobel(img, sobel_kernel, self.gray, self.abs_sobelx, self.abs_sobely)
+        self.magnitude()
+
+    def sobel(self, img, sobel_kernel, gray, sobelx, sobely):
+        cv2.cvtColor(img, cv2.COLOR_RGB2GRAY, dst=gray)
+        cv2.Sobel(gray, cv2.CV_32F, 1, 0, dst=sobelx, ksize=sobel_kernel)
+        cv2.Sobel(gray, cv2.CV_32F, 0, 1, dst=sobely, ksize=sobel_kernel)
+
+    def magnitude(self):
+        np.absolute(self.abs_sobelx, out=self.abs_sobelx)
+        np.absolute(self.abs_sobely, out=self.abs_sobely)
+        np.square(self.abs_sobelx, out=self.sq_mag, dtype=np.float64)
+        np.square(self.abs_sobely, out=self.scratch, dtype=np.float64)
+        np.add(self.sq_mag, self.scratch, out=self.sq_mag)
+
+    def in_bounds(self, values, bounds, out):
+        np.greater_equal(values, bounds[0], out=out)
+        np.less(values, bounds[1], out=self.tmp)
+        np.logical_and(out, self.tmp, out=out)
+        return out
+
+    def abs_mask(self, orient, thresh):
+        '''
+        Same mask as abs_sobel_thresh, as a boolean array
+        '''
+        if orient == 'x':
+            abs_sobel, out = self.abs_sobelx, self.gradx
+        else:
+            abs_sobel, out = self.abs_sobely, self.grady
+        peak = float(abs_sobel.max())
+        # np.uint8(255 * abs_sobel / np.max(abs_sobel)), evaluated on a single value
+        scale = lambda v: int(255 * v / peak) if peak > 0 else 0
+        return self.in_bounds(abs_sobel, scaled_bounds(peak, thresh, scale), out)
+
+    def mag_mask(self, thresh):
+        '''
+        Same mask as mag_thresh, as a boolean array
+        '''
+        peak = float(self.sq_mag.max())
+        max_mag = math.sqrt(peak)
+        scale = lambda v: int(255 * math.sqrt(v) / max_mag) if peak > 0 else 0
+        bounds = scaled_bounds(peak, thresh, scale, upper_inclusive=True)
+        return self.in_bounds(self.sq_mag, bounds, self.magbinary)
+
+    def dir_mask(self, thresh):
+        '''
+        Same mask as ang_thresh, as a boolean array
+
+        arctan2(|sy|, |sx|) >= t is tested as |sy| >= tan(t) * |sx|, which avoids the arctan2
+        over the whole frame. (0, 0) has an angle of 0 and is handled separately.
+        '''
+        out = self.dirbinary
+        low, high = thresh
+        if low <= 0:
+            out.fill(True)
+        elif low > np.pi / 2:
+            out.fill(False)
+        else:
+            np.multiply(self.abs_sobelx, np.tan(low), out=self.scratch, dtype=np.float64)
+            np.greater_equal(self.abs_sobely, self.scratch, out=out)
+            np.greater(self.abs_sobely, 0, out=self.tmp)
+            np.logical_and(out, self.tmp, out=out)
+        if high < 0:
+            out.fill(False)
+        elif high < np.pi / 2:
+            np.multiply(self.abs_sobelx, np.tan(high), out=self.scratch, dtype=np.float64)
+            np.less_equal(self.abs_sobely, self.scratch, out=self.tmp)
+            np.logical_and(out, self.tmp, out=out)
+        return out
+
+    def combined(self, img, sx_thresh, dir_thresh, sobel_kernel, out=None):
+        '''
+        Same result as the combination of the four gradient thresholds
+        :param img: original image
+        :param sx_thresh: gradient threshold
+        :param dir_thresh: threshold of the gradient direction
+        :param sobel_kernel: kernel size
+        :param out: optional uint8 array to write the binary map into
+        :return: the combined binary map
+        '''
+        self.compute(img, sobel_kernel)
+        if out is None:
+            out = np.empty(self.shape, np.uint8)
+        return self.combine(sx_thresh, dir_thresh, out)
+
+    def combined_boxes(self, img, boxes, sx_thresh, dir_thresh, sobel_kernel):
+        '''
+        Same as combined() on each box of the image, but the thresholds are relative to the peaks of all
+        the boxes together, as if they were one image
+        :param img: original image
+        :param boxes: list of (x0, y0, x1, y1) boxes of the image
+        :return: the list of the combined binary maps of the boxes
+        '''
+        shapes = [(y1 - y0, x1 - x0) for x0, y0, x1, y1 in boxes]
+        ends = np.cumsum([height * width for height, width in shapes]).tolist()
+        total = ends[-1] if ends else 0
+        if self.shape is None or len(self.shape) != 1 or self.shape[0] < total:
+            # the boxes are laid out one after the other, with room for larger boxes on the next frames
+            self.allocate((total + total // 4 + 1,))
+        for (x0, y0, x1, y1), shape, end in zip(boxes, shapes, ends):
+            start = end - shape[0] * shape[1]
+            view = lambda buffer: buffer[start:end].reshape(shape)
+            # each box is derived on its own, so no gradient crosses the boundary of two boxes
+            self.sobel(img[y0:y1, x0:x1], sobel_kernel, view(self.gray), view(self.abs_sobelx), view(self.abs_sobely))
+        # the unused end of the workspace has no gradient, which leaves the peaks unchanged
+        self.abs_sobelx[total:] = 0
+        self.abs_sobely[total:] = 0
+        self.magnitude()
+        out = self.combine(sx_thresh, dir_thresh, np.empty(self.shape, np.uint8))
+        return [out[end - height * width:end].reshape(height, width) for (height, width), end in zip(shapes, ends)]
+
+    def combine(self, sx_thresh, dir_thresh, out):
+        '''
+        Combine the four gradient thresholds of the workspace into out
+        '''
+        gradx = self.abs_mask('x', sx_thresh)
+        grady = self.abs_mask('y', sx_thresh)
+        magbinary = self.mag_mask(sx_thresh)
+        dirbinary = self.dir_mask(dir_thresh)
+
+        # ((gradx == 1) & (grady == 1)) | ((magbinary == 1) & (dirbinary == 1))
+        np.logical_and(gradx, grady, out=gradx)
+        np.logical_and(magbinary, dirbinary, out=magbinary)
+        np.logical_or(gradx, magbinary, out=gradx)
+        np.copyto(out, gradx, casting='unsafe')
+        return out
+
+
+# workspace reused across the frames of a video
+gradient_engine = GradientEngine()
+
+
+def combined_gradient_threshold(img, sx_thresh, dir_thresh, sobel_kernel, engine=None):
     '''
     Combine gradient thresh and color thresh
     :param img: original image
     :param s_thresh: threshold of saturation color channel
     :param sx_thresh: gradient threshold
     :param sobel_kernel: kernel size
+    :param engine: GradientEngine holding the workspace, the shared one by default
     :return: color map and combined image
     '''
 
-    gradx = abs_sobel_thresh(img, thresh=sx_thresh, orient='x', sobel_kernel=sobel_kernel)
-    grady = abs_sobel_thresh(img, thresh=sx_thresh, orient='y', sobel_kernel=sobel_kernel)
-    magbinary = mag_thresh(img, sobel_kernel, sx_thresh)
-    dirbinary = ang_thresh(img, sobel_kernel=sobel_kernel, thresh=dir_thresh)
+    if engine is None:
+        engine = gradient_engine
+    return engine.combined(img, sx_thresh, dir_thresh, sobel_kernel)
 
-    # combine the two binary thresholds
-    combined_binary = np.zeros_like(magbinary)
-    combined_binary[((gradx == 1) & (grady == 1)) | ((magbinary == 1) & (dirbinary == 1))] = 1
+class SaturationClassifier():
+    '''
+    Classify RGB pixels against a threshold of the HLS saturation channel with a lookup table.
 
-    return combined_binary
+    The saturation of a pixel only depends on the maximum and the minimum of its R, G and B
+    values, so a 256 x 256 table indexed by (max, min) holds the "passes s_thresh" bit of every
+    RGB color. The table is rebuilt only when the threshold changes.
+    '''
+    def __init__(self):
+        # threshold the table was built for
+        self.thresh = None
+        # 0/1 bit of every (max, min) pair, flattened to 65536 entries
+        self.table = None
+        # shape of the allocated workspace
+        self.shape = None
+        # per-pixel maximum and minimum of the color channels
+        self.vmax = None
+        self.vmin = None
+        # (max, min) index of each pixel into the table
+        self.index = None
+
+    def build(self, s_thresh):
+        '''
+        Build the lookup table for a threshold of the saturation channel
+        '''
+        s_thresh = tuple(s_thresh)
+        if self.thresh == s_thresh:
+            return self.table
+        # one pixel (max, min, min) for every pair of values
+        vmax, vmin = np.meshgrid(np.arange(256, dtype=np.uint8), np.arange(256, dtype=np.uint8), indexing='ij')
+        colors = np.dstack((vmax, vmin, vmin))
+        s_channel = cv2.cvtColor(colors, cv2.COLOR_RGB2HLS)[:, :, 2]
+        self.table = ((s_channel >= s_thresh[0]) & (s_channel < s_thresh[1])).astype(np.uint8).ravel()
+        self.thresh = s_thresh
+        return self.table
+
+    def allocate(self, shape):
+        if self.shape == shape:
+            return
+        self.shape = shape
+        self.vmax = np.empty(shape, np.uint8)
+        self.vmin = np.empty(shape, np.uint8)
+        self.index = np.empty(shape, np.uint16)
+
+    def classify(self, img, s_thresh, out=None):
+        '''
+        Same binary map as thresholding the S channel of the HLS image
+        :param img: original image
+        :param s_thresh: threshold of saturation color channel
+        :param out: optional uint8 array to write the binary map into
+        :return: binary map of the pixels within the threshold
+        '''
+        table = self.build(s_thresh)
+        self.allocate(img.shape[:2])
+        np.maximum(img[:, :, 0], img[:, :, 1], out=self.vmax)
+        np.maximum(self.vmax, img[:, :, 2], out=self.vmax)
+        np.minimum(img[:, :, 0], img[:, :, 1], out=self.vmin)
+        np.minimum(self.vmin, img[:, :, 2], out=self.vmin)
+        np.left_shift(self.vmax, 8, out=self.index, dtype=np.uint16)
+        np.bitwise_or(self.index, self.vmin, out=self.index)
+
+        if out is None:
+            out = np.empty(self.shape, np.uint8)
+        return np.take(table, self.index, out=out, mode='clip')
+
+
+# lookup table reused across the frames of a video
+color_classifier = SaturationClassifier()
 
-def combined_color_threshold(img, s_thresh, combined):
+
+def combined_color_threshold(img, s_thresh, combined, classifier=None, out=None):
     '''
     Combine gradient thresh and color thresh
     :param img: original image
     :param s_thresh: threshold of saturation color channel
     :param combined: the combined gradient image
+    :param classifier: SaturationClassifier holding the lookup table, the shared one by default
+    :param out: optional uint8 array to write the combined image into
     :return: color map and combined image
     '''
 
-    # convert to HLS color space
-    hls = cv2.cvtColor(img, cv2.COLOR_RGB2HLS)
-
-    # separate the color channel
-    s_channel = hls[:, :, 2]
-
-    # threshold color channel
-    s_binary = np.zeros_like(s_channel)
-    s_binary[(s_channel >= s_thresh[0]) & (s_channel < s_thresh[1])] = 1
-
-
-    # combine the two binary thresholds
-    combined_binary = np.zeros_like(combined)
-    combined_binary[(s_binary == 1) | combined == 1] = 1
+    if classifier is None:
+        classifier = color_classifier
+    # threshold color channel straight into the output, then add the gradient pixels
+    combined_binary = classifier.classify(img, s_thresh, out=out)
+    np.bitwise_or(combined_binary, combined, out=combined_binary)
 
     return combined_binary
 
@@ -152,23 +418,9 @@ def region_of_interest(img, vertices):
     Only keeps the region of the image defined by the polygon
     formed from `vertices`. The rest of the image is set to black.
     `vertices` should be a numpy array of integer points.
+    The mask is rasterized once per image shape, type and polygon.
     """
-    # defining a blank mask to start with
-    mask = np.zeros_like(img)
-
-    # defining a 3 channel or 1 channel color to fill the mask with depending on the input image
-    if len(img.shape) > 2:
-        channel_count = img.shape[2]
-        ignore_mask_color = (255,) * channel_count
-    else:
-        ignore_mask_color = 255
-
-    # filling pixels inside the polygon defined by "vertices" with the fill color
-    cv2.fillPoly(mask, vertices, ignore_mask_color)
-
-    # returning the image only where mask pixels are nonzero
-    masked_image = cv2.bitwise_and(img, mask)
-    return masked_image
+    return region_masks.apply(img, vertices)
 
 def color_transform(img, s_thresh, sx_thresh, sobel_kernel):
     '''
@@ -179,17 +431,10 @@ def color_transform(img, s_thresh, sx_thresh, sobel_kernel):
     :param sobel_kernel: kernel size
     :return: color map and combined image
     '''
-    image = np.copy(img)
-    # convert to HLS color space
-    hls = cv2.cvtColor(image, cv2.COLOR_RGB2HLS)
-    # separate the color channel
-    s_channel = hls[:, :, 2]
-
-    sxbinary = mag_thresh(image, sobel_kernel, sx_thresh)
+    sxbinary = mag_thresh(img, sobel_kernel, sx_thresh)
 
     # threshold color channel
-    s_binary = np.zeros_like(s_channel)
-    s_binary[(s_channel >= s_thresh[0]) & (s_channel < s_thresh[1])] = 1
+    s_binary = color_classifier.classify(img, s_thresh)
 
     # stack each channel
     color_binary = np.dstack((np.zeros_like(sxbinary), sxbinary, s_binary))*255
@@ -2,47 +2,118 @@ import cv2
 import numpy as np
 import matplotlib.image as mpimg
 import matplotlib.pyplot as plt
+import hashlib
+import multiprocessing
 import os
 
-def camera_calibration(images, nx, ny):
+def calibration_hash(images, nx, ny):
+    '''
+    :param images: images list
+    :param nx: points per row of a image
+    :param ny: points per column of a image
+    :return: hash of the board size and the name and content of every calibration image
+    '''
+    sha = hashlib.sha1('{}x{}'.format(nx, ny).encode())
+    for fname in sorted(images):
+        sha.update(os.path.basename(fname).encode())
+        with open(fname, 'rb') as f:
+            sha.update(hashlib.sha1(f.read()).digest())
+    return sha.hexdigest()
+
+def find_corners(args):
+    '''
+    :param args: (image path, nx, ny)
+    :return: whether the corners were found, the corners and the shape of the image
+    '''
+    fname, nx, ny = args
+    # read image
+    image = mpimg.imread(fname)
+    # apply grayscale transform
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    # find the chessboard corners
+    ret, corners = cv2.findChessboardCorners(gray, (nx, ny), None)
+    return ret, corners, image.shape
+
+def save_corner_images(images, found, corners, nx, ny, output_dir):
+    '''
+    Draw the detected corners on the calibration images and save the plots
+    '''
+    for fname, ret, image_corners in zip(images, found, corners):
+        if ret:
+            image = cv2.drawChessboardCorners(np.copy(mpimg.imread(fname)), (nx, ny), image_corners, ret)
+            # save the image
+            path = os.path.join(output_dir, 'corner' + os.path.split(fname)[1])
+            plt.imshow(image)
+            plt.savefig(path)
+
+def load_calibration(cache_file, key):
+    '''
+    :param cache_file: npz file written by save_calibration
+    :param key: hash of the calibration images
+    :return: the cached calibration, None if missing or computed from other images
+    '''
+    if cache_file is None or not os.path.exists(cache_file):
+        return None
+    with np.load(cache_file) as data:
+        if str(data['key']) != key:
+            return None
+        return (float(data['ret']), data['mtx'], data['dist'], tuple(data['rvecs']), tuple(data['tvecs']),
+                list(data['imgpoints']))
+
+def save_calibration(cache_file, key, ret, mtx, dist, rvecs, tvecs, imgpoints):
+    '''
+    Store the calibration and the detected corners in a npz file
+    '''
+    directory = os.path.dirname(cache_file)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # write to a temporary file first so an interrupted job never leaves a broken cache
+    tmp_file = cache_file + '.tmp.npz'
+    np.savez(tmp_file, key=key, ret=ret, mtx=mtx, dist=dist, rvecs=np.array(rvecs), tvecs=np.array(tvecs),
+             imgpoints=np.array(imgpoints))
+    os.replace(tmp_file, cache_file)
+
+def camera_calibration(images, nx, ny, cache_file=None, output_dir=None, processes=None):
     '''
 
     :param images: images list
     :param nx: points per row of a image
     :param ny: points per column of a image
+    :param cache_file: if set, npz file to reload the calibration from when the images did not change
+    :param output_dir: if set, save the images with the detected corners into this directory
+    :param processes: number of processes to find the corners, all the cores by default
     :return: the parameters of a calibration image
     '''
 
-    # the 3D coordinates of the real undistorted chessboard corners
-    objpoints = []
+    key = calibration_hash(images, nx, ny)
+    cached = load_calibration(cache_file, key)
+    if cached is not None:
+        return cached[:5]
+
+    # find the corners of all the images in parallel
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.map(find_corners, [(fname, nx, ny) for fname in images])
+    found = [ret for ret, _, _ in results]
+    corners = [image_corners for _, image_corners, _ in results]
+
     # the coordinates of the corners in 2D image
-    imgpoints = []
+    imgpoints = [image_corners for ret, image_corners in zip(found, corners) if ret]
     # prepare object points
     objp = np.zeros((nx * ny, 3), np.float32)
     # x, y coordinate
     objp[:, :2] = np.mgrid[0:nx, 0:ny].T.reshape(-1, 2)
+    # the 3D coordinates of the real undistorted chessboard corners
+    objpoints = [objp] * len(imgpoints)
+
+    if output_dir is not None:
+        save_corner_images(images, found, corners, nx, ny, output_dir)
 
-    for fname in images:
-        # read image
-        image = mpimg.imread(fname)
-        # split the name of image
-        head_tail = os.path.split(fname)
-        # apply grayscale transform
-        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
-        # find the chessboard corners
-        ret, corners = cv2.findChessboardCorners(gray, (nx, ny), None)
-
-        if ret == True:
-            imgpoints.append(corners)
-            objpoints.append(objp)
-            # draw corners
-            image = cv2.drawChessboardCorners(image, (9, 6), corners, ret)
-            # save the image
-            path = os.path.join('output_images/', 'corner'+head_tail[1])
-            plt.imshow(image)
-            plt.savefig(path)
     # calibrate the camera
-    ret, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(objpoints, imgpoints, image.shape[1:], None, None)
+    shape = results[-1][2]
+    ret, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(objpoints, imgpoints, shape[1:], None, None)
+
+    if cache_file is not None:
+        save_calibration(cache_file, key, ret, mtx, dist, rvecs, tvecs, imgpoints)
 
     return ret, mtx, dist, rvecs, tvecs
 
@@ -57,6 +128,70 @@ def undistorted_images(image, mtx, dist):
     undist = cv2.undistort(image, mtx, dist, None, mtx)
     return undist
 
+class CameraModel():
+    '''
+    Undistort frames with remap tables that are built once per image size
+    '''
+    def __init__(self, mtx, dist):
+        # camera matrix
+        self.mtx = mtx
+        # distortion coefficient
+        self.dist = dist
+        # undistortion maps keyed by the (width, height) of the image and of the undistorted image
+        self.maps = {}
+
+    def undistort_maps(self, img_size, new_size=None):
+        '''
+        :param img_size: (width, height) of the image
+        :param new_size: (width, height) of the undistorted image, the size of the image by default
+        :return: the maps used by cv2.remap to undistort an image of this size
+        '''
+        key = (img_size, new_size or img_size)
+        if key not in self.maps:
+            # the camera matrix of the resized image, pixel centers are aligned as by cv2.resize
+            sx, sy = key[1][0] / float(img_size[0]), key[1][1] / float(img_size[1])
+            new_mtx = np.array([[sx, 0, 0.5 * sx - 0.5], [0, sy, 0.5 * sy - 0.5], [0, 0, 1]]).dot(self.mtx)
+            self.maps[key] = cv2.initUndistortRectifyMap(self.mtx, self.dist, None, new_mtx, key[1], cv2.CV_16SC2)
+        return self.maps[key]
+
+    def undistort(self, image, new_size=None):
+        '''
+        Same result as undistorted_images, without recomputing the maps on every frame
+        :param new_size: (width, height) to resize the undistorted image to in the same pass, if set
+        '''
+        map1, map2 = self.undistort_maps((image.shape[1], image.shape[0]), new_size)
+        return cv2.remap(image, map1, map2, cv2.INTER_LINEAR)
+
+    def distort_points(self, points):
+        '''
+        :param points: array (..., 2) of pixel coordinates in the undistorted image
+        :return: the coordinates of the same points in the original (distorted) image
+        '''
+        shape = points.shape
+        points = points.reshape(-1, 2).astype(np.float64)
+        # back to normalized camera coordinates, then project them through the distortion model
+        normalized = np.ones((points.shape[0], 3))
+        normalized[:, 0] = (points[:, 0] - self.mtx[0, 2]) / self.mtx[0, 0]
+        normalized[:, 1] = (points[:, 1] - self.mtx[1, 2]) / self.mtx[1, 1]
+        distorted, _ = cv2.projectPoints(normalized, np.zeros(3), np.zeros(3), self.mtx, self.dist)
+        return distorted.reshape(shape).astype(np.float32)
+
+
+# camera models reused across frames, keyed by the calibration parameters
+camera_models = {}
+
+
+def get_camera_model(mtx, dist):
+    '''
+    :param mtx: camera matrix
+    :param dist: distortion coefficient
+    :return: the CameraModel of these calibration parameters, built on first use
+    '''
+    key = (np.asarray(mtx).tobytes(), np.asarray(dist).tobytes())
+    if key not in camera_models:
+        camera_models[key] = CameraModel(mtx, dist)
+    return camera_models[key]
+
 def warped_image(image, undist, nx, ny):
     '''
     Apply perspective transform on the image
@@ -1,4 +1,5 @@
 from lane_pixels_utils import find_lane_pixels
+from fit_utils import scale_fit
 import numpy as np
 
 def offset_to_center(binary_warped,left_lane_line, right_lane_line):
@@ -35,13 +36,14 @@ def measure_curvature_pixels(left_lane_line, right_lane_line, ploty):
     # we'll choose the maximum y-value, corresponding to the bottom of the image
     y_eval = np.max(ploty)
 
-    left_fit = np.polyfit(left_lane_line.ally * ym_per_pix, left_lane_line.allx * xm_per_pix , 2)
-    right_fit = np.polyfit(right_lane_line.ally * ym_per_pix, right_lane_line.allx * xm_per_pix, 2)
+    for lane_line in (left_lane_line, right_lane_line):
+        # current_fit is the fit of a previous frame when no pixels were found, the radius is not updated
+        if lane_line.allx is None or len(lane_line.allx) == 0 or lane_line.current_fit is None:
+            continue
+        # the fit of the pixels in meters is a rescaling of the fit in pixels
+        fit = scale_fit(lane_line.current_fit, xm_per_pix, ym_per_pix)
 
-    # implement the calculation of R_curve (radius of curvature)
-    left_curverad = np.sqrt((1 + (2 * left_fit[0] * y_eval * ym_per_pix + left_fit[1]) ** 2) ** 3) / np.absolute(2 * left_fit[0])
-    right_curverad = np.sqrt((1 + (2 * right_fit[0] * y_eval * ym_per_pix + right_fit[1]) ** 2) ** 3) / np.absolute(2 * right_fit[0])
-
-    left_lane_line.update_radius(left_curverad)
-    right_lane_line.update_radius(right_curverad)
+        # implement the calculation of R_curve (radius of curvature)
+        curverad = np.sqrt((1 + (2 * fit[0] * y_eval * ym_per_pix + fit[1]) ** 2) ** 3) / np.absolute(2 * fit[0])
+        lane_line.update_radius(curverad)
     return left_lane_line, right_lane_line
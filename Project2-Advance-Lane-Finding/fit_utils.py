@@ -0,0 +1,80 @@
+import numpy as np
+
+
+class QuadraticMoments():
+    '''
+    Sufficient statistics of the least squares fit x = a * y ** 2 + b * y + c.
+
+    The normal equations only need the sums of y ** k (k = 0..4) and x * y ** k (k = 0..2), so a fit
+    costs one pass over the pixels and the statistics of several frames can be combined.
+    y is normalized to u = (y - center) / scale in [-1, 1] so the normal equations stay well conditioned.
+    '''
+    def __init__(self, height):
+        # normalization of the y values over the image height
+        self.center = (height - 1) / 2.
+        self.scale = max((height - 1) / 2., 1.)
+        # sums of u ** (i + j) for the basis (u ** 2, u, 1)
+        self.gram = np.zeros((3, 3))
+        # sums of x * u ** k for the basis (u ** 2, u, 1)
+        self.rhs = np.zeros(3)
+
+    def add(self, x, y, decay=1.):
+        '''
+        :param x: x values of the pixels
+        :param y: y values of the pixels
+        :param decay: weight of the statistics accumulated so far, 0 forgets them
+        :return: self
+        '''
+        u = (np.asarray(y, np.float64) - self.center) / self.scale
+        basis = np.vstack((u * u, u, np.ones_like(u)))
+        self.gram *= decay
+        self.rhs *= decay
+        self.gram += np.dot(basis, basis.T)
+        self.rhs += np.dot(basis, np.asarray(x, np.float64))
+        return self
+
+    def merge(self, other, decay=1.):
+        '''
+        Exponentially weighted update: the statistics accumulated so far weigh decay, the new ones 1
+        :param other: QuadraticMoments of the new frame, with the same height
+        :param decay: weight of the statistics accumulated so far
+        :return: self
+        '''
+        self.gram = decay * self.gram + other.gram
+        self.rhs = decay * self.rhs + other.rhs
+        return self
+
+    def solve(self):
+        '''
+        :return: the coefficients [a, b, c] of x = a * y ** 2 + b * y + c in pixels
+        '''
+        # lstsq instead of solve, as np.polyfit, in case of less than 3 distinct y values
+        a, b, c = np.linalg.lstsq(self.gram, self.rhs, rcond=None)[0]
+        # back from u = (y - center) / scale to y
+        a_y = a / self.scale ** 2
+        b_y = b / self.scale - 2 * a_y * self.center
+        c_y = a_y * self.center ** 2 - b / self.scale * self.center + c
+        return np.array([a_y, b_y, c_y])
+
+
+def fit_moments(x, y, height):
+    '''
+    Same fit as np.polyfit(y, x, 2), through the normal equations
+    :param x: x values of the pixels
+    :param y: y values of the pixels
+    :param height: height of the image
+    :return: the coefficients of the fit and its QuadraticMoments
+    '''
+    moments = QuadraticMoments(height).add(x, y)
+    return moments.solve(), moments
+
+
+def scale_fit(fit, xm_per_pix, ym_per_pix):
+    '''
+    Rescale a fit in pixels to meters, same as fitting the pixels scaled to meters
+    :param fit: coefficients [a, b, c] in pixels
+    :param xm_per_pix: meters per pixel in x dimension
+    :param ym_per_pix: meters per pixel in y dimension
+    :return: the coefficients in meters
+    '''
+    return np.array([fit[0] * xm_per_pix / ym_per_pix ** 2, fit[1] * xm_per_pix / ym_per_pix, fit[2] * xm_per_pix])
@@ -1,5 +1,6 @@
 import numpy as np
 import cv2
+from fit_utils import fit_moments
 
 def hist(img):
     '''
@@ -33,18 +34,24 @@ def find_lane_pixels_blind(binary_warped, left_lane_line, right_lane_line, nwind
     out_img = np.dstack((binary_warped, binary_warped, binary_warped))
     # find the peak of the left and right halves of the histogram
     # these will be the starting point for the left and right lines
-    midpoint = np.int(histogram.shape[0] // 2)
+    midpoint = int(histogram.shape[0] // 2)
     leftx_base = np.argmax(histogram[:midpoint])
     rightx_base = np.argmax(histogram[midpoint:]) + midpoint
 
     # set height of windows - based on nwindows above and image shape
-    window_height = np.int(binary_warped.shape[0] // nwindows)
+    window_height = int(binary_warped.shape[0] // nwindows)
     # identify the x and y positions of all nonzero pixels in this image
     # return the indices of the elements that are non-zero
     nonzero = binary_warped.nonzero()
     nonzeroy = np.array(nonzero[0])
     nonzerox = np.array(nonzero[1])
 
+    # nonzero() returns the pixels row by row, so nonzeroy is sorted and the pixels of each window row
+    # are the contiguous slice [window_starts[window], window_ends[window]) of nonzerox and nonzeroy
+    windows = np.arange(nwindows)
+    window_starts = np.searchsorted(nonzeroy, binary_warped.shape[0] - (windows + 1) * window_height, side='left')
+    window_ends = np.searchsorted(nonzeroy, binary_warped.shape[0] - windows * window_height, side='right')
+
     # current positions to be updated later for each window in nwindows
     leftx_current = leftx_base
     rightx_current = rightx_base
@@ -68,14 +75,12 @@ def find_lane_pixels_blind(binary_warped, left_lane_line, right_lane_line, nwind
             cv2.rectangle(out_img, (win_leftx_low, win_y_low), (win_leftx_high, win_y_high), (0, 255, 0), 2)
             cv2.rectangle(out_img, (win_rightx_low, win_y_low), (win_rightx_high, win_y_high), (0, 255, 0), 2)
 
-        # ((...)) return 0 or 1 of vector nonzerox and nonzeroy, elements outside the window are 0
-        # use .nonzero() because we are interested in the value 1 (elements inside the window)
+        # only the pixels of the window row are tested against the x boundaries of the windows
         # final result is the index of pixels inside the window
-        good_left_inds = ((nonzeroy >= win_y_low) & (nonzeroy <= win_y_high) &
-                          (nonzerox >= win_leftx_low) & (nonzerox <= win_leftx_high)).nonzero()[0]
-
-        good_right_inds = ((nonzeroy >= win_y_low) & (nonzeroy <= win_y_high) &
-                           (nonzerox >= win_rightx_low) & (nonzerox <= win_rightx_high)).nonzero()[0]
+        start, end = window_starts[window], window_ends[window]
+        row_x = nonzerox[start:end]
+        good_left_inds = ((row_x >= win_leftx_low) & (row_x <= win_leftx_high)).nonzero()[0] + start
+        good_right_inds = ((row_x >= win_rightx_low) & (row_x <= win_rightx_high)).nonzero()[0] + start
 
         # append these indices to the lists
         left_lane_inds.append(good_left_inds)
@@ -85,9 +90,9 @@ def find_lane_pixels_blind(binary_warped, left_lane_line, right_lane_line, nwind
         if len(good_left_inds) > minpix:
             # nonzerox[good_left_inds] return the x coordinate of the nonzero pixels within the window
             # leftx_current returns the mean value of all x coordinates of those pixels
-            leftx_current = np.int(np.mean(nonzerox[good_left_inds]))
+            leftx_current = int(np.mean(nonzerox[good_left_inds]))
         if len(good_right_inds) > minpix:
-            rightx_current = np.int(np.mean(nonzerox[good_right_inds]))
+            rightx_current = int(np.mean(nonzerox[good_right_inds]))
 
     # concatenate the arrays of indices (previously was a list of lists of pixels)
 
@@ -103,16 +108,63 @@ def find_lane_pixels_blind(binary_warped, left_lane_line, right_lane_line, nwind
     return left_lane_line, right_lane_line, out_img
 
 
-def find_lane_pixels(binary_warped, left_lane_line, right_lane_line, margin):
+def band_columns(fit, margin, height, width):
+    '''
+    :param fit: polynomial coefficients of the lane line
+    :param margin: the width of the lane line +/- margin
+    :param height: height of the image
+    :param width: width of the image
+    :return: the columns of the band row by row, and the mask of those within the band of their row
+    '''
+    # evaluate the polynomial once per row, with the same expression as for each pixel
+    rows = np.arange(height)
+    fitx = fit[0] * (rows ** 2) + fit[1] * rows + fit[2]
+    # integer columns of each row satisfying fitx - margin <= x <= fitx + margin
+    low = np.ceil(fitx - margin)
+    high = np.floor(fitx + margin)
+    low = np.clip(low, 0, width).astype(np.intp)
+    high = np.clip(high, -1, width - 1).astype(np.intp)
+    band_width = max(int(np.max(high - low)) + 1, 0)
+
+    # columns of the band, row by row, masked where they are outside the band of the row
+    cols = low[:, None] + np.arange(band_width)
+    inside = cols <= high[:, None]
+    np.minimum(cols, width - 1, out=cols)
+    return cols, inside
+
+
+def band_pixels(binary_warped, fit, margin):
+    '''
+    Collect the nonzero pixels within +/- margin of a polynomial, only looking at the band around it
+    :param binary_warped: warped binary image
+    :param fit: polynomial coefficients of the lane line
+    :param margin: the width of the lane line +/- margin
+    :return: the x and y values of the nonzero pixels within the band
+    '''
+    height, width = binary_warped.shape[:2]
+    cols, inside = band_columns(fit, margin, height, width)
+    inside &= binary_warped[np.arange(height)[:, None], cols] != 0
+    # nonzero() keeps the row-major order of binary_warped.nonzero()
+    iy, ix = inside.nonzero()
+    return cols[iy, ix], iy
+
+
+def find_lane_pixels(binary_warped, left_lane_line, right_lane_line, margin, band=False):
     '''
     :param binary_warped: warped binary image
     :param left_lane_line: the instance of left lane line
     :param right_lane_line: the right of left lane line
     :param margin: the width of the lane line +/- margin
+    :param band: if True, only look at the pixels in the band around each line, the result is the same
     :return:
     '''
     out_img = np.dstack((binary_warped, binary_warped, binary_warped))
 
+    if band:
+        left_lane_line.allx, left_lane_line.ally = band_pixels(binary_warped, left_lane_line.best_fit, margin)
+        right_lane_line.allx, right_lane_line.ally = band_pixels(binary_warped, right_lane_line.best_fit, margin)
+        return left_lane_line, right_lane_line, out_img
+
     nonzero = binary_warped.nonzero()
     nonzeroy = np.array(nonzero[0])
     nonzerox = np.array(nonzero[1])
@@ -159,11 +211,29 @@ def sanity_check(left_fitx, right_fitx, thresh):
     return status
 
 
-def fit_polynomial(left_lane_line, right_lane_line, img, thresh=50, sanity=False):
+def fit_line(lane_line, height, detected, decay=None):
+    '''
+    Least squares fit of the detected pixels of a lane line
+    :param lane_line: the instance of a lane line with the information of x and y values
+    :param height: height of the image
+    :param detected: whether the lane lines were detected
+    :param decay: if set, smooth the fit with exponentially weighted statistics instead of recent_fit
+    :return: the coefficients of the fit
+    '''
+    fit, moments = fit_moments(lane_line.allx, lane_line.ally, height)
+    lane_line.current_fit = fit
+    lane_line.update_coefficients(fit, detected)
+    if decay is not None:
+        lane_line.update_moments(moments, decay)
+    return fit
+
+
+def fit_polynomial(left_lane_line, right_lane_line, img, thresh=50, sanity=False, decay=None):
     '''
     :param left_lane_line: the instance of left lane line with the information of x ang y values
     :param right_lane_line: the right of left lane line with the information of x and y values
     :param img: image
+    :param decay: if set, weight of the previous frames in the exponentially weighted smoothing of the fits
     :return: the x values for all y
     '''
     # x = a*y**2 + by + c
@@ -175,14 +245,12 @@ def fit_polynomial(left_lane_line, right_lane_line, img, thresh=50, sanity=False
         left_fit = left_lane_line.best_fit
         detected = False
     else:
-        left_fit = np.polyfit(left_lane_line.ally, left_lane_line.allx, 2)
-        left_lane_line.update_coefficients(left_fit, detected)
+        left_fit = fit_line(left_lane_line, img.shape[0], detected, decay)
     if not list(right_lane_line.allx) or not list(right_lane_line.ally):
         right_fit = right_lane_line.best_fit
         detected = False
     else:
-        right_fit = np.polyfit(right_lane_line.ally, right_lane_line.allx, 2)
-        right_lane_line.update_coefficients(right_fit, detected)
+        right_fit = fit_line(right_lane_line, img.shape[0], detected, decay)
 
     # generate all values of y coordinate
     ploty = np.linspace(0, img.shape[0] - 1, img.shape[0])
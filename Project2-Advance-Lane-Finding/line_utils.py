@@ -1,21 +1,40 @@
 import numpy as np
-import collections
+import copy
+
+from fit_utils import QuadraticMoments
 
 
 class Line():
-    def __init__(self):
+    '''
+    State of a lane line over the frames of a video.
+
+    The fits of the last len frames are kept in a preallocated ring buffer with their running sum, so
+    best_fit is updated in place in O(1) without allocating. The sum is recomputed from the buffer every
+    time it wraps around, so the rounding errors do not build up over a long video. best_fit is
+    overwritten by the next update, copy it to keep the fit of a frame. bestx is the x values of the
+    last fit, the array given to update_x.
+    '''
+    __slots__ = ('len', 'detected', 'fits', 'fit_sum', 'nfits', 'mean_fit', 'best_fit', 'bestx',
+                 'current_fit', 'moments', 'radius_of_curvature', 'allx', 'ally')
+
+    def __init__(self, n=10):
         # number of the frames to be considered
-        self.len = 10
+        self.len = n
         # was the line detected in the last iteration?
         self.detected = False
-        # x values of the last n fits of the line
-        self.recent_xfitted = collections.deque(maxlen=self.len)
-        # average x values of the fitted line over the last n iterations
-        self.bestx = None
-        # polynomial coefficients of the last n iterarions
-        self.recent_fit = collections.deque(maxlen=self.len)
-        # polynomial coefficients averaged over the last n iterations
+        # polynomial coefficients of the last n iterations, their sum and the number of fits so far
+        self.fits = np.zeros((n, 3))
+        self.fit_sum = np.zeros(3)
+        self.nfits = 0
+        # polynomial coefficients averaged over the last n iterations, and the buffer they are divided into
         self.best_fit = None
+        self.mean_fit = np.zeros(3)
+        # x values of the last fit of the line
+        self.bestx = None
+        # polynomial coefficients for the most recent fit
+        self.current_fit = None
+        # exponentially weighted least squares statistics, used instead of recent_fit when smoothing with a decay
+        self.moments = None
         # radius of curvature of the line in some units
         self.radius_of_curvature = None
         # x values for detected line pixels
@@ -23,26 +42,47 @@ class Line():
         # y values for detected line pixels
         self.ally = None
 
-    def update_x(self, x):
-        self.recent_xfitted = []
-        if len(self.recent_xfitted) > 0:
-            if np.absolute(self.bestx - x).all() < 50:
-                self.recent_xfitted.append(x)
-                self.bestx = np.mean(np.array(self.recent_xfitted), 0)
+    def push(self, buffer, total, count, value):
+        '''
+        Write value in the ring buffer and update the running sum of its entries
+        :return: the number of values pushed so far
+        '''
+        slot = count % self.len
+        if count >= self.len:
+            total -= buffer[slot]
+        buffer[slot] = value
+        total += value
+        count += 1
+        if count % self.len == 0:
+            # exact sum once per turn of the buffer
+            np.sum(buffer, axis=0, out=total)
+        return count
 
-        else:
-            self.recent_xfitted.append(x)
-            self.bestx = x
+    @property
+    def recent_fit(self):
+        '''
+        :return: the polynomial coefficients of the last n iterations, oldest first
+        '''
+        return ring_entries(self.fits, self.nfits)
+
+    def update_x(self, x):
+        # the drawn line is the last fit, not an average
+        self.bestx = x
 
     def update_coefficients(self, fit, detected):
-        self.recent_xfitted = []
         self.detected = detected
-        if len(self.recent_fit) > 0:
-            self.recent_fit.append(fit)
-            self.best_fit = np.mean(np.array(self.recent_fit), 0)
+        self.nfits = self.push(self.fits, self.fit_sum, self.nfits, fit)
+        self.best_fit = np.divide(self.fit_sum, min(self.nfits, self.len), out=self.mean_fit)
+
+    def update_moments(self, moments, decay):
+        '''
+        Smooth the fit with the least squares statistics of all frames, older frames weigh decay ** age
+        '''
+        if self.moments is None:
+            self.moments = copy.deepcopy(moments)
         else:
-            self.recent_fit.append(fit)
-            self.best_fit = fit
+            self.moments.merge(moments, decay)
+        self.best_fit = self.moments.solve()
 
     def update_radius(self, radius):
         if self.radius_of_curvature == None:
@@ -50,4 +90,78 @@ class Line():
         elif np.absolute(self.radius_of_curvature - radius).all() < 100:
             self.radius_of_curvature = (self.radius_of_curvature + radius) / 2
         else:
-            return " Sanity check failed: The radius of curvature is not similar. "
\ No newline at end of file
+            return " Sanity check failed: The radius of curvature is not similar. "
+
+    def snapshot(self):
+        '''
+        :return: the tracking state as a dict of arrays, which np.savez can store between video chunks
+        '''
+        optional = lambda value: np.empty(0) if value is None else np.array(value, np.float64)
+        state = {'len': self.len, 'detected': self.detected, 'fits': self.fits.copy(), 'nfits': self.nfits,
+                 'bestx': optional(self.bestx), 'best_fit': optional(self.best_fit),
+                 'current_fit': optional(self.current_fit), 'radius_of_curvature': optional(self.radius_of_curvature)}
+        if self.moments is not None:
+            state['moments'] = np.vstack((self.moments.gram, self.moments.rhs))
+            state['moments_height'] = 2 * self.moments.center + 1
+        return state
+
+    def restore(self, state):
+        '''
+        :param state: dict, or loaded npz file, returned by snapshot()
+        :return: self, in the state of the snapshot
+        '''
+        optional = lambda value: None if value.size == 0 else np.array(value)
+        self.__init__(int(state['len']))
+        self.detected = bool(state['detected'])
+        self.fits[:] = state['fits']
+        self.nfits = int(state['nfits'])
+        if self.nfits > 0:
+            np.sum(self.recent_fit, axis=0, out=self.fit_sum)
+            self.best_fit = np.divide(self.fit_sum, min(self.nfits, self.len), out=self.mean_fit)
+        self.bestx = optional(state['bestx'])
+        # best_fit may come from the moments rather than from the ring buffer
+        best_fit = optional(state['best_fit'])
+        if best_fit is not None:
+            self.best_fit = best_fit
+        self.current_fit = optional(state['current_fit'])
+        radius = optional(state['radius_of_curvature'])
+        self.radius_of_curvature = None if radius is None else float(radius)
+        if 'moments' in state:
+            self.moments = QuadraticMoments(int(state['moments_height']))
+            self.moments.gram = np.array(state['moments'][:3])
+            self.moments.rhs = np.array(state['moments'][3])
+        return self
+
+
+def ring_entries(buffer, count):
+    '''
+    :param buffer: ring buffer
+    :param count: number of values pushed into the buffer so far
+    :return: the entries of the buffer, oldest first
+    '''
+    size = len(buffer)
+    if count <= size:
+        return buffer[:count]
+    return np.roll(buffer, -(count % size), axis=0)
+
+
+def save_lines(path, left_lane_line, right_lane_line):
+    '''
+    Save the state of both lane lines, e.g. at the end of a video chunk
+    '''
+    state = {}
+    for name, lane_line in (('left', left_lane_line), ('right', right_lane_line)):
+        state.update({name + '_' + key: value for key, value in lane_line.snapshot().items()})
+    np.savez(path, **state)
+
+
+def load_lines(path):
+    '''
+    :return: the left and right lane lines saved by save_lines
+    '''
+    with np.load(path) as data:
+        lines = []
+        for name in ('left', 'right'):
+            prefix = name + '_'
+            lines.append(Line().restore({key[len(prefix):]: data[key] for key in data.files if key.startswith(prefix)}))
+    return lines
@@ -0,0 +1,277 @@
+import json
+
+import cv2
+import numpy as np
+
+from binary_utils import GradientEngine, SaturationClassifier
+from calibration_utils import CameraModel
+from curvature_utils import measure_curvature_pixels, offset_to_center
+from lane_pixels_utils import band_pixels, find_lane_pixels_blind, fit_polynomial
+from line_utils import ring_entries
+from overlay_utils import OverlayRenderer
+from perspective_transform_utils import BirdsEyeTransform
+from roi_utils import RegionMask
+from pipeline import draw_text, lane_region
+
+# number of the fits averaged by a lane line, as the default of Line
+RECENT_FITS = 10
+
+# state of a lane line as a fixed-size record, instead of the deques of Line
+LINE_STATE = np.dtype([
+    # was the line detected in the last iteration?
+    ('detected', '?'),
+    # number of fits since the start of the stream, the last RECENT_FITS are in recent_fit
+    ('nfits', 'i8'),
+    # ring buffer of the polynomial coefficients of the last fits
+    ('recent_fit', 'f8', (RECENT_FITS, 3)),
+    # polynomial coefficients averaged over the last fits
+    ('best_fit', 'f8', 3),
+    # polynomial coefficients of the most recent fit
+    ('current_fit', 'f8', 3),
+    # whether bestx is set, and the coefficients bestx is evaluated from
+    ('has_x', '?'),
+    ('xfit', 'f8', 3),
+    # radius of curvature of the line in meters, nan until measured
+    ('radius', 'f8'),
+])
+
+# state of a stream: its left and right lane lines
+STREAM_STATE = np.dtype([('left', LINE_STATE), ('right', LINE_STATE)])
+
+
+class LineRecord():
+    '''
+    Line interface over a LINE_STATE record, so the lane finding functions update the record in place.
+
+    bestx is only ever set to a fit evaluated at every row by fit_polynomial, so the record keeps that
+    fit, the one of the last update_coefficients() or best_fit when the line had no pixels, and bestx
+    is evaluated from it with the same expression.
+    '''
+    def __init__(self, record, height):
+        # LINE_STATE record, a view on the states of the streams
+        self.record = record
+        # height of the warped image
+        self.height = height
+        # x and y values of the detected pixels of the current frame
+        self.allx = None
+        self.ally = None
+        # fit fit_polynomial evaluates next
+        self.pending_fit = self.best_fit
+
+    @property
+    def detected(self):
+        return bool(self.record['detected'])
+
+    @property
+    def best_fit(self):
+        return self.record['best_fit'] if self.record['nfits'] > 0 else None
+
+    @property
+    def current_fit(self):
+        return self.record['current_fit'] if self.record['nfits'] > 0 else None
+
+    @current_fit.setter
+    def current_fit(self, fit):
+        self.record['current_fit'] = fit
+
+    @property
+    def bestx(self):
+        if not self.record['has_x']:
+            return None
+        fit = self.record['xfit']
+        ploty = np.linspace(0, self.height - 1, self.height)
+        return fit[0] * ploty ** 2 + fit[1] * ploty + fit[2]
+
+    @property
+    def radius_of_curvature(self):
+        radius = self.record['radius']
+        return None if np.isnan(radius) else float(radius)
+
+    def update_x(self, x):
+        # x is the pending fit evaluated at every row, as in Line.update_x only the last one is kept
+        self.record['xfit'] = self.pending_fit
+        self.record['has_x'] = True
+
+    def update_coefficients(self, fit, detected):
+        record = self.record
+        record['detected'] = detected
+        record['recent_fit'][record['nfits'] % RECENT_FITS] = fit
+        record['nfits'] += 1
+        record['best_fit'] = np.mean(ring_entries(record['recent_fit'], record['nfits']), 0)
+        self.pending_fit = fit
+
+    def update_radius(self, radius):
+        if self.radius_of_curvature == None:
+            self.record['radius'] = radius
+        elif np.absolute(self.radius_of_curvature - radius).all() < 100:
+            self.record['radius'] = (self.radius_of_curvature + radius) / 2
+        else:
+            return " Sanity check failed: The radius of curvature is not similar. "
+
+
+class MultiStreamPipeline():
+    '''
+    Lane finding on batches of frames of many streams, e.g. one frame of each camera.
+
+    The stateless stages run over the whole batch with buffers allocated once per batch size. The lane
+    lines of every stream are rows of a STREAM_STATE array, so thousands of streams take a few
+    hundred bytes each and are checkpointed as one array. Every workspace belongs to the instance,
+    nothing is shared with the pipeline module or with other instances.
+    '''
+    def __init__(self, mtx, dist, nwindows=9, margin=100, minpix=50, test=True):
+        # undistortion and birds-eye transform of the frames
+        self.camera = CameraModel(mtx, dist)
+        self.transform = BirdsEyeTransform()
+        # workspaces of the thresholds and of the overlay
+        self.engine = GradientEngine()
+        self.classifier = SaturationClassifier()
+        self.renderer = OverlayRenderer(self.transform)
+        self.regions = RegionMask()
+        # parameters of the lane search
+        self.nwindows = nwindows
+        self.margin = margin
+        self.minpix = minpix
+        # if True, plot the region between two lines
+        self.test = test
+        # row of each stream in states, and stream id of each row
+        self.rows = {}
+        self.ids = []
+        # states of the streams, the first len(ids) rows are used
+        self.states = np.zeros(0, STREAM_STATE)
+        # (batch size, height, width) of the allocated batch buffers
+        self.shape = None
+        self.undist = None
+        self.combined_binary = None
+        self.masked = None
+        self.warped = None
+        self.output = None
+        # region of interest of the frames
+        self.mask = None
+
+    def add_stream(self, stream_id):
+        '''
+        :return: the row of the state of the stream, a new state if the stream is unknown
+        '''
+        if stream_id in self.rows:
+            return self.rows[stream_id]
+        if len(self.ids) == len(self.states):
+            states = np.zeros(max(2 * len(self.states), 16), STREAM_STATE)
+            states[:len(self.states)] = self.states
+            self.states = states
+        row = len(self.ids)
+        self.states[row] = np.zeros((), STREAM_STATE)
+        self.states[row]['left']['radius'] = np.nan
+        self.states[row]['right']['radius'] = np.nan
+        self.rows[stream_id] = row
+        self.ids.append(stream_id)
+        return row
+
+    def remove_stream(self, stream_id):
+        '''
+        Forget a stream, the last row takes its place
+        '''
+        row = self.rows.pop(stream_id)
+        last = len(self.ids) - 1
+        if row != last:
+            self.states[row] = self.states[last]
+            self.ids[row] = self.ids[last]
+            self.rows[self.ids[row]] = row
+        self.ids.pop()
+
+    def state(self, stream_id):
+        '''
+        :return: a copy of the STREAM_STATE record of a stream
+        '''
+        return self.states[self.rows[stream_id]].copy()
+
+    def checkpoint(self, path):
+        '''
+        Save the states of all streams in a .npz file, the stream ids must be str or int
+        '''
+        for stream_id in self.ids:
+            if isinstance(stream_id, bool) or not isinstance(stream_id, (str, int)):
+                raise TypeError('Stream id {!r} cannot be checkpointed, use a str or an int'.format(stream_id))
+        # stored as JSON, which keeps the type of every id
+        np.savez(path, ids=np.array(json.dumps(self.ids)), states=self.states[:len(self.ids)])
+
+    def restore(self, path):
+        '''
+        Load the states saved by checkpoint(), they replace the current ones
+        '''
+        with np.load(path) as data:
+            self.ids = json.loads(str(data['ids']))
+            self.states = data['states'].copy()
+        self.rows = {stream_id: row for row, stream_id in enumerate(self.ids)}
+
+    def allocate(self, shape):
+        if self.shape == shape:
+            return
+        self.shape = shape
+        self.undist = np.empty(shape + (3,), np.uint8)
+        self.combined_binary = np.empty(shape, np.uint8)
+        self.masked = np.empty(shape, np.uint8)
+        self.warped = np.empty(shape, np.uint8)
+        self.output = np.empty(shape + (3,), np.uint8)
+        self.mask = self.regions.mask(shape[1:], np.uint8, lane_region(shape[1:]))
+
+    def preprocess(self, frames):
+        '''
+        Stateless stages of the pipeline over a batch of frames of the same size
+        :param frames: array (n, height, width, 3) or list of RGB frames
+        :return: the undistorted frames, combined binary maps and warped binary maps
+        '''
+        count = len(frames)
+        height, width = frames[0].shape[:2]
+        self.allocate((count, height, width))
+        map1, map2 = self.camera.undistort_maps((width, height))
+        for frame, undist in zip(frames, self.undist):
+            cv2.remap(frame, map1, map2, cv2.INTER_LINEAR, dst=undist)
+        # the color threshold is per pixel, the frames are classified as one image
+        self.classifier.classify(self.undist.reshape(-1, width, 3), (170, 255),
+                                 out=self.combined_binary.reshape(-1, width))
+        # the gradient thresholds are relative to the maximum gradient of each frame
+        for undist, combined_binary in zip(self.undist, self.combined_binary):
+            combined = self.engine.combined(undist, sx_thresh=(20, 100), dir_thresh=(0.7, 1.3), sobel_kernel=9)
+            np.bitwise_or(combined_binary, combined, out=combined_binary)
+        np.bitwise_and(self.combined_binary, self.mask, out=self.masked)
+        matrix = self.transform.matrix((width, height))
+        for masked, warped in zip(self.masked, self.warped):
+            cv2.warpPerspective(masked, matrix, (width, height), dst=warped, flags=cv2.INTER_LINEAR)
+        return self.undist, self.combined_binary, self.warped
+
+    def track(self, row, undist, combined_binary, warped, out):
+        '''
+        Stateful stages of the pipeline for one frame of a stream
+        :param row: row of the state of the stream
+        :param out: array to write the annotated frame into
+        '''
+        height = warped.shape[0]
+        left_lane_line = LineRecord(self.states[row]['left'], height)
+        right_lane_line = LineRecord(self.states[row]['right'], height)
+
+        if not left_lane_line.detected or not right_lane_line.detected:
+            find_lane_pixels_blind(warped, left_lane_line, right_lane_line, self.nwindows, self.margin,
+                                   self.minpix, False)
+        else:
+            for lane_line in (left_lane_line, right_lane_line):
+                lane_line.allx, lane_line.ally = band_pixels(warped, lane_line.best_fit, self.margin)
+        _, _, ploty = fit_polynomial(left_lane_line, right_lane_line, warped, thresh=50, sanity=True)
+        self.renderer.render(undist, left_lane_line, right_lane_line, self.margin, self.test, out=out)
+        measure_curvature_pixels(left_lane_line, right_lane_line, ploty)
+        offset = offset_to_center(combined_binary, left_lane_line, right_lane_line)
+        curvature = np.mean([left_lane_line.radius_of_curvature, right_lane_line.radius_of_curvature])
+        draw_text(out, curvature, offset)
+        return out
+
+    def process(self, stream_ids, frames):
+        '''
+        Same result as pipeline() on every frame with the lane lines of its stream
+        :param stream_ids: stream of each frame, a stream may appear several times in frame order
+        :param frames: array (n, height, width, 3) or list of RGB frames of the same size
+        :return: array (n, height, width, 3) of the annotated frames, overwritten by the next batch
+        '''
+        rows = [self.add_stream(stream_id) for stream_id in stream_ids]
+        undist, combined_binary, warped = self.preprocess(frames)
+        for i, row in enumerate(rows):
+            self.track(row, undist[i], combined_binary[i], warped[i], self.output[i])
+        return self.output
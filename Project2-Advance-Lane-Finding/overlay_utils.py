@@ -0,0 +1,103 @@
+import cv2
+import numpy as np
+
+from perspective_transform_utils import birds_eye
+
+
+class OverlayRenderer():
+    '''
+    Draw the lane on the undistorted image with buffers reused across frames.
+
+    Same result as visualization_outimg, the inverse warp and weighted_img(α=1, β=0.5), but only the
+    columns of the birds-eye view around the lane lines are drawn, and only the region of the camera
+    view they warp back to is blended. Outside of it the weighted image is the undistorted image.
+    '''
+    def __init__(self, transform=birds_eye):
+        # birds-eye transform used to warp the drawing back to the camera view
+        self.transform = transform
+        # shape of the allocated buffers
+        self.shape = None
+        # birds-eye view drawing, kept black outside of the drawn columns
+        self.window_img = None
+        # columns (x0, x1) drawn on the previous frame
+        self.columns = None
+        # polygon of the lane: left line from top to bottom, then right line from bottom to top
+        self.lane_pts = None
+        # polygon of a search window around a line
+        self.window_pts = None
+
+    def allocate(self, shape):
+        if self.shape == shape:
+            return
+        height = shape[0]
+        self.shape = shape
+        self.window_img = np.zeros(shape, np.uint8)
+        self.columns = None
+        ploty = np.arange(height, dtype=np.int32)
+        self.lane_pts = np.empty((2 * height, 2), np.int32)
+        self.lane_pts[:height, 1] = ploty
+        self.lane_pts[height:, 1] = ploty[::-1]
+        self.window_pts = self.lane_pts.copy()
+
+    def fill_points(self, pts, top_to_bottom, bottom_to_top):
+        # same truncation as np.int_ on the float coordinates
+        height = self.shape[0]
+        np.copyto(pts[:height, 0], top_to_bottom, casting='unsafe')
+        np.copyto(pts[height:, 0], bottom_to_top[::-1], casting='unsafe')
+
+    def draw(self, left_lane_line, right_lane_line, margin, test):
+        '''
+        Draw the lane, or the search windows, on the birds-eye view buffer
+        :return: the columns (x0, x1) of the birds-eye view that were drawn
+        '''
+        height, width = self.shape[:2]
+        if self.columns is not None:
+            self.window_img[:, self.columns[0]:self.columns[1]] = 0
+
+        if test:
+            self.fill_points(self.lane_pts, left_lane_line.bestx, right_lane_line.bestx)
+            cv2.fillPoly(self.window_img, [self.lane_pts], (0, 255, 0))
+            cv2.polylines(self.window_img, [self.lane_pts[:height]], isClosed=False, color=(255, 0, 0), thickness=30)
+            cv2.polylines(self.window_img, [self.lane_pts[height:]], isClosed=False, color=(0, 0, 255), thickness=30)
+            # half of the thickness of the lines, and some more for the round caps
+            pad = 32
+        else:
+            for lane_line, color in ((left_lane_line, (255, 0, 0)), (right_lane_line, (0, 0, 255))):
+                self.fill_points(self.window_pts, lane_line.bestx - margin, lane_line.bestx + margin)
+                cv2.fillPoly(self.window_img, [self.window_pts], color)
+            pad = margin + 2
+
+        xs = np.concatenate((left_lane_line.bestx, right_lane_line.bestx))
+        x0 = int(min(max(np.floor(xs.min()) - pad, 0), width))
+        x1 = int(min(max(np.ceil(xs.max()) + pad + 1, x0), width))
+        self.columns = (x0, x1)
+        return self.columns
+
+    def render(self, undist, left_lane_line, right_lane_line, margin, test, out=None):
+        '''
+        :param undist: undistorted image
+        :param left_lane_line: left lane line
+        :param right_lane_line: right lane line
+        :param margin: the width of the windows +/- margin
+        :param test: if True, plot the region between two lines
+        :param out: optional array to write the result into, a new one by default
+        :return: the undistorted image with the lane drawn on it
+        '''
+        self.allocate(undist.shape)
+        height, width = self.shape[:2]
+        x0, x1 = self.draw(left_lane_line, right_lane_line, margin, test)
+
+        if out is None:
+            out = undist.copy()
+        else:
+            np.copyto(out, undist)
+        box = self.transform.unwarped_box((width, height), (x0, 0, x1, height))
+        bx0, by0, bx1, by1 = box
+        if bx1 > bx0 and by1 > by0:
+            warped_inverse = self.transform.unwarp(self.window_img, box)
+            out[by0:by1, bx0:bx1] = cv2.addWeighted(undist[by0:by1, bx0:bx1], 1, warped_inverse, 0.5, 0.)
+        return out
+
+
+# buffers reused across the frames of a video
+overlay_renderer = OverlayRenderer()
@@ -1,17 +1,11 @@
 import cv2
 import numpy as np
 
-def warped_test_images(undist, inverse):
+def perspective_points(img_size):
     '''
-    Apply perspective transform on the image
-    :param undist: undistorted image
-    :param inverse: if True, returen the inverse warped image
-    :return: a warped image
+    :param img_size: (width, height) of the image
+    :return: the source and destination points of the birds-eye transform
     '''
-
-    # length of x and y
-    img_size = (undist.shape[1], undist.shape[0])
-
     # define 4 source points src
     src = np.float32([[200, img_size[1]-10], # bottom left
                      [img_size[0]-200, img_size[1]-10], # bottom right
@@ -22,6 +16,21 @@ def warped_test_images(undist, inverse):
                       [img_size[0]-320, img_size[1]-10], # br
                       [img_size[0]-320, 0], #ur
                       [320, 0]]) # ul
+    return src, dst
+
+
+def warped_test_images(undist, inverse):
+    '''
+    Apply perspective transform on the image
+    :param undist: undistorted image
+    :param inverse: if True, returen the inverse warped image
+    :return: a warped image
+    '''
+
+    # length of x and y
+    img_size = (undist.shape[1], undist.shape[0])
+
+    src, dst = perspective_points(img_size)
     # apply perspective transform to get the transform matrix
 
     if inverse:
@@ -35,6 +44,101 @@ def warped_test_images(undist, inverse):
     return warped
 
 
+class BirdsEyeTransform():
+    '''
+    Birds-eye warp and its inverse, with the perspective matrices computed once per image size.
+
+    The warp and the unwarp of an undistorted image are cv2.warpPerspective with the cached matrices,
+    the same pixels as warped_test_images. With a CameraModel the undistortion is composed with the
+    warp into a remap table built once per image size, so a raw frame is brought to the birds-eye view
+    with a single resampling.
+    '''
+    def __init__(self, points=perspective_points):
+        # function returning the (src, dst) points for an image size
+        self.points = points
+        # remap tables of the composed undistortion and warp, keyed by (image size, inverse, camera)
+        self.maps = {}
+        # perspective matrices keyed by (image size, inverse)
+        self.matrices = {}
+
+    def matrix(self, img_size, inverse=False):
+        '''
+        :return: the matrix mapping the camera view to the birds-eye view, or the opposite if inverse
+        '''
+        key = (img_size, inverse)
+        if key not in self.matrices:
+            src, dst = self.points(img_size)
+            if inverse:
+                self.matrices[key] = cv2.getPerspectiveTransform(dst, src)
+            else:
+                self.matrices[key] = cv2.getPerspectiveTransform(src, dst)
+        return self.matrices[key]
+
+    def build_maps(self, img_size, inverse, camera):
+        # cv2.remap looks up the source pixel of each output pixel, so use the opposite matrix
+        M = self.matrix(img_size, not inverse)
+        grid = np.mgrid[0:img_size[1], 0:img_size[0]].astype(np.float32)
+        grid = np.dstack((grid[1], grid[0]))
+        coords = cv2.perspectiveTransform(grid, M)
+        if camera is not None:
+            coords = camera.distort_points(coords)
+        return cv2.convertMaps(coords, None, cv2.CV_16SC2)
+
+    def remap_tables(self, img_size, inverse=False, camera=None):
+        key = (img_size, inverse, camera)
+        if key not in self.maps:
+            self.maps[key] = self.build_maps(img_size, inverse, camera)
+        return self.maps[key]
+
+    def warp(self, img, camera=None):
+        '''
+        :param img: undistorted image, or the original image if camera is given
+        :param camera: CameraModel to undistort the image within the same lookup
+        :return: the birds-eye view of the image
+        '''
+        img_size = (img.shape[1], img.shape[0])
+        if camera is None:
+            return cv2.warpPerspective(img, self.matrix(img_size), img_size, flags=cv2.INTER_LINEAR)
+        map1, map2 = self.remap_tables(img_size, False, camera)
+        return cv2.remap(img, map1, map2, cv2.INTER_LINEAR)
+
+    def unwarp(self, img, box=None):
+        '''
+        :param img: birds-eye view image
+        :param box: if set, (x0, y0, x1, y1) region of the camera view to compute
+        :return: the image warped back to the camera view, or its region within box
+        '''
+        img_size = (img.shape[1], img.shape[0])
+        # warpPerspective rounds the positions of the pixels by blocks of its output, a smaller or shifted
+        # output gives slightly different pixels, so the whole view is warped and the box cut out of it
+        unwarped = cv2.warpPerspective(img, self.matrix(img_size, inverse=True), img_size, flags=cv2.INTER_LINEAR)
+        if box is not None:
+            x0, y0, x1, y1 = box
+            unwarped = unwarped[y0:y1, x0:x1]
+        return unwarped
+
+    def unwarped_box(self, img_size, box):
+        '''
+        :param img_size: (width, height) of the image
+        :param box: (x0, y0, x1, y1) region of the birds-eye view
+        :return: (x0, y0, x1, y1) region of the camera view that unwarp() may fill from this region
+        '''
+        x0, y0, x1, y1 = box
+        # the bilinear interpolation reads the pixels up to one pixel around the sampled position
+        corners = np.float32([[[x0 - 1, y0 - 1], [x1, y0 - 1], [x1, y1], [x0 - 1, y1]]])
+        corners = cv2.perspectiveTransform(corners, self.matrix(img_size, inverse=True))[0]
+        # one more pixel for the fixed point precision of the sampled positions
+        low = np.floor(corners.min(axis=0)) - 1
+        high = np.ceil(corners.max(axis=0)) + 2
+        x0, y0 = np.maximum(low, 0).astype(int)
+        x1, y1 = np.minimum(high, img_size).astype(int)
+        return x0, y0, max(x1, x0), max(y1, y0)
+
+
+# matrices and remap tables reused across the frames of a video
+birds_eye = BirdsEyeTransform()
+
+
 def weighted_img(img, initial_img, α=0.8, β=.2, γ=0.):
     '''
 
@@ -1,39 +1,117 @@
-from calibration_utils import undistorted_images
+from calibration_utils import get_camera_model
 from binary_utils import combined_gradient_threshold, combined_color_threshold, region_of_interest
-from perspective_transform_utils import warped_test_images, weighted_img
-from lane_pixels_utils import find_lane_pixels_blind, find_lane_pixels, fit_polynomial, visualization_outimg
+from perspective_transform_utils import birds_eye
+from lane_pixels_utils import find_lane_pixels_blind, find_lane_pixels, fit_polynomial
+from overlay_utils import overlay_renderer
 from curvature_utils import measure_curvature_pixels, offset_to_center
+from profiling_utils import profiler
 import numpy as np
 import cv2
 
 
-def pipeline(ini_img, mtx, dist, left_lane_line, right_lane_line, nwindows, margin, minpix, verbose, test):
+def preprocess(ini_img, mtx, dist, profiler=profiler):
+    '''
+    Stateless stages of the pipeline, they can run on any frame independently
+    :param ini_img: original image
+    :param mtx: camera matrix
+    :param dist: distortion coefficient
+    :param profiler: StageProfiler timing the stages
+    :return: undistorted image, combined binary map and warped binary map
+    '''
 
-    undist = undistorted_images(ini_img, mtx, dist)
-    combined = combined_gradient_threshold(undist, sx_thresh=(20, 100), dir_thresh=(0.7, 1.3), sobel_kernel=9)
-    combined_binary = combined_color_threshold(undist, s_thresh=(170, 255), combined=combined)
-    imshape = ini_img.shape
-    vertices = np.array([[(0, imshape[0]), (imshape[1] / 2 - 25, imshape[0] / 2 + 50),
-                          (imshape[1] / 2 + 25, imshape[0] / 2 + 50), (imshape[1], imshape[0])]], dtype=np.int32)
-    masked_image = region_of_interest(combined_binary, vertices)
-    warped_test_image = warped_test_images(masked_image, inverse=False)
+    with profiler.stage('undistort'):
+        undist = get_camera_model(mtx, dist).undistort(ini_img)
+    combined_binary, warped_test_image = binary_warp(undist, profiler)
+
+    return undist, combined_binary, warped_test_image
+
+
+def lane_region(imshape, scale=1.):
+    '''
+    :param imshape: shape of the image
+    :param scale: size of the image relative to the 720p frames the region is designed for
+    :return: vertices of the region of interest in front of the car
+    '''
+    return np.array([[(0, imshape[0]), (imshape[1] / 2 - 25 * scale, imshape[0] / 2 + 50 * scale),
+                      (imshape[1] / 2 + 25 * scale, imshape[0] / 2 + 50 * scale), (imshape[1], imshape[0])]],
+                    dtype=np.int32)
+
+
+def draw_text(weighted_image, curvature, offset, scale=1.):
+    '''
+    Write the curvature radius and the offset from the center on the image
+    :param scale: size of the image relative to 720p
+    '''
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    thickness = max(int(2 * scale), 1)
+    cv2.putText(weighted_image, 'Curvature radius: {:.02f}m'.format(curvature), (int(10 * scale), int(60 * scale)),
+                font, 1.5 * scale, (255, 255, 255), thickness, cv2.LINE_AA)
+    cv2.putText(weighted_image, 'Offset from center: {:.02f}m'.format(offset), (int(10 * scale), int(130 * scale)),
+                font, 1.5 * scale, (255, 255, 255), thickness, cv2.LINE_AA)
+    return weighted_image
+
+
+def binary_warp(undist, profiler=profiler, transform=birds_eye, sobel_kernel=9, scale=1.):
+    '''
+    Thresholds, region of interest and birds-eye warp of an undistorted image
+    :param undist: undistorted image
+    :param profiler: StageProfiler timing the stages
+    :param transform: BirdsEyeTransform of the image
+    :param sobel_kernel: Sobel kernel size of the gradient threshold
+    :param scale: size of the image relative to the 720p frames the region of interest is designed for
+    :return: combined binary map and warped binary map
+    '''
+
+    with profiler.stage('gradient_threshold'):
+        combined = combined_gradient_threshold(undist, sx_thresh=(20, 100), dir_thresh=(0.7, 1.3),
+                                               sobel_kernel=sobel_kernel)
+    with profiler.stage('color_threshold'):
+        combined_binary = combined_color_threshold(undist, s_thresh=(170, 255), combined=combined)
+    with profiler.stage('region_of_interest'):
+        masked_image = region_of_interest(combined_binary, lane_region(undist.shape, scale))
+    with profiler.stage('warp'):
+        warped_test_image = transform.warp(masked_image)
+
+    return combined_binary, warped_test_image
+
+
+def track(undist, combined_binary, warped_test_image, left_lane_line, right_lane_line, nwindows, margin, minpix,
+          verbose, test, profiler=profiler):
+    '''
+    Stateful stages of the pipeline, they have to run in frame order
+    :return: the undistorted image with the lane and its curvature and offset drawn on it
+    '''
 
     if  left_lane_line.detected == False or right_lane_line.detected == False:
-        left_lane_line, right_lane_line, out_img = find_lane_pixels_blind(warped_test_image, left_lane_line, right_lane_line, nwindows, margin, minpix, verbose)
+        profiler.tag('search', 'blind')
+        with profiler.stage('search_blind'):
+            left_lane_line, right_lane_line, out_img = find_lane_pixels_blind(warped_test_image, left_lane_line, right_lane_line, nwindows, margin, minpix, verbose)
     else:
-        left_lane_line, right_lane_line, out_img = find_lane_pixels(warped_test_image, left_lane_line, right_lane_line, margin)
-
-    left_lane_line, right_lane_line, ploty = fit_polynomial(left_lane_line, right_lane_line, warped_test_image, thresh=50, sanity=True)
-    result = visualization_outimg(warped_test_image, left_lane_line, right_lane_line, ploty, margin, test)
-    warped_inverse = warped_test_images(result, inverse=True)
-    weighted_image = weighted_img(warped_inverse, undist, α=1, β=0.5, γ=0.)
-    left_lane_line, right_lane_line = measure_curvature_pixels(left_lane_line, right_lane_line, ploty)
-    offset = offset_to_center(combined_binary,left_lane_line, right_lane_line)
-    mean_curvature_meter = np.mean([left_lane_line.radius_of_curvature, right_lane_line.radius_of_curvature])
-    font = cv2.FONT_HERSHEY_SIMPLEX
-    cv2.putText(weighted_image, 'Curvature radius: {:.02f}m'.format(mean_curvature_meter), (10, 60), font, 1.5,
-                (255, 255, 255), 2, cv2.LINE_AA)
-    cv2.putText(weighted_image, 'Offset from center: {:.02f}m'.format(offset), (10, 130), font, 1.5, (255, 255, 255), 2,
-                cv2.LINE_AA)
+        profiler.tag('search', 'tracked')
+        with profiler.stage('search_tracked'):
+            left_lane_line, right_lane_line, out_img = find_lane_pixels(warped_test_image, left_lane_line, right_lane_line, margin, band=True)
+
+    with profiler.stage('fit'):
+        left_lane_line, right_lane_line, ploty = fit_polynomial(left_lane_line, right_lane_line, warped_test_image, thresh=50, sanity=True)
+    with profiler.stage('overlay'):
+        weighted_image = overlay_renderer.render(undist, left_lane_line, right_lane_line, margin, test)
+    with profiler.stage('curvature'):
+        left_lane_line, right_lane_line = measure_curvature_pixels(left_lane_line, right_lane_line, ploty)
+        offset = offset_to_center(combined_binary,left_lane_line, right_lane_line)
+        mean_curvature_meter = np.mean([left_lane_line.radius_of_curvature, right_lane_line.radius_of_curvature])
+    with profiler.stage('text'):
+        draw_text(weighted_image, mean_curvature_meter, offset)
+    profiler.end_frame()
+
+    return weighted_image
+
 
-    return weighted_image
\ No newline at end of file
+def pipeline(ini_img, mtx, dist, left_lane_line, right_lane_line, nwindows, margin, minpix, verbose, test,
+             profiler=profiler, pyramid=None):
+    # opt-in multi-resolution processing, see pyramid_utils
+    if pyramid is not None:
+        return pyramid.process(ini_img, mtx, dist, left_lane_line, right_lane_line, nwindows, margin, minpix,
+                               verbose, test, profiler)
+    undist, combined_binary, warped_test_image = preprocess(ini_img, mtx, dist, profiler)
+    return track(undist, combined_binary, warped_test_image, left_lane_line, right_lane_line, nwindows, margin,
+                 minpix, verbose, test, profiler)
@@ -0,0 +1,147 @@
+import collections
+import contextlib
+import csv
+import json
+import time
+import tracemalloc
+
+import numpy as np
+
+# context returned by a disabled profiler, it does nothing
+null_stage = contextlib.nullcontext()
+
+
+class StageProfiler():
+    '''
+    Time the stages of the pipeline frame by frame.
+
+    When disabled, stage() returns a shared no-op context so the instrumentation costs one attribute
+    lookup per stage. Every sample_every frames, the memory allocated by each stage is measured with
+    tracemalloc. Timings are recorded in the process the stages run in.
+    '''
+    def __init__(self, enabled=False, sample_every=0):
+        # whether the stages are timed
+        self.enabled = enabled
+        # measure the allocations every n frames, never if 0
+        self.sample_every = sample_every
+        # durations in seconds of each stage, one entry per frame it ran in
+        self.durations = collections.defaultdict(list)
+        # peak bytes allocated by each stage on the sampled frames
+        self.allocations = collections.defaultdict(list)
+        # total duration and tags (e.g. the search path) of each frame
+        self.frames = []
+        # start time and tags of the current frame
+        self.frame_start = None
+        self.tags = {}
+
+    def enable(self, sample_every=None):
+        self.enabled = True
+        if sample_every is not None:
+            self.sample_every = sample_every
+
+    def disable(self):
+        self.enabled = False
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def reset(self):
+        self.durations.clear()
+        self.allocations.clear()
+        self.frames = []
+        self.frame_start = None
+        self.tags = {}
+
+    def sampling(self):
+        return self.sample_every > 0 and len(self.frames) % self.sample_every == 0
+
+    def stage(self, name):
+        '''
+        :param name: name of the stage
+        :return: a context timing the code it wraps
+        '''
+        if not self.enabled:
+            return null_stage
+        return self.timed_stage(name)
+
+    @contextlib.contextmanager
+    def timed_stage(self, name):
+        if self.frame_start is None:
+            self.frame_start = time.perf_counter()
+        sample = self.sampling()
+        if sample:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name].append(time.perf_counter() - start)
+            if sample:
+                self.allocations[name].append(tracemalloc.get_traced_memory()[1] - before)
+
+    def tag(self, key, value):
+        '''
+        Attach a value to the current frame, e.g. which search path ran
+        '''
+        if self.enabled:
+            self.tags[key] = value
+
+    def end_frame(self):
+        if not self.enabled or self.frame_start is None:
+            return
+        self.frames.append((time.perf_counter() - self.frame_start, self.tags))
+        self.frame_start = None
+        self.tags = {}
+        if tracemalloc.is_tracing() and not self.sampling():
+            tracemalloc.stop()
+
+    def report(self):
+        '''
+        :return: per stage and per frame latency percentiles in milliseconds, allocations and search paths
+        '''
+        def summary(values):
+            values = np.asarray(values) * 1000
+            return {'count': len(values), 'mean_ms': float(np.mean(values)),
+                    'p50_ms': float(np.percentile(values, 50)), 'p95_ms': float(np.percentile(values, 95)),
+                    'p99_ms': float(np.percentile(values, 99)), 'max_ms': float(np.max(values))}
+
+        stages = collections.OrderedDict()
+        for name, values in self.durations.items():
+            stages[name] = summary(values)
+            if self.allocations[name]:
+                stages[name]['alloc_peak_bytes'] = int(np.mean(self.allocations[name]))
+        report = {'stages': stages}
+        if self.frames:
+            report['frames'] = summary([duration for duration, _ in self.frames])
+            # latency of the frames grouped by search path, to correlate spikes with lost tracking
+            paths = collections.defaultdict(list)
+            for duration, tags in self.frames:
+                paths[tags.get('search', 'none')].append(duration)
+            report['search'] = {path: summary(durations) for path, durations in paths.items()}
+        return report
+
+    def dump(self, path):
+        '''
+        Write the report as json, or as csv (one row per stage) if the path ends with .csv
+        '''
+        report = self.report()
+        if path.endswith('.csv'):
+            fields = ['stage', 'count', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'alloc_peak_bytes']
+            rows = [dict(stats, stage=name) for name, stats in report['stages'].items()]
+            if 'frames' in report:
+                rows.append(dict(report['frames'], stage='frame'))
+                rows += [dict(stats, stage='frame_' + path_name) for path_name, stats in report['search'].items()]
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=fields)
+                writer.writeheader()
+                writer.writerows(rows)
+        else:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+        return report
+
+
+# profiler used by the pipeline, disabled until enable() is called
+profiler = StageProfiler()
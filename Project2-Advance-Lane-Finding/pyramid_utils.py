@@ -0,0 +1,363 @@
+import argparse
+import glob
+import json
+import os
+
+import cv2
+import numpy as np
+
+from binary_utils import GradientEngine, SaturationClassifier, combined_color_threshold
+from calibration_utils import camera_calibration, get_camera_model
+from curvature_utils import measure_curvature_pixels, offset_to_center
+from fit_utils import fit_moments
+from lane_pixels_utils import band_columns, band_pixels, find_lane_pixels_blind, fit_polynomial
+from line_utils import Line
+from overlay_utils import OverlayRenderer
+from perspective_transform_utils import BirdsEyeTransform, perspective_points
+from pipeline import binary_warp, draw_text, lane_region
+from profiling_utils import profiler
+from roi_utils import region_masks
+
+
+# height of the frames the pixel parameters of the pipeline (margins, sanity check, meters per pixel) are tuned for
+NORMALIZED_HEIGHT = 720
+# rows of the refinement bands thresholded as one box, in normalized pixels
+REFINE_CHUNK = 32
+
+
+def rescale(values, ratio):
+    '''
+    :param values: pixel coordinates in an image
+    :param ratio: size of the other image / size of this image
+    :return: the coordinates in the other image, pixel centers are aligned as by cv2.resize
+    '''
+    return (np.asarray(values, np.float64) + 0.5) * ratio - 0.5
+
+
+def rescale_fit(fit, ratio):
+    '''
+    :param fit: coefficients [a, b, c] of x = a * y ** 2 + b * y + c in the pixels of an image
+    :param ratio: size of the other image / size of this image
+    :return: the coefficients of the same curve in the pixels of the other image
+    '''
+    a, b, c = fit
+    # y in this image = y in the other one / ratio + d
+    d = 0.5 / ratio - 0.5
+    return np.array([a / ratio, 2 * a * d + b, ratio * (a * d ** 2 + b * d + c) + 0.5 * ratio - 0.5])
+
+
+def odd_kernel(size):
+    '''
+    :return: the closest Sobel kernel size, odd and between 3 and 31
+    '''
+    return int(min(max(2 * round((size - 1) / 2.) + 1, 3), 31))
+
+
+class PyramidPipeline():
+    '''
+    Lane finding on a downscaled copy of the frame, refined at full resolution around the lines.
+
+    The pixel parameters of the pipeline are tuned for 720p frames, so the lane lines keep their state
+    in the pixels of the frame resized to 720p (the normalized resolution), whatever the resolution of
+    the video is. The frame is undistorted straight to working_height, where the thresholds, the warp
+    and the lane search run with their parameters scaled, and at full resolution for the overlay. The
+    fit of each line is then refined with the full resolution pixels of a narrow band around it, at the
+    row density of the working resolution: the band is cut in chunks of REFINE_CHUNK rows, only the
+    boxes of the camera view the chunks are sampled from are thresholded, and the binary map is warped
+    within the bands only. full_fits holds the fits in full resolution pixels.
+    '''
+    def __init__(self, working_height=NORMALIZED_HEIGHT, refine_margin=10, refinement=True, sobel_kernel=9):
+        # height of the frames the thresholds and the search run on, the full height if None
+        self.working_height = working_height
+        # half width of the refinement bands, in normalized pixels
+        self.refine_margin = refine_margin
+        # whether the fits are refined at full resolution
+        self.refinement = refinement
+        # Sobel kernel size at the normalized resolution
+        self.sobel_kernel = sobel_kernel
+        # (width, height) of the normalized resolution
+        self.normalized_size = None
+        # full and working resolution sizes / normalized size
+        self.full_scale = None
+        self.working_scale = None
+        # birds-eye transforms of the working and full resolution frames, the normalized one scaled
+        self.working_transform = BirdsEyeTransform(points=self.working_points)
+        self.full_transform = BirdsEyeTransform(points=self.full_points)
+        # stands for a normalized image in the functions only reading its shape
+        self.normalized = None
+        # buffers of the thresholds within the bands
+        self.engine = GradientEngine()
+        self.classifier = SaturationClassifier()
+        # overlay drawn at full resolution
+        self.renderer = OverlayRenderer(self.full_transform)
+        # left and right fits in full resolution birds-eye pixels
+        self.full_fits = None
+
+    def points(self, ratio):
+        src, dst = perspective_points(self.normalized_size)
+        return np.float32(rescale(src, ratio)), np.float32(rescale(dst, ratio))
+
+    def working_points(self, img_size):
+        return self.points(self.working_scale)
+
+    def full_points(self, img_size):
+        return self.points(self.full_scale)
+
+    def geometry(self, img_size):
+        '''
+        Set the geometry of both resolutions for the size of the frames
+        :param img_size: (width, height) of the full resolution frames
+        :return: the (width, height) of the working resolution
+        '''
+        width, height = img_size
+        full_scale = height / float(NORMALIZED_HEIGHT)
+        working_height = self.working_height or height
+        if full_scale != self.full_scale or working_height / float(NORMALIZED_HEIGHT) != self.working_scale:
+            # the geometry of both resolutions derives from the normalized one
+            self.full_scale = full_scale
+            self.working_scale = working_height / float(NORMALIZED_HEIGHT)
+            self.normalized_size = (int(round(width / full_scale)), NORMALIZED_HEIGHT)
+            self.normalized = np.broadcast_to(np.uint8(0), self.normalized_size[::-1])
+            for transform in (self.working_transform, self.full_transform):
+                transform.maps.clear()
+                transform.matrices.clear()
+        if working_height == height:
+            return img_size
+        return (int(round(self.normalized_size[0] * self.working_scale)), working_height)
+
+    def search(self, warped, left_lane_line, right_lane_line, nwindows, margin, minpix, verbose, profiler):
+        '''
+        Find the pixels of the lines in the working resolution birds-eye view
+        :return: the lines with their pixels in normalized coordinates
+        '''
+        ratio = self.working_scale
+        if not left_lane_line.detected or not right_lane_line.detected:
+            profiler.tag('search', 'blind')
+            with profiler.stage('search_blind'):
+                find_lane_pixels_blind(warped, left_lane_line, right_lane_line, nwindows, int(round(margin * ratio)),
+                                       minpix * ratio ** 2, verbose)
+        else:
+            profiler.tag('search', 'tracked')
+            with profiler.stage('search_tracked'):
+                for lane_line in (left_lane_line, right_lane_line):
+                    lane_line.allx, lane_line.ally = band_pixels(warped, rescale_fit(lane_line.best_fit, ratio),
+                                                                 margin * ratio)
+        if ratio != 1:
+            for lane_line in (left_lane_line, right_lane_line):
+                lane_line.allx = rescale(lane_line.allx, 1 / ratio)
+                lane_line.ally = rescale(lane_line.ally, 1 / ratio)
+        return left_lane_line, right_lane_line
+
+    def refine(self, undist, left_lane_line, right_lane_line):
+        '''
+        Replace the pixels of the lines by the full resolution pixels of the bands around their fits
+        :param undist: full resolution undistorted image
+        :param left_lane_line: left lane line with its pixels in normalized coordinates
+        :param right_lane_line: right lane line with its pixels in normalized coordinates
+        '''
+        height, width = undist.shape[:2]
+        map1, map2 = self.full_transform.remap_tables((width, height))
+        # rows of the bands, as many as at the working resolution
+        step = max(int(self.full_scale / self.working_scale), 1)
+        rows = np.arange(0, height, step)
+        chunk = max(int(round(REFINE_CHUNK * self.working_scale)), 1)
+        bands = []
+        chunks = []
+        for lane_line in (left_lane_line, right_lane_line):
+            if len(lane_line.allx) < 3:
+                continue
+            fit, _ = fit_moments(lane_line.allx, lane_line.ally, NORMALIZED_HEIGHT)
+            cols, inside = band_columns(rescale_fit(fit, self.full_scale), self.refine_margin * self.full_scale,
+                                        height, width)
+            if cols.shape[1] == 0:
+                continue
+            cols, inside = cols[::step], inside[::step]
+            band = np.zeros(cols.shape, np.uint8)
+            bands.append((lane_line, cols, inside, band))
+            # remap tables of the band only, straightened: column j of row y is the column cols[y, j]
+            band_map1 = map1[rows[:, None], cols]
+            band_map2 = map2[rows[:, None], cols]
+            for y0 in range(0, len(rows), chunk):
+                chunks.append((band[y0:y0 + chunk], band_map1[y0:y0 + chunk], band_map2[y0:y0 + chunk]))
+        if not bands:
+            return
+        binaries = self.band_binaries(undist, [chunk_map1 for _, chunk_map1, _ in chunks])
+        for (band, chunk_map1, chunk_map2), (binary, origin) in zip(chunks, binaries):
+            # birds-eye view of the binary map within the band, as binary_warp warps the whole map
+            if binary is not None:
+                cv2.remap(binary, chunk_map1 - origin, chunk_map2, cv2.INTER_LINEAR, dst=band)
+        for lane_line, cols, inside, band in bands:
+            inside &= band != 0
+            iy, ix = inside.nonzero()
+            if len(iy) < 3:
+                continue
+            lane_line.allx = rescale(cols[iy, ix], 1 / self.full_scale)
+            lane_line.ally = rescale(rows[iy], 1 / self.full_scale)
+
+    def band_binaries(self, undist, chunk_maps):
+        '''
+        Thresholds of the camera view, at full resolution, within the boxes the chunks of the bands are
+        sampled from. The gradient is scaled to the peak of all the boxes rather than of the frame.
+        :param undist: full resolution undistorted image
+        :param chunk_maps: integer remap tables of the chunks, as given by remap_tables
+        :return: for each chunk, the binary map of its box masked by the region of interest and the (x, y)
+        origin of the box, or None and None if every sample of the chunk is outside the frame
+        '''
+        height, width = undist.shape[:2]
+        sobel_kernel = odd_kernel(self.sobel_kernel * self.full_scale)
+        # the bilinear neighbours of the samples, and the pixels the Sobel kernel reads around them
+        pad = sobel_kernel // 2 + 1
+        boxes = []
+        for chunk_map in chunk_maps:
+            points = chunk_map.reshape(-1, 2)
+            x0, y0 = np.maximum(points.min(axis=0).astype(int) - pad, 0)
+            x1 = min(int(points[:, 0].max()) + 1 + pad, width)
+            y1 = min(int(points[:, 1].max()) + 1 + pad, height)
+            boxes.append((x0, y0, x1, y1) if x1 > x0 and y1 > y0 else None)
+        inside = [box for box in boxes if box is not None]
+        combined = iter(self.engine.combined_boxes(undist, inside, sx_thresh=(20, 100), dir_thresh=(0.7, 1.3),
+                                                   sobel_kernel=sobel_kernel))
+        # the mask of the frame is rasterized once, the boxes change with every frame
+        mask = region_masks.mask((height, width), np.uint8, lane_region(undist.shape, self.full_scale))
+        binaries = []
+        for box in boxes:
+            if box is None:
+                binaries.append((None, None))
+                continue
+            x0, y0, x1, y1 = box
+            binary = combined_color_threshold(undist[y0:y1, x0:x1], s_thresh=(170, 255), combined=next(combined),
+                                              classifier=self.classifier)
+            np.bitwise_and(binary, mask[y0:y1, x0:x1], out=binary)
+            binaries.append((binary, np.int16([x0, y0])))
+        return binaries
+
+    def full_resolution_line(self, lane_line, height):
+        '''
+        :return: a Line with the bestx of lane_line at each row of the full resolution birds-eye view, None
+        while no fit of lane_line has passed the sanity check
+        '''
+        if lane_line.bestx is None:
+            return None
+        line = Line()
+        y = rescale(np.arange(height), 1 / self.full_scale)
+        bestx = np.interp(y, np.arange(len(lane_line.bestx)), lane_line.bestx)
+        line.bestx = rescale(bestx, self.full_scale)
+        return line
+
+    def process(self, ini_img, mtx, dist, left_lane_line, right_lane_line, nwindows, margin, minpix, verbose, test,
+                profiler=profiler):
+        '''
+        Same as pipeline() with the lane search at the working resolution
+        :param ini_img: original image
+        :param mtx: camera matrix
+        :param dist: distortion coefficient
+        :param left_lane_line: left lane line, in normalized pixels
+        :param right_lane_line: right lane line, in normalized pixels
+        :param nwindows: the number of sliding windows
+        :param margin: the width of the windows +/- margin, in normalized pixels
+        :param minpix: minimum number of pixels found to recenter window, in normalized pixels
+        :param verbose: if True, draw sliding windows
+        :param test: if True, plot the region between two lines
+        :return: the full resolution undistorted image with the lane and its curvature and offset drawn on it
+        '''
+        camera = get_camera_model(mtx, dist)
+        img_size = (ini_img.shape[1], ini_img.shape[0])
+        working_size = self.geometry(img_size)
+        with profiler.stage('undistort'):
+            undist = camera.undistort(ini_img)
+        if working_size == img_size:
+            small = undist
+        else:
+            with profiler.stage('undistort_working'):
+                small = camera.undistort(ini_img, working_size)
+        combined_binary, warped = binary_warp(small, profiler, self.working_transform,
+                                              odd_kernel(self.sobel_kernel * self.working_scale), self.working_scale)
+        self.search(warped, left_lane_line, right_lane_line, nwindows, margin, minpix, verbose, profiler)
+        if self.refinement and self.full_scale != self.working_scale:
+            with profiler.stage('refine'):
+                self.refine(undist, left_lane_line, right_lane_line)
+
+        with profiler.stage('fit'):
+            _, _, ploty = fit_polynomial(left_lane_line, right_lane_line, self.normalized, thresh=50, sanity=True)
+            self.full_fits = (rescale_fit(left_lane_line.best_fit, self.full_scale),
+                              rescale_fit(right_lane_line.best_fit, self.full_scale))
+        with profiler.stage('overlay'):
+            height = undist.shape[0]
+            lines = [self.full_resolution_line(lane_line, height) for lane_line in (left_lane_line, right_lane_line)]
+            if None in lines:
+                # no lane to draw yet
+                weighted_image = undist.copy()
+            else:
+                weighted_image = self.renderer.render(undist, lines[0], lines[1], margin * self.full_scale, test)
+        with profiler.stage('curvature'):
+            # meters per pixel are those of the normalized resolution
+            measure_curvature_pixels(left_lane_line, right_lane_line, ploty)
+            offset = offset_to_center(self.normalized, left_lane_line, right_lane_line)
+            mean_curvature_meter = np.mean([left_lane_line.radius_of_curvature, right_lane_line.radius_of_curvature])
+        with profiler.stage('text'):
+            draw_text(weighted_image, mean_curvature_meter, offset, self.full_scale)
+        profiler.end_frame()
+
+        return weighted_image
+
+
+def compare_to_full_resolution(frames, mtx, dist, pyramid=None, nwindows=9, margin=100, minpix=50):
+    '''
+    Run the pyramid mode and the same pipeline at full resolution without refinement on the same frames,
+    and compare their lane lines.
+    :param frames: RGB frames of a video, in order
+    :param pyramid: PyramidPipeline, a new one by default
+    :return: the position error of the lines in full resolution pixels, and the curvature and offset of both
+    '''
+    pyramid = pyramid or PyramidPipeline()
+    reference = PyramidPipeline(working_height=None, refinement=False, sobel_kernel=pyramid.sobel_kernel)
+    runs = ((reference, Line(), Line()), (pyramid, Line(), Line()))
+    errors = []
+    measures = []
+    for frame in frames:
+        for run, left_lane_line, right_lane_line in runs:
+            run.process(frame, mtx, dist, left_lane_line, right_lane_line, nwindows, margin, minpix, False, True)
+        lines = [run[1:] for run in runs]
+        if any(line.bestx is None for pair in lines for line in pair):
+            continue
+        for reference_line, pyramid_line in zip(*lines):
+            errors.append(np.abs(pyramid_line.bestx - reference_line.bestx) * reference.full_scale)
+        measures.append([value for pair in lines for value in
+                         (np.mean([line.radius_of_curvature for line in pair]),
+                          offset_to_center(reference.normalized, *pair))])
+
+    if not errors:
+        return {'frames': 0}
+    errors = np.concatenate(errors)
+    measures = np.array(measures)
+    return {'frames': len(measures), 'mean_error_px': float(np.mean(errors)),
+            'p95_error_px': float(np.percentile(errors, 95)), 'max_error_px': float(np.max(errors)),
+            'full_radius_m': float(np.median(measures[:, 0])), 'pyramid_radius_m': float(np.median(measures[:, 2])),
+            'offset_error_m': float(np.mean(np.abs(measures[:, 3] - measures[:, 1])))}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Accuracy of the pyramid mode against the full resolution pipeline.')
+    parser.add_argument('input', type=str, help='Path of the input video.')
+    parser.add_argument('--working_height', type=int, default=NORMALIZED_HEIGHT,
+                        help='Height of the frames the thresholds and the search run on.')
+    parser.add_argument('--refine_margin', type=float, default=10, help='Half width of the refinement bands.')
+    parser.add_argument('--frames', type=int, default=100, help='Number of frames to compare.')
+    parser.add_argument('--camera_cal', type=str, default='camera_cal',
+                        help='Directory of the chessboard images used to calibrate the camera.')
+    parser.add_argument('--cache', type=str, default='camera_cal/calibration.npz',
+                        help='File storing the camera calibration between runs.')
+    args = parser.parse_args()
+
+    images = glob.glob(os.path.join(args.camera_cal, 'calibration*.jpg'))
+    _, mtx, dist, _, _ = camera_calibration(images, 9, 6, cache_file=args.cache)
+    capture = cv2.VideoCapture(args.input)
+    frames = []
+    while len(frames) < args.frames:
+        ret, bgr = capture.read()
+        if not ret:
+            break
+        frames.append(cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB))
+    capture.release()
+    pyramid = PyramidPipeline(args.working_height, args.refine_margin)
+    print(json.dumps(compare_to_full_resolution(frames, mtx, dist, pyramid), indent=2))
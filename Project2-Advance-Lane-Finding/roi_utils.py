@@ -0,0 +1,89 @@
+import collections
+
+import cv2
+import numpy as np
+
+
+class RegionMask():
+    '''
+    Masks of polygonal regions of interest, rasterized once per (shape, dtype, vertices).
+
+    The frames of a video have the same size and region, so the mask of region_of_interest is filled
+    on the first frame only. Outside of the bounding box of the region the result is set to 0 without
+    reading the image, and the box is exposed so later stages can skip the rows and columns outside.
+    Only depends on cv2 and numpy, so the Project1 notebook uses it too.
+    '''
+    def __init__(self, capacity=16):
+        # number of masks kept, the least recently used one is dropped first
+        self.capacity = capacity
+        # (mask, bounding box) keyed by (shape, dtype, vertices)
+        self.masks = collections.OrderedDict()
+
+    def get(self, shape, dtype, vertices):
+        '''
+        :param shape: shape of the image
+        :param dtype: type of the image
+        :param vertices: array of integer points of the polygon, as for cv2.fillPoly
+        :return: the read-only mask and the bounding box (x0, y0, x1, y1) of its nonzero pixels
+        '''
+        vertices = np.ascontiguousarray(vertices, np.int32)
+        key = (tuple(shape), np.dtype(dtype).str, vertices.shape, vertices.tobytes())
+        entry = self.masks.get(key)
+        if entry is not None:
+            self.masks.move_to_end(key)
+            return entry
+
+        mask = np.zeros(shape, dtype)
+        # defining a 3 channel or 1 channel color to fill the mask with depending on the input image
+        if len(shape) > 2:
+            ignore_mask_color = (255,) * shape[2]
+        else:
+            ignore_mask_color = 255
+        cv2.fillPoly(mask, vertices, ignore_mask_color)
+        mask.setflags(write=False)
+
+        inside = mask.reshape(shape[0], shape[1], -1).any(axis=2)
+        rows = np.flatnonzero(inside.any(axis=1))
+        cols = np.flatnonzero(inside.any(axis=0))
+        if len(rows) == 0:
+            box = (0, 0, 0, 0)
+        else:
+            box = (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+
+        entry = (mask, box)
+        self.masks[key] = entry
+        if len(self.masks) > self.capacity:
+            self.masks.popitem(last=False)
+        return entry
+
+    def mask(self, shape, dtype, vertices):
+        return self.get(shape, dtype, vertices)[0]
+
+    def bounding_box(self, shape, vertices):
+        '''
+        :return: (x0, y0, x1, y1) region of the image that the polygon covers
+        '''
+        return self.get(shape[:2], np.uint8, vertices)[1]
+
+    def apply(self, img, vertices, out=None):
+        '''
+        Same result as region_of_interest
+        :param img: image to mask
+        :param vertices: array of integer points of the polygon
+        :param out: optional array to write the result into, img itself masks it in place
+        :return: the image where the mask is nonzero, 0 elsewhere
+        '''
+        mask, (x0, y0, x1, y1) = self.get(img.shape, img.dtype, vertices)
+        if out is None:
+            out = np.empty_like(img)
+        out[:y0] = 0
+        out[y1:] = 0
+        out[y0:y1, :x0] = 0
+        out[y0:y1, x1:] = 0
+        if x1 > x0:
+            cv2.bitwise_and(img[y0:y1, x0:x1], mask[y0:y1, x0:x1], dst=out[y0:y1, x0:x1])
+        return out
+
+
+# masks reused across the frames of a video
+region_masks = RegionMask()
@@ -0,0 +1,277 @@
+import os
+import queue
+import threading
+
+import cv2
+import numpy as np
+
+IMAGE_EXT = ['jpeg', 'gif', 'png', 'jpg']
+
+
+def image_sequence(folder):
+    '''
+    :param folder: directory of images, e.g. the frames recorded by drive.py
+    :return: the sorted paths of the images of the folder
+    '''
+    image_list = sorted(os.path.join(folder, image_file) for image_file in os.listdir(folder))
+    return [image_file for image_file in image_list if os.path.splitext(image_file)[1][1:].lower() in IMAGE_EXT]
+
+
+class FrameReader():
+    '''
+    Streaming decoder of the frames of a video file or of a sequence of images.
+
+    A thread decodes the next frames into a fixed pool of buffers while the caller processes the current
+    one, at most prefetch frames ahead, so the memory used does not depend on the length of the video.
+    Iterating yields views on the pool: a frame is valid until the next one is requested, copy it to keep
+    it. The skipped frames of a video are grabbed but not decoded.
+    '''
+    def __init__(self, source, prefetch=4, step=1, start=0, stop=None, rgb=True):
+        '''
+        :param source: path of a video, or list of image paths
+        :param prefetch: number of frames decoded ahead
+        :param step: keep one frame out of step
+        :param start: index of the first frame
+        :param stop: index after the last frame, the end of the source by default
+        :param rgb: if True the frames are RGB, as moviepy gives them, else BGR as cv2 decodes them
+        '''
+        # source of the frames
+        self.source = source
+        self.capture = None
+        if isinstance(source, str):
+            self.capture = cv2.VideoCapture(source)
+            if not self.capture.isOpened():
+                raise IOError('Cannot open video {}'.format(source))
+            self.fps = self.capture.get(cv2.CAP_PROP_FPS)
+            self.width = int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+            self.height = int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            self.length = int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        else:
+            if len(source) == 0:
+                raise ValueError('No image to read')
+            first = cv2.imread(source[0])
+            if first is None:
+                raise IOError('Cannot read image {}'.format(source[0]))
+            self.fps = None
+            self.height, self.width = first.shape[:2]
+            self.length = len(source)
+        # frames to read
+        self.prefetch = prefetch
+        self.step = step
+        self.start = start
+        self.stop = stop
+        self.rgb = rgb
+        # index of the next frame of the source
+        self.position = 0
+        # BGR frame decoded by cv2 before the color conversion
+        self.bgr = None
+
+    def __len__(self):
+        '''
+        :return: the number of frames the reader yields, from the frame count of the container for a video
+        '''
+        stop = self.length if self.stop is None else min(self.stop, self.length)
+        return len(range(self.start, stop, self.step))
+
+    def seek(self, index):
+        '''
+        Move to the frame index, the frames in between are grabbed without decoding them
+        :return: False if the source ends before the frame
+        '''
+        if self.capture is None or index < self.position:
+            self.position = index
+            if self.capture is not None:
+                self.capture.set(cv2.CAP_PROP_POS_FRAMES, index)
+            return self.capture is not None or index < self.length
+        while self.position < index:
+            if not self.capture.grab():
+                return False
+            self.position += 1
+        return True
+
+    def read(self, out=None):
+        '''
+        Decode the next frame of the source into out
+        :param out: array (height, width, 3) of type uint8 to decode into, allocated if None
+        :return: the frame, or None at the end of the source
+        '''
+        if self.capture is not None:
+            ret, self.bgr = self.capture.read(self.bgr)
+            if not ret:
+                return None
+        else:
+            if self.position >= self.length:
+                return None
+            self.bgr = cv2.imread(self.source[self.position])
+            if self.bgr is None:
+                raise IOError('Cannot read image {}'.format(self.source[self.position]))
+            if self.bgr.shape[:2] != (self.height, self.width):
+                raise ValueError('Image {} is not {}x{}'.format(self.source[self.position], self.width, self.height))
+        self.position += 1
+        if out is None:
+            out = np.empty((self.height, self.width, 3), np.uint8)
+        if self.rgb:
+            cv2.cvtColor(self.bgr, cv2.COLOR_BGR2RGB, dst=out)
+        else:
+            np.copyto(out, self.bgr)
+        return out
+
+    def decode(self, buffers, free, ready, stopping):
+        '''
+        Decode the selected frames into the free buffers, in order, and hand them over to the iterator
+        '''
+        try:
+            # the frame count of a video container is an estimate, read until the end of the stream
+            index = self.start
+            while self.stop is None or index < self.stop:
+                slot = free.get()
+                if stopping.is_set() or not self.seek(index) or self.read(buffers[slot]) is None:
+                    break
+                ready.put(slot)
+                index += self.step
+        except Exception as e:
+            ready.put(e)
+        finally:
+            ready.put(None)
+
+    def __iter__(self):
+        buffers = np.empty((self.prefetch + 1, self.height, self.width, 3), np.uint8)
+        free = queue.Queue()
+        for slot in range(len(buffers)):
+            free.put(slot)
+        ready = queue.Queue()
+        stopping = threading.Event()
+        decoder = threading.Thread(target=self.decode, args=(buffers, free, ready, stopping), daemon=True)
+        decoder.start()
+        try:
+            while True:
+                slot = ready.get()
+                if slot is None:
+                    break
+                if isinstance(slot, Exception):
+                    raise slot
+                yield buffers[slot]
+                free.put(slot)
+        finally:
+            stopping.set()
+            # unblock the decoder if it waits for a buffer
+            free.put(0)
+            decoder.join()
+
+    def close(self):
+        if self.capture is not None:
+            self.capture.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FrameWriter():
+    '''
+    Streaming encoder of a video.
+
+    write() converts the frame into one of a fixed pool of buffers and returns, a thread encodes the
+    buffers in order, so the caller can reuse its frame right away and the encoding overlaps the
+    processing of the next frame. The size of the video is the size of the first frame.
+    '''
+    def __init__(self, path, fps, queue_size=4, rgb=True, fourcc='mp4v'):
+        '''
+        :param path: path of the video
+        :param fps: frames per second of the video
+        :param queue_size: number of frames waiting to be encoded
+        :param rgb: if True the frames are RGB, else BGR
+        :param fourcc: code of the video codec
+        '''
+        self.path = path
+        self.fps = fps
+        self.queue_size = queue_size
+        self.rgb = rgb
+        self.fourcc = fourcc
+        # opened with the first frame
+        self.writer = None
+        self.buffers = None
+        self.free = queue.Queue()
+        self.ready = queue.Queue()
+        self.encoder = None
+        # error of the encoder thread, raised by the next write
+        self.error = None
+        # number of frames written
+        self.count = 0
+
+    def open(self, height, width):
+        writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*self.fourcc), self.fps, (width, height))
+        if not writer.isOpened():
+            writer.release()
+            raise IOError('Cannot write video {}'.format(self.path))
+        self.writer = writer
+        self.buffers = np.empty((self.queue_size, height, width, 3), np.uint8)
+        for slot in range(self.queue_size):
+            self.free.put(slot)
+        self.encoder = threading.Thread(target=self.encode, daemon=True)
+        self.encoder.start()
+
+    def encode(self):
+        while True:
+            slot = self.ready.get()
+            if slot is None:
+                break
+            try:
+                self.writer.write(self.buffers[slot])
+            except Exception as e:
+                self.error = e
+            self.free.put(slot)
+
+    def write(self, frame):
+        '''
+        :param frame: array (height, width, 3) of type uint8, copied before the function returns
+        '''
+        if self.writer is None:
+            self.open(*frame.shape[:2])
+        if self.error is not None:
+            raise self.error
+        slot = self.free.get()
+        if self.rgb:
+            cv2.cvtColor(frame, cv2.COLOR_RGB2BGR, dst=self.buffers[slot])
+        else:
+            np.copyto(self.buffers[slot], frame)
+        self.ready.put(slot)
+        self.count += 1
+
+    def close(self):
+        '''
+        Encode the queued frames and close the video
+        :return: the number of frames written
+        '''
+        if self.writer is not None:
+            self.ready.put(None)
+            self.encoder.join()
+            self.writer.release()
+            self.writer = None
+        if self.error is not None:
+            raise self.error
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def transcode(reader, path, process=None, fps=None, queue_size=4):
+    '''
+    Stream the frames of a reader into a video, one frame of the source in memory at a time
+    :param reader: FrameReader of the source
+    :param path: path of the video
+    :param process: optional function applied to every frame
+    :param fps: frames per second of the video, the one of the source by default
+    :return: the number of frames written
+    '''
+    fps = fps or reader.fps
+    with FrameWriter(path, fps, queue_size, rgb=reader.rgb) as writer:
+        for frame in reader:
+            writer.write(frame if process is None else process(frame))
+    return writer.count
@@ -0,0 +1,193 @@
+import argparse
+import collections
+import glob
+import multiprocessing
+import os
+import queue
+import threading
+
+import cv2
+import numpy as np
+
+from calibration_utils import camera_calibration
+from line_utils import Line
+from pipeline import preprocess, track
+from profiling_utils import profiler
+
+# views on the shared frame buffers, set in every worker process by init_worker
+worker_buffers = None
+# camera matrix and distortion coefficient used by the worker processes
+worker_calibration = None
+
+
+def shared_slots(nslots, shape):
+    '''
+    :param nslots: number of frames in flight
+    :param shape: shape of a RGB frame
+    :return: for each slot, the shared memory of the frame, undistorted image, combined and warped binary maps
+    '''
+    size = int(np.prod(shape))
+    return [(multiprocessing.RawArray('B', size), multiprocessing.RawArray('B', size),
+             multiprocessing.RawArray('B', size // 3), multiprocessing.RawArray('B', size // 3))
+            for _ in range(nslots)]
+
+
+def slot_views(slot, shape):
+    '''
+    :param slot: shared memory of a slot
+    :param shape: shape of a RGB frame
+    :return: numpy views on the frame, undistorted image, combined and warped binary maps
+    '''
+    frame, undist, combined, warped = (np.frombuffer(buffer, np.uint8) for buffer in slot)
+    return frame.reshape(shape), undist.reshape(shape), combined.reshape(shape[:2]), warped.reshape(shape[:2])
+
+
+def init_worker(slots, shape, mtx, dist):
+    global worker_buffers, worker_calibration
+    worker_buffers = [slot_views(slot, shape) for slot in slots]
+    worker_calibration = (mtx, dist)
+    # a forked worker inherits the profiler of the parent, but its timings are never collected
+    profiler.disable()
+    profiler.reset()
+
+
+def process_slot(index):
+    '''
+    Run the stateless stages on the frame of a slot and write the results back into the slot
+    '''
+    frame, undist, combined, warped = worker_buffers[index]
+    outputs = preprocess(frame, *worker_calibration)
+    for buffer, output in zip((undist, combined, warped), outputs):
+        np.copyto(buffer, output)
+    return index
+
+
+def read_frames(capture, views, free_slots, ready_slots, stop):
+    '''
+    Decode the frames into the free slots, in order, and hand them over to the dispatcher
+    '''
+    bgr = None
+    try:
+        while True:
+            index = free_slots.get()
+            if stop.is_set():
+                break
+            ret, bgr = capture.read(bgr)
+            if not ret:
+                break
+            cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=views[index][0])
+            ready_slots.put(index)
+    finally:
+        ready_slots.put(None)
+
+
+def write_frames(writer, frames):
+    '''
+    Encode the annotated frames in the order they are received
+    '''
+    while True:
+        frame = frames.get()
+        if frame is None:
+            break
+        writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+
+
+def run_video(input_path, output_path, mtx, dist, workers=None, nwindows=9, margin=100, minpix=50, test=True):
+    '''
+    Apply the lane finding pipeline to a video.
+
+    A reader thread decodes the frames into shared memory slots, a process pool runs the stateless stages
+    (undistort, thresholds, region of interest, warp) and the lane tracking runs in frame order in this
+    process, so the output is the same as calling pipeline() on every frame.
+    :param input_path: path of the input video
+    :param output_path: path of the annotated output video
+    :param mtx: camera matrix
+    :param dist: distortion coefficient
+    :param workers: number of worker processes, all the cores by default
+    :return: the number of processed frames
+    '''
+    capture = cv2.VideoCapture(input_path)
+    if not capture.isOpened():
+        raise IOError('Cannot open video {}'.format(input_path))
+    width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+
+    workers = workers or multiprocessing.cpu_count()
+    # frames being processed by the pool, the other slots are decoded ahead or free
+    in_flight = 2 * workers
+    shape = (height, width, 3)
+    slots = shared_slots(in_flight + 2, shape)
+    views = [slot_views(slot, shape) for slot in slots]
+
+    free_slots = queue.Queue()
+    for index in range(len(slots)):
+        free_slots.put(index)
+    ready_slots = queue.Queue()
+    output_frames = queue.Queue(maxsize=in_flight)
+    stop = threading.Event()
+    reader = threading.Thread(target=read_frames, args=(capture, views, free_slots, ready_slots, stop))
+    encoder = threading.Thread(target=write_frames, args=(writer, output_frames))
+
+    left_lane_line = Line()
+    right_lane_line = Line()
+    count = 0
+
+    def finish(index):
+        _, undist, combined, warped = views[index]
+        output_frames.put(track(undist, combined, warped, left_lane_line, right_lane_line, nwindows, margin,
+                                minpix, False, test))
+        free_slots.put(index)
+
+    pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(slots, shape, mtx, dist))
+    reader.start()
+    encoder.start()
+    try:
+        pending = collections.deque()
+        while True:
+            index = ready_slots.get()
+            if index is None:
+                break
+            pending.append(pool.apply_async(process_slot, (index,)))
+            count += 1
+            # track the finished frames in order, wait for the oldest one when the pool is full
+            while pending and (len(pending) >= in_flight or pending[0].ready()):
+                finish(pending.popleft().get())
+        while pending:
+            finish(pending.popleft().get())
+    finally:
+        stop.set()
+        # unblock the reader if it waits for a slot
+        free_slots.put(0)
+        reader.join()
+        output_frames.put(None)
+        encoder.join()
+        pool.terminate()
+        capture.release()
+        writer.release()
+
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find the lane lines of a video.')
+    parser.add_argument('input', type=str, help='Path of the input video.')
+    parser.add_argument('output', type=str, help='Path of the output video.')
+    parser.add_argument('--camera_cal', type=str, default='camera_cal',
+                        help='Directory of the chessboard images used to calibrate the camera.')
+    parser.add_argument('--cache', type=str, default='camera_cal/calibration.npz',
+                        help='File storing the camera calibration between runs.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes.')
+    parser.add_argument('--profile', type=str, default='',
+                        help='If set, json or csv file to write the timings of the tracking stages to.')
+    args = parser.parse_args()
+
+    images = glob.glob(os.path.join(args.camera_cal, 'calibration*.jpg'))
+    _, mtx, dist, _, _ = camera_calibration(images, 9, 6, cache_file=args.cache)
+    if args.profile != '':
+        profiler.enable(sample_every=50)
+    frames = run_video(args.input, args.output, mtx, dist, workers=args.workers)
+    print('{} frames written to {}'.format(frames, args.output))
+    if args.profile != '':
+        profiler.dump(args.profile)
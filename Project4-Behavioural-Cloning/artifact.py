@@ -0,0 +1,99 @@
+import json
+
+import numpy as np
+
+# version of the format of the inference artifacts
+ARTIFACT_VERSION = 1
+
+# value of the pixels padded around the frames, 0 once normalized by x / 255.0 - 0.5
+PAD_VALUE = 127.5
+
+
+def same_padding(size, kernel, stride):
+    '''
+    :return: the padding before and after a dimension of a 'same' convolution, as TensorFlow pads it
+    '''
+    output = -(-size // stride)
+    total = max((output - 1) * stride + kernel - size, 0)
+    return total // 2, total - total // 2
+
+
+def fold_normalization(kernel, bias):
+    '''
+    Weights of the first convolution applied to the pixels, instead of to x / 255.0 - 0.5. The result is
+    the same when the frames are padded with PAD_VALUE instead of 0.
+    :param kernel: kernel (rows, cols, input channels, output channels) of the convolution
+    :param bias: bias of the convolution
+    :return: the folded kernel and bias
+    '''
+    return kernel / 255.0, bias - 0.5 * kernel.sum(axis=(0, 1, 2))
+
+
+def quantize(kernel, dtype):
+    '''
+    :param kernel: float32 kernel, the output channels on the last axis
+    :param dtype: 'float32', 'float16', or 'int8' for symmetric quantization of every output channel
+    :return: the stored kernel, and the scale of every output channel for int8
+    '''
+    if dtype == 'int8':
+        scale = np.abs(kernel).reshape(-1, kernel.shape[-1]).max(axis=0) / 127.0
+        scale[scale == 0] = 1.0
+        return np.round(kernel / scale).astype(np.int8), scale.astype(np.float32)
+    return kernel.astype(dtype), None
+
+
+def save_artifact(path, weights, input_shape, cropping, padding, dtype='float32'):
+    '''
+    :param path: path of the .npz artifact
+    :param weights: kernels and biases of the layers, in order, the normalization folded into the first one
+    :param input_shape: shape of the padded frames
+    :param cropping: rows removed from the top and the bottom of the frames
+    :param padding: ((top, bottom), (left, right)) padding of the frames with PAD_VALUE
+    :param dtype: storage type of the kernels, see quantize
+    '''
+    arrays = {}
+    for i in range(0, len(weights), 2):
+        kernel, scale = quantize(np.asarray(weights[i], np.float32), dtype)
+        arrays['kernel_{}'.format(i // 2)] = kernel
+        if scale is not None:
+            arrays['scale_{}'.format(i // 2)] = scale
+        arrays['bias_{}'.format(i // 2)] = np.asarray(weights[i + 1], np.float32)
+    metadata = {'version': ARTIFACT_VERSION, 'layers': len(weights) // 2, 'dtype': dtype,
+                'input_shape': list(input_shape), 'cropping': list(cropping),
+                'padding': [list(pad) for pad in padding], 'pad_value': PAD_VALUE}
+    np.savez(path, metadata=np.array(json.dumps(metadata)), **arrays)
+
+
+def read_metadata(data):
+    metadata = json.loads(str(data['metadata']))
+    if metadata['version'] != ARTIFACT_VERSION:
+        raise ValueError('Artifact version {} is not supported'.format(metadata['version']))
+    return metadata
+
+
+def artifact_metadata(path):
+    '''
+    :return: the metadata of an artifact, without loading its weights
+    '''
+    with np.load(path) as data:
+        return read_metadata(data)
+
+
+def load_artifact(path):
+    '''
+    :param path: path of an artifact written by save_artifact
+    :return: the float32 kernels and biases of the layers in order, and the metadata
+    '''
+    with np.load(path) as data:
+        metadata = read_metadata(data)
+        weights = []
+        for i in range(metadata['layers']):
+            kernel = data['kernel_{}'.format(i)].astype(np.float32)
+            if 'scale_{}'.format(i) in data.files:
+                kernel *= data['scale_{}'.format(i)]
+            weights += [kernel, data['bias_{}'.format(i)]]
+    return weights, metadata
+
+
+def is_artifact(path):
+    return path.endswith('.npz')
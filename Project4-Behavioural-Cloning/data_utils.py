@@ -0,0 +1,139 @@
+import collections
+import concurrent.futures
+import csv
+import os
+
+import cv2
+import numpy as np
+
+
+def read_csv(path):
+    '''
+    :param path: path stores the csv file
+    :return: lines of the csv
+    '''
+    lines = []
+    with open(path) as csvfile:
+        reader = csv.reader(csvfile)
+        for line in reader:
+            lines.append(line)
+    return lines
+
+
+def read_samples(csv_lines, image_path, correction=0.4):
+    '''
+    Same samples as read_images, without decoding the images
+    :param csv_lines: lines in csv file
+    :param image_path: path of images
+    :param correction: correction to create adjusted steering measurements
+    :return: paths of the center, left and right images of every line, and their steering angles
+    '''
+    paths = []
+    measurements = []
+    for line in csv_lines:
+        for i in range(3):
+            filename = line[i].split('/')[-1]
+            paths.append(os.path.join(image_path, filename))
+        measurement = float(line[3])  # center
+        measurements.append(measurement)
+        measurements.append(measurement + correction)  # left image
+        measurements.append(measurement - correction)  # right image
+    return paths, np.array(measurements, np.float32)
+
+
+class StreamingLoader():
+    '''
+    Batches of images decoded on the fly from the paths of the samples.
+
+    Only the paths and the steering angles are kept in memory. With augmentation every sample is seen
+    twice per epoch, as is and flipped, the flip is applied when the batch is decoded. The order of the
+    samples is shuffled every epoch, and worker threads decode the next batches while the model trains,
+    so the memory used is a few batches whatever the size of the driving log.
+    '''
+    def __init__(self, paths, measurements, augment=True, batch_size=32, shuffle=True, workers=4, prefetch=None,
+                 image_shape=(160, 320, 3), seed=None):
+        '''
+        :param paths: paths of the images
+        :param measurements: steering angle of each image
+        :param augment: if True, add the flipped images
+        :param batch_size: number of images of a batch
+        :param shuffle: if True, shuffle the samples every epoch
+        :param workers: number of threads decoding the batches, cv2 releases the GIL while decoding
+        :param prefetch: number of batches decoded ahead, workers by default
+        :param image_shape: shape of the images
+        '''
+        self.paths = list(paths)
+        self.measurements = np.asarray(measurements, np.float32)
+        self.augment = augment
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.workers = workers
+        self.prefetch = prefetch or workers
+        self.image_shape = image_shape
+        self.random = np.random.RandomState(seed)
+
+    def num_samples(self):
+        '''
+        :return: the number of samples of an epoch, the flipped images included
+        '''
+        return len(self.measurements) * (2 if self.augment else 1)
+
+    def __len__(self):
+        '''
+        :return: the number of batches of an epoch
+        '''
+        return int(np.ceil(self.num_samples() / self.batch_size))
+
+    def epoch(self):
+        '''
+        :return: the indices of the samples of an epoch, in order, a sample i is the image i // 2 flipped if
+        i is odd with augmentation, else the image i
+        '''
+        indices = np.arange(self.num_samples())
+        if self.shuffle:
+            self.random.shuffle(indices)
+        return indices
+
+    def split(self, indices):
+        '''
+        :param indices: indices of the samples
+        :return: the index of the image of each sample, and whether it is flipped
+        '''
+        if self.augment:
+            return indices // 2, indices % 2 == 1
+        return indices, np.zeros(len(indices), bool)
+
+    def load_batch(self, indices):
+        '''
+        :param indices: indices of the samples of the batch
+        :return: the images and the steering angles of the batch
+        '''
+        images = np.empty((len(indices),) + self.image_shape, np.uint8)
+        sources, flips = self.split(indices)
+        for image, source, flip in zip(images, sources, flips):
+            bgr = cv2.imread(self.paths[source])
+            if bgr is None:
+                raise IOError('Cannot read image {}'.format(self.paths[source]))
+            if flip:
+                bgr = cv2.flip(bgr, 1)
+            cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=image)
+        measurements = self.measurements[sources]
+        measurements[flips] *= -1.0
+        return images, measurements
+
+    def batches(self):
+        '''
+        :return: the index arrays of the batches of the epochs, forever
+        '''
+        while True:
+            indices = self.epoch()
+            for offset in range(0, len(indices), self.batch_size):
+                yield indices[offset:offset + self.batch_size]
+
+    def __iter__(self):
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            pending = collections.deque()
+            for indices in self.batches():
+                pending.append(executor.submit(self.load_batch, indices))
+                if len(pending) > self.prefetch:
+                    yield pending.popleft().result()
@@ -0,0 +1,179 @@
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+
+import cv2
+import numpy as np
+
+from data_utils import read_csv, read_samples, StreamingLoader
+
+# rows removed from the top and the bottom of the images, as the Cropping2D layer of the model
+CROPPING = (50, 20)
+
+
+class DatasetStore():
+    '''
+    Images of a driving log decoded, cropped and converted to RGB once, in a uint8 file read as a memmap.
+
+    The manifest maps every image file to its row in the store, with the hash of its content, so a new
+    compilation only decodes the images that are not in the store yet. The rows of the samples of the
+    log and their steering angles are stored next to it.
+    '''
+    def __init__(self, directory):
+        '''
+        :param directory: directory of the store
+        '''
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, 'manifest.json')
+        self.images_path = os.path.join(directory, 'images.u8')
+        self.samples_path = os.path.join(directory, 'samples.npz')
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'cropping': list(CROPPING), 'shape': None, 'count': 0, 'files': {}}
+
+    def shape(self):
+        '''
+        :return: the shape of the stored images
+        '''
+        return tuple(self.manifest['shape'])
+
+    def images(self):
+        '''
+        :return: read-only memmap (count, height, width, 3) of the images
+        '''
+        return np.memmap(self.images_path, np.uint8, 'r', shape=(self.manifest['count'],) + self.shape())
+
+    def samples(self):
+        '''
+        :return: the row of the image of every sample of the log, and its steering angle
+        '''
+        with np.load(self.samples_path) as data:
+            return data['rows'], data['measurements']
+
+    def save_manifest(self):
+        path = self.manifest_path + '.tmp'
+        with open(path, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(path, self.manifest_path)
+
+
+def decode(data, cropping):
+    '''
+    :param data: bytes of a JPEG
+    :param cropping: rows removed from the top and the bottom
+    :return: the cropped RGB image
+    '''
+    bgr = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if bgr is None:
+        raise IOError('Cannot decode image')
+    top, bottom = cropping
+    return cv2.cvtColor(bgr[top:bgr.shape[0] - bottom], cv2.COLOR_BGR2RGB)
+
+
+def compile_dataset(log_path, image_path, directory, correction=0.4, workers=4):
+    '''
+    Add the images of a driving log to a store, the images already in it are not decoded again
+    :param log_path: path of driving_log.csv
+    :param image_path: directory of the images of the log
+    :param directory: directory of the store, created if needed
+    :param correction: correction of the steering angle of the left and right images
+    :param workers: number of threads decoding the images
+    :return: the store, and the number of images added
+    '''
+    os.makedirs(directory, exist_ok=True)
+    store = DatasetStore(directory)
+    manifest = store.manifest
+    files = manifest['files']
+    rows_of_hash = {entry['sha1']: entry['row'] for entry in files.values()}
+
+    paths, measurements = read_samples(read_csv(log_path), image_path, correction)
+    # images unknown to the manifest, or modified since they were added
+    changed = []
+    for path in dict.fromkeys(paths):
+        stat = os.stat(path)
+        entry = files.get(os.path.basename(path))
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            changed.append((path, stat))
+
+    # an interrupted compilation may have appended rows the manifest does not list
+    if os.path.exists(store.images_path) and manifest['shape'] is not None:
+        with open(store.images_path, 'r+b') as f:
+            f.truncate(manifest['count'] * int(np.prod(manifest['shape'])))
+
+    added = 0
+    cropping = tuple(manifest['cropping'])
+
+    def load(item):
+        path, stat = item
+        with open(path, 'rb') as f:
+            data = f.read()
+        sha1 = hashlib.sha1(data).hexdigest()
+        image = None if sha1 in rows_of_hash else decode(data, cropping)
+        return path, stat, sha1, image
+
+    with open(store.images_path, 'ab') as images, concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        # a chunk of images is decoded at a time, to bound the memory used
+        chunks = (changed[i:i + 256] for i in range(0, len(changed), 256))
+        for path, stat, sha1, image in (result for chunk in chunks for result in executor.map(load, chunk)):
+            if sha1 not in rows_of_hash:
+                if manifest['shape'] is None:
+                    manifest['shape'] = list(image.shape)
+                elif list(image.shape) != manifest['shape']:
+                    raise ValueError('Image {} is not of shape {}'.format(path, manifest['shape']))
+                images.write(np.ascontiguousarray(image).tobytes())
+                rows_of_hash[sha1] = manifest['count']
+                manifest['count'] += 1
+                added += 1
+            files[os.path.basename(path)] = {'sha1': sha1, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                                             'row': rows_of_hash[sha1]}
+
+    rows = np.array([files[os.path.basename(path)]['row'] for path in paths], np.int64)
+    np.savez(store.samples_path, rows=rows, measurements=measurements)
+    store.save_manifest()
+    return store, added
+
+
+class CachedLoader(StreamingLoader):
+    '''
+    Batches of StreamingLoader read from a DatasetStore instead of decoded from the JPEGs.
+
+    The images are cropped already, a batch is a gather of rows of the memmap, no image is decoded.
+    '''
+    def __init__(self, images, rows, measurements, augment=True, batch_size=32, shuffle=True, workers=2,
+                 prefetch=None, seed=None):
+        '''
+        :param images: memmap of the images of the store
+        :param rows: row of the image of each sample
+        :param measurements: steering angle of each sample
+        '''
+        super().__init__([], measurements, augment, batch_size, shuffle, workers, prefetch, images.shape[1:], seed)
+        self.images = images
+        self.rows = np.asarray(rows)
+
+    def load_batch(self, indices):
+        # sorted indices read the memmap mostly forward
+        sources, flips = self.split(np.sort(indices))
+        images = self.images[self.rows[sources]]
+        images[flips] = images[flips, :, ::-1]
+        measurements = self.measurements[sources]
+        measurements[flips] *= -1.0
+        return images, measurements
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile a driving log into a memory-mapped dataset.')
+    parser.add_argument('log', type=str, help='Path of driving_log.csv.')
+    parser.add_argument('images', type=str, help='Directory of the images of the log.')
+    parser.add_argument('output', type=str, help='Directory of the dataset, updated if it exists.')
+    parser.add_argument('--correction', type=float, default=0.4,
+                        help='Correction of the steering angle of the left and right images.')
+    parser.add_argument('--workers', type=int, default=4, help='Number of threads decoding the images.')
+    args = parser.parse_args()
+
+    store, added = compile_dataset(args.log, args.images, args.output, args.correction, args.workers)
+    print('{} images added, {} images of shape {} in {}'.format(added, store.manifest['count'], store.shape(),
+                                                                args.output))
@@ -1,8 +1,8 @@
 import argparse
 import base64
-from datetime import datetime
 import os
 import shutil
+import time
 
 import numpy as np
 import socketio
@@ -12,14 +12,22 @@ from PIL import Image
 from flask import Flask
 from io import BytesIO
 
-from keras.models import load_model
-import h5py
-from keras import __version__ as keras_version
+from artifact import artifact_metadata, is_artifact
+from numpy_engine import engine_preprocessor, load_engine
+from preprocessing import FramePreprocessor, artifact_preprocessor, is_headless
+from recorder import FrameRecorder
+from serving import InferenceServer
 
 sio = socketio.Server()
 app = Flask(__name__)
 model = None
 prev_image_array = None
+# inference thread of the --serve mode
+server = None
+# writer of the frames when an image folder is given
+recorder = None
+# preprocessing of the frames for a model exported by export.py
+preprocessor = None
 
 
 class SimplePIController:
@@ -46,11 +54,60 @@ class SimplePIController:
 controller = SimplePIController(0.1, 0.002)
 set_speed = 9
 controller.set_desired(set_speed)
+# speed controller of every client of the --serve mode
+controllers = {}
+
+
+def decode_image(imgString):
+    return np.asarray(Image.open(BytesIO(base64.b64decode(imgString))))
+
+
+def load_inference_model(model_path, use_numpy=False):
+    '''
+    :param use_numpy: if True, run the model with numpy_engine, Keras is not imported
+    :return: the model of a h5 file, or of an inference artifact written by export.py --optimize
+    '''
+    if use_numpy:
+        return load_engine(model_path)[0]
+    # Keras is imported only when it runs the model, it dominates the start time
+    if is_artifact(model_path):
+        from export import load_optimized
+        return load_optimized(model_path)[0]
+    from keras.models import load_model
+    return load_model(model_path)
+
+
+def load_predict(model_path, use_numpy=False):
+    '''
+    :return: the predict function of a batch, run once so that the first frame does not build it
+    '''
+    model = load_inference_model(model_path, use_numpy)
+    model.predict_on_batch(np.zeros((1,) + model.input_shape[1:], np.float32))
+    return model.predict_on_batch
+
+
+def send_client_control(sid, steering_angle, speed):
+    if sid not in controllers:
+        controllers[sid] = SimplePIController(0.1, 0.002)
+        controllers[sid].set_desired(set_speed)
+    throttle = controllers[sid].update(float(speed))
+    sio.emit(
+        "steer",
+        data={
+            'steering_angle': steering_angle.__str__(),
+            'throttle': throttle.__str__()
+        },
+        room=sid)
 
 
 @sio.on('telemetry')
 def telemetry(sid, data):
-    if data:
+    if data and server is not None:
+        server.submit(sid, data["image"], data["speed"])
+        if recorder is not None:
+            recorder.record(base64.b64decode(data["image"]), data["steering_angle"], data["throttle"],
+                            data["speed"])
+    elif data:
         # The current steering angle of the car
         steering_angle = data["steering_angle"]
         # The current throttle of the car
@@ -59,8 +116,13 @@ def telemetry(sid, data):
         speed = data["speed"]
         # The current image from the center camera of the car
         imgString = data["image"]
-        image = Image.open(BytesIO(base64.b64decode(imgString)))
-        image_array = np.asarray(image)
+        jpeg = base64.b64decode(imgString)
+        if preprocessor is not None:
+            # decoded, cropped and normalized for a model exported without these layers
+            image_array = preprocessor(jpeg)
+        else:
+            image = Image.open(BytesIO(jpeg))
+            image_array = np.asarray(image)
         steering_angle = float(model.predict(image_array[None, :, :, :], batch_size=1))
 
         throttle = controller.update(float(speed))
@@ -68,11 +130,9 @@ def telemetry(sid, data):
         print(steering_angle, throttle)
         send_control(steering_angle, throttle)
 
-        # save frame
-        if args.image_folder != '':
-            timestamp = datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
-            image_filename = os.path.join(args.image_folder, timestamp)
-            image.save('{}.jpg'.format(image_filename))
+        # save frame, the JPEG is written as received by the recorder threads
+        if recorder is not None:
+            recorder.record(jpeg, data["steering_angle"], data["throttle"], speed)
     else:
         # NOTE: DON'T EDIT THIS.
         sio.emit('manual', data={}, skip_sid=True)
@@ -84,6 +144,11 @@ def connect(sid, environ):
     send_control(0, 0)
 
 
+@sio.on('disconnect')
+def disconnect(sid):
+    controllers.pop(sid, None)
+
+
 def send_control(steering_angle, throttle):
     sio.emit(
         "steer",
@@ -99,7 +164,7 @@ if __name__ == '__main__':
     parser.add_argument(
         'model',
         type=str,
-        help='Path to model h5 file. Model should be on the same path.'
+        help='Path to model h5 file, or .npz artifact of export.py --optimize. Model should be on the same path.'
     )
     parser.add_argument(
         'image_folder',
@@ -108,18 +173,69 @@ if __name__ == '__main__':
         default='',
         help='Path to image folder. This is where the images from the run will be saved.'
     )
+    parser.add_argument(
+        '--serve',
+        action='store_true',
+        help='Predict in a dedicated thread on the newest frame of every client, in batches, '
+             'and report the latencies.'
+    )
+    parser.add_argument(
+        '--numpy',
+        action='store_true',
+        help='Run the model with NumPy only, from the h5 file or the .npz artifact, without Keras.'
+    )
+    parser.add_argument(
+        '--archive',
+        action='store_true',
+        help='Record the frames in chunk files with an index of the telemetry, instead of a file per frame.'
+    )
+    parser.add_argument(
+        '--record_queue',
+        type=int,
+        default=64,
+        help='Number of frames waiting to be written, the next frames are not recorded when it is full.'
+    )
+    parser.add_argument(
+        '--report_every',
+        type=int,
+        default=100,
+        help='Number of frames between latency reports of the --serve mode.'
+    )
     args = parser.parse_args()
 
-    # check that model Keras version is same as local Keras version
-    f = h5py.File(args.model, mode='r')
-    model_version = f.attrs.get('keras_version')
-    keras_version = str(keras_version).encode('utf8')
+    if args.numpy:
+        print('NumPy inference, frames preprocessed before inference')
+        preprocessor = engine_preprocessor(args.model)
+    elif is_artifact(args.model):
+        print('Inference artifact, frames preprocessed before inference')
+        preprocessor = artifact_preprocessor(artifact_metadata(args.model))
+    else:
+        import h5py
+        from keras import __version__ as keras_version
 
-    if model_version != keras_version:
-        print('You are using Keras version ', keras_version,
-              ', but the model was built using ', model_version)
+        # check that model Keras version is same as local Keras version
+        f = h5py.File(args.model, mode='r')
+        model_version = f.attrs.get('keras_version')
+        keras_version = str(keras_version).encode('utf8')
 
-    model = load_model(args.model)
+        if model_version != keras_version:
+            print('You are using Keras version ', keras_version,
+                  ', but the model was built using ', model_version)
+
+        if is_headless(f):
+            print('Model without cropping and normalization layers, frames preprocessed before inference')
+            preprocessor = FramePreprocessor()
+
+    if args.serve:
+        start = time.perf_counter()
+        server = InferenceServer(lambda: load_predict(args.model, args.numpy), preprocessor or decode_image,
+                                 send_client_control, args.report_every)
+        server.start()
+        print('Model ready in {:.2f} s'.format(time.perf_counter() - start))
+    else:
+        start = time.perf_counter()
+        model = load_inference_model(args.model, args.numpy)
+        print('Model ready in {:.2f} s'.format(time.perf_counter() - start))
 
     if args.image_folder != '':
         print("Creating image folder at {}".format(args.image_folder))
@@ -128,6 +244,7 @@ if __name__ == '__main__':
         else:
             shutil.rmtree(args.image_folder)
             os.makedirs(args.image_folder)
+        recorder = FrameRecorder(args.image_folder, archive=args.archive, queue_size=args.record_queue)
         print("RECORDING THIS RUN ...")
     else:
         print("NOT RECORDING THIS RUN ...")
@@ -136,4 +253,9 @@ if __name__ == '__main__':
     app = socketio.Middleware(sio, app)
 
     # deploy as an eventlet WSGI server
-    eventlet.wsgi.server(eventlet.listen(('', 4567)), app)
+    try:
+        eventlet.wsgi.server(eventlet.listen(('', 4567)), app)
+    finally:
+        if recorder is not None:
+            recorder.close()
+            print('{} frames recorded, {} dropped'.format(recorder.written, recorder.dropped))
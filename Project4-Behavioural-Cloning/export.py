@@ -0,0 +1,118 @@
+import argparse
+import os
+
+import cv2
+import numpy as np
+from keras.models import load_model
+
+from artifact import fold_normalization, load_artifact, same_padding, save_artifact
+from data_utils import read_csv, read_samples
+from model import Model, split_data
+from preprocessing import CROPPING, FramePreprocessor, artifact_preprocessor
+
+
+def export_headless(model, preprocessor=None):
+    '''
+    Model without its Cropping2D and Lambda layers, for frames preprocessed by FramePreprocessor
+    :param model: trained Keras model
+    :param preprocessor: FramePreprocessor giving the input shape of the model
+    :return: the model with the same weights
+    '''
+    preprocessor = preprocessor or FramePreprocessor()
+    headless = Model(preprocessor.shape(*model.input_shape[1:3]), crop=False, normalize=False)
+    # the removed layers have no weights
+    headless.set_weights(model.get_weights())
+    return headless
+
+
+def export_optimized(model, path, dtype='float32'):
+    '''
+    Write the inference artifact of a trained model: no dropout, the normalization folded into the first
+    convolution, and the kernels stored as dtype
+    :param model: trained Keras model
+    :param path: path of the .npz artifact
+    :param dtype: 'float32', 'float16' or 'int8'
+    '''
+    height, width = model.input_shape[1:3]
+    cropped = height - sum(CROPPING)
+    # the first convolution pads as a 'same' convolution of kernel 5 and stride 2
+    padding = (same_padding(cropped, 5, 2), same_padding(width, 5, 2))
+    weights = model.get_weights()
+    weights[0], weights[1] = fold_normalization(weights[0], weights[1])
+    input_shape = (cropped + sum(padding[0]), width + sum(padding[1]), 3)
+    save_artifact(path, weights, input_shape, CROPPING, padding, dtype)
+
+
+def load_optimized(path):
+    '''
+    :return: the Keras model of an artifact, and the FramePreprocessor of its frames
+    '''
+    weights, metadata = load_artifact(path)
+    model = Model(tuple(metadata['input_shape']), crop=False, normalize=False, dropout=False, padded=True)
+    model.set_weights(weights)
+    return model, artifact_preprocessor(metadata)
+
+
+def validate(model, optimized, preprocessor, paths, batch_size=64):
+    '''
+    Steering angles of the optimized model against the trained model
+    :param model: trained Keras model, on the RGB frames
+    :param optimized: function of a batch of preprocessed frames, returning the steering angles
+    :param preprocessor: preprocessing of the JPEG frames for optimized
+    :param paths: paths of the held-out frames
+    :return: the absolute differences of the steering angles
+    '''
+    differences = []
+    for offset in range(0, len(paths), batch_size):
+        batch_paths = paths[offset:offset + batch_size]
+        frames = np.stack([cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB) for path in batch_paths])
+        preprocessed = None
+        for i, path in enumerate(batch_paths):
+            with open(path, 'rb') as f:
+                frame = preprocessor(f.read())
+            if preprocessed is None:
+                preprocessed = np.empty((len(batch_paths),) + frame.shape, np.float32)
+            preprocessed[i] = frame
+        expected = np.asarray(model.predict_on_batch(frames)).reshape(-1)
+        steering_angles = np.asarray(optimized(preprocessed)).reshape(-1)
+        differences.append(np.abs(steering_angles - expected))
+    return np.concatenate(differences)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the model for drive.py.')
+    parser.add_argument('model', type=str, help='Path of the trained model h5 file.')
+    parser.add_argument('output', type=str,
+                        help='Path of the exported model, a .npz inference artifact with --optimize, else a h5 file.')
+    parser.add_argument('--optimize', action='store_true',
+                        help='Write an inference artifact without dropout, with the normalization folded into '
+                             'the first convolution.')
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16', 'int8'],
+                        help='Storage type of the weights of the artifact.')
+    parser.add_argument('--data', type=str, default='../2016',
+                        help='Directory of driving_log.csv and IMG, its validation lines are the held-out frames.')
+    parser.add_argument('--samples', type=int, default=500, help='Number of held-out frames validated.')
+    parser.add_argument('--tolerance', type=float, default=0.01,
+                        help='Largest difference of steering angle accepted on the held-out frames.')
+    args = parser.parse_args()
+
+    model = load_model(args.model)
+    if not args.optimize:
+        export_headless(model).save(args.output)
+        print('Model without cropping and normalization layers written to {}'.format(args.output))
+    else:
+        if not args.output.endswith('.npz'):
+            parser.error('the artifact must be a .npz file')
+        export_optimized(model, args.output, args.dtype)
+        print('{} inference artifact written to {}'.format(args.dtype, args.output))
+
+        optimized, preprocessor = load_optimized(args.output)
+        _, validation_lines = split_data(read_csv(os.path.join(args.data, 'driving_log.csv')), ratio=0.2)
+        paths, _ = read_samples(validation_lines, os.path.join(args.data, 'IMG'))
+        paths = paths[::max(1, len(paths) // args.samples)][:args.samples]
+        differences = validate(model, optimized.predict_on_batch, preprocessor, paths)
+        print('Steering difference on {} held-out frames: mean {:.2e}, max {:.2e}'.format(
+            len(differences), differences.mean(), differences.max()))
+        if differences.max() > args.tolerance:
+            os.remove(args.output)
+            raise SystemExit('The artifact exceeds the tolerance {} and was removed'.format(args.tolerance))
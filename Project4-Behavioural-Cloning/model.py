@@ -1,73 +1,49 @@
-import csv
-import os
-import cv2
-import numpy as np
 from keras.models import Sequential
 from keras.models import Model
-import matplotlib.pyplot as plt
 from keras.layers import Flatten, Lambda, Cropping2D, Convolution2D, Dense, Dropout
-import sklearn
+import argparse
 import math
+import os
 
+from data_utils import read_csv, read_samples, StreamingLoader
+from dataset import compile_dataset, CachedLoader
 
 
-def read_csv(path):
-    '''
-    :param path: path stores the csv file
-    :return: lines of the csv
-    '''
-    lines = []
-    with open(path) as csvfile:
-        reader = csv.reader(csvfile)
-        for line in reader:
-            lines.append(line)
-    return lines
 
-
-def read_images(csv_lines, image_path, correction=0.4):
-    '''
-    :param csv_lines: lines in csv file
-    :param image_path: path of images
-    :param correction: correction to create adjusted steering measurements
-    :return: images and steering angles
-    '''
-    images = []
-    measurements = []
-    for line in csv_lines:
-        for i in range(3):
-            source_path = line[i]
-            filename = source_path.split('/')[-1]
-            current_path = os.path.join(image_path, filename)
-            image = cv2.imread(current_path)
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            images.append(image)
-        measurement = line[3]  # center
-        measurements.append(measurement)
-        measurements.append(float(measurement) + correction)  # left image
-        measurements.append(float(measurement) - correction)  # right image
-    return images, measurements
-
-
-def Model(input_shape):
+def Model(input_shape, crop=True, normalize=True, dropout=True, padded=False):
     '''
     :param input_shape: shape of original image
+    :param crop: if False, the images are cropped already, e.g. read from a compiled dataset
+    :param normalize: if False, the images are normalized already, e.g. by preprocessing.FramePreprocessor
+    :param dropout: if False, the model is only used for inference and has no dropout layers
+    :param padded: if True, the images are padded for the first convolution already, as for the
+    artifacts of export.py
     :return: model
     '''
     model = Sequential()
-    model.add(Cropping2D(cropping=((50, 20), (0, 0)), input_shape=input_shape))  #
-    model.add(Lambda(lambda x: x / 255.0 - 0.5))
-    model.add(Convolution2D(24, 5, 5, border_mode="same", subsample=(2, 2), activation="relu"))
+    if crop:
+        model.add(Cropping2D(cropping=((50, 20), (0, 0)), input_shape=input_shape))  #
+        if normalize:
+            model.add(Lambda(lambda x: x / 255.0 - 0.5))
+    elif normalize:
+        model.add(Lambda(lambda x: x / 255.0 - 0.5, input_shape=input_shape))
+    first_layer = {} if crop or normalize else {'input_shape': input_shape}
+    model.add(Convolution2D(24, 5, 5, border_mode="valid" if padded else "same", subsample=(2, 2),
+                            activation="relu", **first_layer))
     model.add(Convolution2D(36, 5, 5, border_mode="same", subsample=(2, 2), activation="relu"))
     model.add(Convolution2D(48, 5, 5, border_mode="valid", subsample=(2, 2), activation="relu"))
     model.add(Convolution2D(64, 3, 3, border_mode="valid", activation='relu'))
     model.add(Convolution2D(64, 3, 3, border_mode="valid", activation='relu'))
     model.add(Flatten())
     model.add(Dense(100))
-    model.add(Dropout(0.3))
+    if dropout:
+        model.add(Dropout(0.3))
     model.add(Dense(50))
-    model.add(Dropout(0.3))
+    if dropout:
+        model.add(Dropout(0.3))
     model.add(Dense(10))
-    model.add(Dropout(0.3))
+    if dropout:
+        model.add(Dropout(0.3))
     model.add(Dense(1))
     return model
 
@@ -88,74 +64,81 @@ def split_data(dataset, ratio=0.2):
     return training_files, validation_files
 
 
-def augmentation(x, y):
-    '''
-    :param x: images
-    :param y: measurements
-    :return: augmented data
-    '''
-    x_augmented = []
-    y_augmented = []
-    for image, measurement in zip(x, y):
-        x_augmented.append(image)
-        y_augmented.append(measurement)
-        x_augmented.append(cv2.flip(image, 1))
-        y_augmented.append(-1.0 * float(measurement))
-    return x_augmented, y_augmented
-
-
 def generator(dataset, image_path, augment=True, batch_size=32):
     '''
     :param dataset: dataset
     :param image_path: path of images
     :param augmentation: if True, apply data augmentation
-    :return:
+    :return: batches of images decoded on the fly, shuffled every epoch
     '''
-    x, y = read_images(dataset, image_path)
-    if augment:
-        x, y = augmentation(x, y)
-    num_dataset = len(x)
-    print(num_dataset)
-    while 1:
-        for offset in range(0, num_dataset, batch_size):
-            batch_x = x[offset:offset+batch_size]
-            batch_y = y[offset:offset+batch_size]
-            x_train, y_train = np.array(batch_x), np.array(batch_y)
-            yield sklearn.utils.shuffle(x_train, y_train)
-
-
-lines = read_csv("../2016/driving_log.csv")
-training_files, validation_files = split_data(lines, ratio=0.2)
-train_generator = generator(training_files, "../2016/IMG", augment=True, batch_size=32)
-validation_generator = generator(validation_files, "../2016/IMG", augment=True, batch_size=32)
-
-batch_size = 32
-input_shape = (160, 320, 3)
-model = Model(input_shape)
-model.compile(loss='mse', optimizer='adam')
-
-history_object = model.fit_generator(train_generator,
-                    steps_per_epoch=math.ceil(len(training_files) / batch_size),
-                    validation_data=validation_generator,
-                    validation_steps=math.ceil(len(validation_files) / batch_size),
-                    epochs=10, verbose=1)
-model.save('model.h5')
-
-# print the keys contained in the history object
-print(history_object.history.keys())
-
-# plot the training and validation loss for each epoch
-plt.plot(history_object.history['loss'])
-plt.plot(history_object.history['val_loss'])
-plt.title('model mean squared error loss')
-plt.ylabel('mean squared error loss')
-plt.xlabel('epoch')
-plt.legend(['training set', 'validation set'], loc='upper right')
-plt.savefig('loss.jpg')
-
-
-
-
-
+    paths, measurements = read_samples(dataset, image_path)
+    loader = StreamingLoader(paths, measurements, augment=augment, batch_size=batch_size)
+    print(loader.num_samples())
+    return iter(loader)
 
 
+def cached_generators(store, num_training_lines, augment=True, batch_size=32):
+    '''
+    :param store: DatasetStore of the driving log
+    :param num_training_lines: number of lines of the log used for training, the others for validation
+    :return: training and validation batches sliced from the memmap of the store
+    '''
+    images = store.images()
+    rows, measurements = store.samples()
+    # three samples per line, center, left and right
+    split = 3 * num_training_lines
+    train_loader = CachedLoader(images, rows[:split], measurements[:split], augment=augment, batch_size=batch_size)
+    validation_loader = CachedLoader(images, rows[split:], measurements[split:], augment=augment,
+                                     batch_size=batch_size)
+    return iter(train_loader), iter(validation_loader)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train the steering model.')
+    parser.add_argument('--data', type=str, default='../2016', help='Directory of driving_log.csv and IMG.')
+    parser.add_argument('--cache', type=str, default='',
+                        help='If set, directory of the compiled dataset, updated with the new lines of the log.')
+    args = parser.parse_args()
+    # only used to plot the loss, drive.py imports Model without it
+    import matplotlib.pyplot as plt
+
+    lines = read_csv(os.path.join(args.data, 'driving_log.csv'))
+    training_files, validation_files = split_data(lines, ratio=0.2)
+    input_shape = (160, 320, 3)
+    if args.cache != '':
+        store, _ = compile_dataset(os.path.join(args.data, 'driving_log.csv'), os.path.join(args.data, 'IMG'),
+                                   args.cache)
+        train_generator, validation_generator = cached_generators(store, len(training_files), batch_size=32)
+        model = Model(store.shape(), crop=False)
+    else:
+        train_generator = generator(training_files, os.path.join(args.data, 'IMG'), augment=True, batch_size=32)
+        validation_generator = generator(validation_files, os.path.join(args.data, 'IMG'), augment=True,
+                                         batch_size=32)
+        model = Model(input_shape)
+
+    batch_size = 32
+    model.compile(loss='mse', optimizer='adam')
+
+    history_object = model.fit_generator(train_generator,
+                        steps_per_epoch=math.ceil(len(training_files) / batch_size),
+                        validation_data=validation_generator,
+                        validation_steps=math.ceil(len(validation_files) / batch_size),
+                        epochs=10, verbose=1)
+    if args.cache != '':
+        # the cropping and normalization layers have no weights, drive.py gets the full model
+        trained = model
+        model = Model(input_shape)
+        model.set_weights(trained.get_weights())
+    model.save('model.h5')
+
+    # print the keys contained in the history object
+    print(history_object.history.keys())
+
+    # plot the training and validation loss for each epoch
+    plt.plot(history_object.history['loss'])
+    plt.plot(history_object.history['val_loss'])
+    plt.title('model mean squared error loss')
+    plt.ylabel('mean squared error loss')
+    plt.xlabel('epoch')
+    plt.legend(['training set', 'validation set'], loc='upper right')
+    plt.savefig('loss.jpg')
@@ -0,0 +1,189 @@
+import argparse
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from artifact import artifact_metadata, fold_normalization, is_artifact, load_artifact, same_padding
+from preprocessing import CROPPING, artifact_preprocessor
+
+# (kernel size, stride, padding) of the convolutions of model.Model, the frames are padded for the first one
+CONVOLUTIONS = [(5, 2, 'valid'), (5, 2, 'same'), (5, 2, 'valid'), (3, 1, 'valid'), (3, 1, 'valid')]
+
+
+def load_h5_weights(path):
+    '''
+    :param path: h5 file of a model trained by model.py, with or without the cropping and normalization layers
+    :return: the weights of the layers in order, as model.get_weights() returns them
+    '''
+    # only needed for h5 files, the artifacts are read with numpy
+    import h5py
+    weights = []
+    with h5py.File(path, mode='r') as f:
+        group = f['model_weights'] if 'model_weights' in f else f
+        for layer_name in group.attrs['layer_names']:
+            layer = group[layer_name]
+            for weight_name in layer.attrs['weight_names']:
+                weights.append(np.array(layer[weight_name], np.float32))
+    return weights
+
+
+def engine_metadata(height=160, width=320):
+    '''
+    :return: the metadata of the artifact of a h5 model, see export.export_optimized
+    '''
+    cropped = height - sum(CROPPING)
+    padding = [list(same_padding(cropped, 5, 2)), list(same_padding(width, 5, 2))]
+    return {'cropping': list(CROPPING), 'padding': padding, 'pad_value': 127.5,
+            'input_shape': [cropped + sum(padding[0]), width + sum(padding[1]), 3]}
+
+
+class ConvolutionPlan():
+    '''
+    Buffers of a convolution for an input shape: the padded input, the im2col matrix and the output
+    '''
+    def __init__(self, input_shape, kernel, stride, padding, channels):
+        '''
+        :param input_shape: (batch, height, width, channels) of the input
+        :param kernel: kernel size
+        :param stride: stride
+        :param padding: 'same' or 'valid'
+        :param channels: number of output channels
+        '''
+        batch, height, width, depth = input_shape
+        if padding == 'same':
+            self.pad_rows = same_padding(height, kernel, stride)
+            self.pad_cols = same_padding(width, kernel, stride)
+        else:
+            self.pad_rows = self.pad_cols = (0, 0)
+        padded_height = height + sum(self.pad_rows)
+        padded_width = width + sum(self.pad_cols)
+        self.rows = (padded_height - kernel) // stride + 1
+        self.cols = (padded_width - kernel) // stride + 1
+        self.kernel = kernel
+        self.stride = stride
+        # input with its border of zeros, filled once
+        self.padded = np.zeros((batch, padded_height, padded_width, depth), np.float32) if padding == 'same' else None
+        # one row of kernel * kernel * depth values per output pixel
+        self.columns = np.empty((batch, self.rows, self.cols, kernel, kernel, depth), np.float32)
+        self.output = np.empty((batch, self.rows, self.cols, channels), np.float32)
+
+    def run(self, x, weights, bias):
+        '''
+        :param x: input of the convolution
+        :param weights: kernel reshaped to (kernel * kernel * depth, channels)
+        :return: the output buffer, after ReLU
+        '''
+        if self.padded is not None:
+            top, left = self.pad_rows[0], self.pad_cols[0]
+            self.padded[:, top:top + x.shape[1], left:left + x.shape[2]] = x
+            x = self.padded
+        batch, _, _, depth = x.shape
+        s0, s1, s2, s3 = x.strides
+        windows = as_strided(x, (batch, self.rows, self.cols, self.kernel, self.kernel, depth),
+                             (s0, s1 * self.stride, s2 * self.stride, s1, s2, s3), writeable=False)
+        np.copyto(self.columns, windows)
+        columns = self.columns.reshape(-1, weights.shape[0])
+        output = self.output.reshape(-1, weights.shape[1])
+        np.matmul(columns, weights, out=output)
+        output += bias
+        np.maximum(output, 0, out=output)
+        return self.output
+
+
+class NumpyEngine():
+    '''
+    Inference of the steering network with NumPy only, no Keras or TensorFlow.
+
+    The weights come from an artifact of export.py --optimize, or from a h5 file whose normalization is
+    folded into the first convolution at load time, so both take the padded frames of artifact_preprocessor.
+    The convolutions are matrix products of the im2col matrices of their inputs, and every buffer is
+    allocated once per batch size.
+    '''
+    def __init__(self, weights, metadata):
+        '''
+        :param weights: kernels and biases of the layers in order, the normalization folded into the first one
+        :param metadata: metadata of the artifact
+        '''
+        self.metadata = metadata
+        # as the input_shape of a Keras model, the batch size first
+        self.input_shape = (None,) + tuple(metadata['input_shape'])
+        # kernels as (kernel * kernel * depth, channels) matrices
+        self.kernels = [np.ascontiguousarray(kernel.reshape(-1, kernel.shape[-1]), np.float32)
+                        for kernel in weights[0::2]]
+        self.biases = [np.asarray(bias, np.float32) for bias in weights[1::2]]
+        # buffers of every batch size seen
+        self.plans = {}
+
+    def plan(self, batch):
+        if batch not in self.plans:
+            shape = (batch,) + self.input_shape[1:]
+            convolutions = []
+            for (kernel, stride, padding), bias in zip(CONVOLUTIONS, self.biases):
+                convolutions.append(ConvolutionPlan(shape, kernel, stride, padding, len(bias)))
+                shape = convolutions[-1].output.shape
+            dense = [np.empty((batch, len(bias)), np.float32) for bias in self.biases[len(CONVOLUTIONS):]]
+            self.plans[batch] = (convolutions, dense)
+        return self.plans[batch]
+
+    def predict_on_batch(self, frames):
+        '''
+        :param frames: array (batch, height, width, 3) of frames of artifact_preprocessor
+        :return: the steering angles, array (batch, 1) overwritten by the next batch of the same size
+        '''
+        frames = np.asarray(frames, np.float32)
+        if frames.shape[1:] != self.input_shape[1:]:
+            raise ValueError('Frames of shape {} expected, got {}'.format(self.input_shape[1:], frames.shape[1:]))
+        convolutions, dense = self.plan(len(frames))
+        x = frames
+        for layer, plan in enumerate(convolutions):
+            x = plan.run(x, self.kernels[layer], self.biases[layer])
+        x = x.reshape(len(frames), -1)
+        # the dense layers have no activation
+        for layer, output in enumerate(dense, len(convolutions)):
+            np.matmul(x, self.kernels[layer], out=output)
+            output += self.biases[layer]
+            x = output
+        return x
+
+    def predict(self, frames, batch_size=None):
+        return self.predict_on_batch(frames)
+
+
+def load_engine(path):
+    '''
+    :param path: .npz artifact of export.py --optimize, or h5 file of model.py
+    :return: the engine, and the FramePreprocessor of its frames
+    '''
+    if is_artifact(path):
+        weights, metadata = load_artifact(path)
+    else:
+        weights = load_h5_weights(path)
+        weights[0], weights[1] = fold_normalization(weights[0], weights[1])
+        metadata = engine_metadata()
+    return NumpyEngine(weights, metadata), artifact_preprocessor(metadata)
+
+
+def engine_preprocessor(path):
+    '''
+    :return: the FramePreprocessor of the frames of the engine of a model file, without loading the weights
+    '''
+    return artifact_preprocessor(artifact_metadata(path) if is_artifact(path) else engine_metadata())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the NumPy inference of the steering network.')
+    parser.add_argument('model', type=str, help='Path of the .npz artifact or h5 file.')
+    parser.add_argument('--batch_size', type=int, default=1, help='Number of frames of a batch.')
+    parser.add_argument('--repeat', type=int, default=100, help='Number of timed batches.')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    engine, _ = load_engine(args.model)
+    print('Loaded in {:.1f} ms'.format(1000 * (time.perf_counter() - start)))
+    frames = np.random.uniform(0, 255, (args.batch_size,) + engine.input_shape[1:]).astype(np.float32)
+    engine.predict_on_batch(frames)
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        engine.predict_on_batch(frames)
+    print('{:.2f} ms per batch of {}'.format(1000 * (time.perf_counter() - start) / args.repeat, args.batch_size))
@@ -0,0 +1,121 @@
+import base64
+import json
+
+import cv2
+import numpy as np
+
+# rows removed from the top and the bottom of the frames by the Cropping2D layer of the model
+CROPPING = (50, 20)
+
+# reduced decoding of cv2, the JPEG is downscaled in the DCT domain
+REDUCED_DECODE = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4,
+                  8: cv2.IMREAD_REDUCED_COLOR_8}
+
+
+class FramePreprocessor():
+    '''
+    Telemetry frames decoded, cropped and normalized as the first layers of the model do, before inference.
+
+    The JPEG is decoded by cv2 without PIL, the rows the model crops are never converted, and the
+    normalized frame is written into a buffer allocated once per frame size, so a model exported without
+    its Cropping2D and Lambda layers gets the same input as the full model. For an artifact with the
+    normalization folded into its first convolution, the pixels are not normalized but written inside a
+    border of padding. The frame returned is overwritten by the next call.
+    '''
+    def __init__(self, cropping=CROPPING, scale=1, normalize=True, padding=((0, 0), (0, 0)), pad_value=0.):
+        '''
+        :param cropping: rows removed from the top and the bottom, at full resolution
+        :param scale: 1, 2, 4 or 8, downscaling of the JPEG decoding, for models trained on downscaled frames
+        :param normalize: if False, the frames keep their pixel values
+        :param padding: ((top, bottom), (left, right)) border added around the cropped frame
+        :param pad_value: value of the border
+        '''
+        self.cropping = cropping
+        self.scale = scale
+        self.flags = REDUCED_DECODE[scale]
+        self.normalize = normalize
+        self.padding = padding
+        self.pad_value = pad_value
+        # RGB buffer of the cropped frame, output buffer with its border, and view inside the border
+        self.rgb = None
+        self.output = None
+        self.inside = None
+
+    def reduced(self, size):
+        '''
+        :return: the size of a dimension decoded with the downscaling, rounded up as cv2 does
+        '''
+        return -(-size // self.scale)
+
+    def crop_rows(self):
+        '''
+        :return: the rows removed from the top and the bottom of the decoded frame
+        '''
+        return tuple(rows // self.scale for rows in self.cropping)
+
+    def shape(self, height=160, width=320):
+        '''
+        :return: the shape of the preprocessed frames of a frame size
+        '''
+        top, bottom = self.crop_rows()
+        (pad_top, pad_bottom), (pad_left, pad_right) = self.padding
+        return (self.reduced(height) - top - bottom + pad_top + pad_bottom,
+                self.reduced(width) + pad_left + pad_right, 3)
+
+    def __call__(self, imgString):
+        '''
+        :param imgString: base64 JPEG of a telemetry message, or JPEG bytes
+        :return: the cropped RGB frame as float32, normalized to [-0.5, 0.5] if normalize
+        '''
+        jpeg = base64.b64decode(imgString) if isinstance(imgString, str) else imgString
+        bgr = cv2.imdecode(np.frombuffer(jpeg, np.uint8), self.flags)
+        if bgr is None:
+            raise IOError('Cannot decode frame')
+        top, bottom = self.crop_rows()
+        cropped = bgr[top:bgr.shape[0] - bottom]
+        (pad_top, _), (pad_left, _) = self.padding
+        if self.rgb is None or self.rgb.shape != cropped.shape:
+            self.rgb = np.empty(cropped.shape, np.uint8)
+            # the border is filled once
+            self.output = np.full(self.shape(bgr.shape[0] * self.scale, bgr.shape[1] * self.scale), self.pad_value,
+                                  np.float32)
+            self.inside = self.output[pad_top:pad_top + cropped.shape[0], pad_left:pad_left + cropped.shape[1]]
+        cv2.cvtColor(cropped, cv2.COLOR_BGR2RGB, dst=self.rgb)
+        if self.normalize:
+            # same operations as the Lambda layer, x / 255.0 - 0.5
+            np.divide(self.rgb, np.float32(255.0), out=self.inside)
+            np.subtract(self.inside, np.float32(0.5), out=self.inside)
+        else:
+            np.copyto(self.inside, self.rgb)
+        return self.output
+
+
+def artifact_preprocessor(metadata):
+    '''
+    :param metadata: metadata of an inference artifact, see artifact.py
+    :return: the FramePreprocessor of the frames of the artifact
+    '''
+    return FramePreprocessor(tuple(metadata['cropping']), normalize=False,
+                             padding=tuple(tuple(pad) for pad in metadata['padding']),
+                             pad_value=metadata['pad_value'])
+
+
+def model_layers(h5_file):
+    '''
+    :param h5_file: h5py File of a saved Keras model
+    :return: the configurations of the layers of the model
+    '''
+    model_config = h5_file.attrs.get('model_config')
+    if isinstance(model_config, bytes):
+        model_config = model_config.decode('utf8')
+    config = json.loads(model_config)['config']
+    # Sequential configurations are a list of layers, or a dict with the layers since Keras 2.2
+    return config['layers'] if isinstance(config, dict) else config
+
+
+def is_headless(h5_file):
+    '''
+    :return: True if the model was exported without its cropping and normalization layers
+    '''
+    layers = [layer for layer in model_layers(h5_file) if layer['class_name'] != 'InputLayer']
+    return layers[0]['class_name'] not in ('Cropping2D', 'Lambda')
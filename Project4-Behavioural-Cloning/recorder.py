@@ -0,0 +1,168 @@
+import csv
+from datetime import datetime
+import os
+import queue
+import threading
+
+import cv2
+import numpy as np
+
+# columns of the index of an archive
+INDEX_FIELDS = ['timestamp', 'chunk', 'offset', 'length', 'steering_angle', 'throttle', 'speed']
+
+
+class FrameRecorder():
+    '''
+    Recording of the frames seen by drive.py, off the telemetry handler.
+
+    record() only queues the JPEG bytes received from the simulator, background threads write them as
+    they are, without decoding and encoding them again. When the queue is full the frame is dropped,
+    the steering is never delayed by the disk. The frames are written either one file per frame, with
+    the names video.py expects, or in an append-only archive of chunk files of concatenated JPEGs and
+    an index.csv of their positions and telemetry.
+    '''
+    def __init__(self, folder, archive=False, queue_size=64, workers=2, chunk_frames=1000):
+        '''
+        :param folder: directory of the recording
+        :param archive: if True write an archive, else a JPEG file per frame
+        :param queue_size: number of frames waiting to be written before frames are dropped
+        :param workers: number of writer threads of the JPEG files, an archive has one writer
+        :param chunk_frames: number of frames of a chunk file of an archive
+        '''
+        self.folder = folder
+        self.archive = archive
+        self.chunk_frames = chunk_frames
+        self.frames = queue.Queue(maxsize=queue_size)
+        # frames written and frames dropped because the queue was full
+        self.written = 0
+        self.dropped = 0
+        # written is counted by every writer thread
+        self.lock = threading.Lock()
+        # chunk file, index file and number of frames of the archive
+        self.chunk = None
+        self.index = None
+        self.count = 0
+        # timestamp of the last frame, and number of frames with the same timestamp
+        self.last_timestamp = None
+        self.repeat = 0
+        if archive:
+            self.index_file = open(os.path.join(folder, 'index.csv'), 'w', newline='')
+            self.index = csv.writer(self.index_file)
+            self.index.writerow(INDEX_FIELDS)
+            workers = 1
+        self.writers = [threading.Thread(target=self.write_frames, daemon=True) for _ in range(workers)]
+        for writer in self.writers:
+            writer.start()
+
+    def record(self, jpeg, steering_angle=None, throttle=None, speed=None):
+        '''
+        Queue a frame, never blocks
+        :param jpeg: bytes of the JPEG image, as decoded from the base64 string of the telemetry
+        :return: False if the frame is dropped
+        '''
+        timestamp = datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
+        # frames of the same millisecond get a suffix, sorted after the first one
+        if timestamp == self.last_timestamp:
+            self.repeat += 1
+            timestamp = '{}_{:04d}'.format(timestamp, self.repeat)
+        else:
+            self.last_timestamp = timestamp
+            self.repeat = 0
+        try:
+            self.frames.put_nowait((timestamp, jpeg, steering_angle, throttle, speed))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def write_frames(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            if self.archive:
+                self.write_archive(*frame)
+            else:
+                timestamp, jpeg = frame[:2]
+                with open(os.path.join(self.folder, '{}.jpg'.format(timestamp)), 'wb') as f:
+                    f.write(jpeg)
+            with self.lock:
+                self.written += 1
+
+    def write_archive(self, timestamp, jpeg, steering_angle, throttle, speed):
+        if self.count % self.chunk_frames == 0:
+            if self.chunk is not None:
+                self.chunk.close()
+            self.chunk = open(os.path.join(self.folder, chunk_name(self.count // self.chunk_frames)), 'ab')
+            self.index_file.flush()
+        offset = self.chunk.tell()
+        self.chunk.write(jpeg)
+        self.index.writerow([timestamp, self.count // self.chunk_frames, offset, len(jpeg), steering_angle, throttle,
+                             speed])
+        self.count += 1
+
+    def close(self):
+        '''
+        Write the queued frames and close the files
+        '''
+        for _ in self.writers:
+            self.frames.put(None)
+        for writer in self.writers:
+            writer.join()
+        if self.chunk is not None:
+            self.chunk.close()
+        if self.index is not None:
+            self.index_file.close()
+
+
+def chunk_name(number):
+    return 'chunk_{:05d}.bin'.format(number)
+
+
+def is_archive(folder):
+    return os.path.exists(os.path.join(folder, 'index.csv'))
+
+
+class ArchiveReader():
+    '''
+    Frames of an archive written by FrameRecorder, in recording order
+    '''
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, 'index.csv')) as f:
+            self.rows = list(csv.DictReader(f))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        '''
+        :return: the bytes of the JPEG and the index row of every frame
+        '''
+        chunk = None
+        number = None
+        try:
+            for row in self.rows:
+                if row['chunk'] != number:
+                    if chunk is not None:
+                        chunk.close()
+                    number = row['chunk']
+                    chunk = open(os.path.join(self.folder, chunk_name(int(number))), 'rb')
+                chunk.seek(int(row['offset']))
+                jpeg = chunk.read(int(row['length']))
+                if len(jpeg) < int(row['length']):
+                    # the last frame of an interrupted recording
+                    break
+                yield jpeg, row
+        finally:
+            if chunk is not None:
+                chunk.close()
+
+    def frames(self, step=1):
+        '''
+        :param step: keep one frame out of step
+        :return: the decoded BGR frames
+        '''
+        for i, (jpeg, _) in enumerate(self):
+            if i % step == 0:
+                yield cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR)
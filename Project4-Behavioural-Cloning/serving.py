@@ -0,0 +1,123 @@
+import collections
+import time
+
+import eventlet
+import eventlet.event
+from eventlet import tpool
+import numpy as np
+
+
+class LatencyStats():
+    '''
+    Telemetry to steer latencies of the last frames, printed every report_every frames
+    '''
+    def __init__(self, report_every=100, window=1000):
+        self.report_every = report_every
+        # latencies in seconds of the last window frames
+        self.latencies = collections.deque(maxlen=window)
+        # sizes of the batches of the last window frames
+        self.batch_sizes = collections.deque(maxlen=window)
+        # frames served and frames replaced by a newer one before inference
+        self.served = 0
+        self.dropped = 0
+
+    def add(self, latency, batch_size):
+        self.latencies.append(latency)
+        self.batch_sizes.append(batch_size)
+        self.served += 1
+        if self.served % self.report_every == 0:
+            print(self.report())
+
+    def report(self):
+        latencies = 1000 * np.array(self.latencies)
+        return ('latency ms: mean {:.1f} p50 {:.1f} p95 {:.1f} max {:.1f}, mean batch {:.2f}, '
+                'served {}, dropped {}').format(latencies.mean(), np.percentile(latencies, 50),
+                                                np.percentile(latencies, 95), latencies.max(),
+                                                np.mean(self.batch_sizes), self.served, self.dropped)
+
+
+class InferenceServer():
+    '''
+    Steering angles predicted by a dedicated thread, on the newest frame of every client.
+
+    The telemetry handler only stores the frame of its client, replacing the one not yet predicted, so
+    the steering is never computed on a stale frame. The inference loop takes the frames of all the
+    clients waiting, decodes them and runs one batched forward pass in the thread while the eventlet
+    loop keeps receiving telemetry, then sends every client its steering angle.
+    '''
+    def __init__(self, load, decode, send, report_every=100):
+        '''
+        :param load: function run in the inference thread, returning the predict function of a batch
+        :param decode: function of the image string of a telemetry message, returning the image array
+        :param send: function of (sid, steering_angle, speed) sending the control to a client
+        :param report_every: number of frames between latency reports
+        '''
+        self.load = load
+        self.decode = decode
+        self.send = send
+        # newest frame of every client waiting for inference: (image string, speed, arrival time)
+        self.pending = collections.OrderedDict()
+        self.ready = eventlet.event.Event()
+        self.predict = None
+        self.stats = LatencyStats(report_every)
+
+    def start(self):
+        '''
+        Build the predict function in the inference thread, then serve the frames in a green thread
+        '''
+        # the model lives in a single thread, as the graph of the backend may be bound to it
+        tpool.set_num_threads(1)
+        self.predict = tpool.execute(self.load)
+        return eventlet.spawn(self.run)
+
+    def submit(self, sid, image, speed):
+        '''
+        Called by the telemetry handler, the frame replaces the waiting frame of the client if any
+        '''
+        if self.pending.pop(sid, None) is not None:
+            self.stats.dropped += 1
+        self.pending[sid] = (image, speed, time.perf_counter())
+        if not self.ready.ready():
+            self.ready.send()
+
+    def infer(self, images):
+        '''
+        :param images: image strings of the frames of the clients
+        :return: the indices of the frames decoded, and their steering angles
+        '''
+        # decode may reuse its output buffer, every frame is copied into the batch before the next one
+        batch = None
+        decoded = []
+        for i, image in enumerate(images):
+            # a frame that cannot be decoded is skipped, the other clients are still served
+            try:
+                frame = self.decode(image)
+                if batch is None:
+                    batch = np.empty((len(images),) + frame.shape, frame.dtype)
+                batch[len(decoded)] = frame
+            except Exception as e:
+                print('Cannot decode frame: {}'.format(e))
+                continue
+            decoded.append(i)
+        if not decoded:
+            return decoded, []
+        return decoded, np.asarray(self.predict(batch[:len(decoded)])).reshape(-1)
+
+    def run(self):
+        while True:
+            self.ready.wait()
+            self.ready = eventlet.event.Event()
+            frames, self.pending = self.pending, collections.OrderedDict()
+            if not frames:
+                continue
+            sids = list(frames)
+            try:
+                decoded, steering_angles = tpool.execute(self.infer, [frames[sid][0] for sid in sids])
+            except Exception as e:
+                print('Inference failed: {}'.format(e))
+                continue
+            for i, steering_angle in zip(decoded, steering_angles):
+                sid = sids[i]
+                _, speed, arrival = frames[sid]
+                self.send(sid, float(steering_angle), speed)
+                self.stats.add(time.perf_counter() - arrival, len(decoded))
@@ -1,8 +1,59 @@
-from moviepy.editor import ImageSequenceClip
 import argparse
+import itertools
 import os
+import sys
 
-IMAGE_EXT = ['jpeg', 'gif', 'png', 'jpg']
+from recorder import ArchiveReader, is_archive
+
+# the streaming video encoding (video_io) is shared with the lane finding projects, its directory is resolved here
+# so the module works from any working directory and importer, and appended so the modules of the importer come first
+PROJECT2_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                                             'Project2-Advance-Lane-Finding'))
+if PROJECT2_DIR not in sys.path:
+    sys.path.append(PROJECT2_DIR)
+
+from video_io import FrameReader, FrameWriter, image_sequence
+
+
+def open_writer(paths, fps, height, width):
+    '''
+    :param paths: paths of the video, tried in order
+    :return: a FrameWriter opened on the first path where the video can be written
+    '''
+    for path in paths:
+        writer = FrameWriter(path, fps, rgb=False)
+        try:
+            writer.open(height, width)
+            return writer
+        except IOError as e:
+            error = e
+    raise error
+
+
+def write_frames(frames, paths, fps):
+    '''
+    Stream BGR frames into a video. The output is opened before the frames are read, so only a video
+    that cannot be written falls back to the next path, an image that cannot be read is raised
+    :param frames: iterable of BGR frames of the same size
+    :param paths: paths of the video, tried in order
+    :return: the number of frames written
+    '''
+    frames = iter(frames)
+    first = next(frames, None)
+    if first is None:
+        return 0
+    with open_writer(paths, fps, *first.shape[:2]) as writer:
+        for frame in itertools.chain([first], frames):
+            writer.write(frame)
+    return writer.count
+
+
+def write_archive(folder, paths, fps, step):
+    '''
+    Stream the frames of an archive recorded by drive.py --archive into a video
+    :return: the number of frames written
+    '''
+    return write_frames(ArchiveReader(folder).frames(step), paths, fps)
 
 
 def main():
@@ -11,32 +62,35 @@ def main():
         'image_folder',
         type=str,
         default='',
-        help='Path to image folder. The video will be created from these images.'
+        help='Path to image folder, or archive recorded by drive.py --archive. '
+             'The video will be created from these images.'
     )
     parser.add_argument(
         '--fps',
         type=int,
         default=60,
         help='FPS (Frames per second) setting for the video.')
+    parser.add_argument(
+        '--step',
+        type=int,
+        default=1,
+        help='Keep one image out of step.')
     args = parser.parse_args()
 
-    #convert file folder into list firltered for image file types
-    image_list = sorted([os.path.join(args.image_folder, image_file)
-                        for image_file in os.listdir(args.image_folder)])
-    
-    image_list = [image_file for image_file in image_list if os.path.splitext(image_file)[1][1:].lower() in IMAGE_EXT]
-
     #two methods of naming output video to handle varying environemnts
     video_file_1 = args.image_folder + '.mp4'
     video_file_2 = args.image_folder + 'output_video.mp4'
 
     print("Creating video {}, FPS={}".format(args.image_folder, args.fps))
-    clip = ImageSequenceClip(image_list, fps=args.fps)
-    
-    try:
-        clip.write_videofile(video_file_1)
-    except:
-        clip.write_videofile(video_file_2)
+    if is_archive(args.image_folder):
+        count = write_archive(args.image_folder, (video_file_1, video_file_2), args.fps, args.step)
+    else:
+        #convert file folder into list firltered for image file types
+        image_list = image_sequence(args.image_folder)
+        # the images are decoded and encoded one at a time, not loaded all at once
+        with FrameReader(image_list, step=args.step, rgb=False) as reader:
+            count = write_frames(reader, (video_file_1, video_file_2), args.fps)
+    print("{} frames written".format(count))
 
 
 if __name__ == '__main__':